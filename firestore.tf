@@ -61,4 +61,96 @@ resource "google_firestore_index" "labs_status_expires" {
     google_project_service.apis,
     google_firestore_database.default
   ]
-}
\ No newline at end of file
+}
+# Participant listing sorts: labs(status ASC, field ASC|DESC) for each
+# sort option of GET /api/v1/admin/participants (expires_at ASC is above).
+locals {
+  labs_participant_sorts = {
+    expires_at_desc  = { field = "expires_at", order = "DESCENDING" }
+    created_at_asc   = { field = "created_at", order = "ASCENDING" }
+    created_at_desc  = { field = "created_at", order = "DESCENDING" }
+    owner_email_asc  = { field = "owner_email", order = "ASCENDING" }
+    owner_email_desc = { field = "owner_email", order = "DESCENDING" }
+  }
+}
+
+resource "google_firestore_index" "labs_status_sort" {
+  for_each = local.labs_participant_sorts
+
+  provider    = google-beta
+  project     = var.project_id
+  database    = google_firestore_database.default.name
+  collection  = "labs"
+  query_scope = "COLLECTION"
+
+  fields {
+    field_path = "status"
+    order      = "ASCENDING"
+  }
+
+  fields {
+    field_path = each.value.field
+    order      = each.value.order
+  }
+
+  depends_on = [
+    google_project_service.apis,
+    google_firestore_database.default
+  ]
+}
+
+# Audit log query indexes: one (field ASC, timestamp DESC) index per
+# server-side filter used by GET /api/v1/admin/audit-logs. Firestore merges
+# these for combined equality filters.
+locals {
+  audit_log_filter_fields = ["actor_role", "actor_email", "action", "status"]
+}
+
+resource "google_firestore_index" "audit_logs_filter_timestamp" {
+  for_each = toset(local.audit_log_filter_fields)
+
+  provider    = google-beta
+  project     = var.project_id
+  database    = google_firestore_database.default.name
+  collection  = "audit_logs"
+  query_scope = "COLLECTION"
+
+  fields {
+    field_path = each.value
+    order      = "ASCENDING"
+  }
+
+  fields {
+    field_path = "timestamp"
+    order      = "DESCENDING"
+  }
+
+  depends_on = [
+    google_project_service.apis,
+    google_firestore_database.default
+  ]
+}
+
+# Composite index: audit_logs(search_keywords CONTAINS, timestamp DESC)
+resource "google_firestore_index" "audit_logs_keywords_timestamp" {
+  provider    = google-beta
+  project     = var.project_id
+  database    = google_firestore_database.default.name
+  collection  = "audit_logs"
+  query_scope = "COLLECTION"
+
+  fields {
+    field_path   = "search_keywords"
+    array_config = "CONTAINS"
+  }
+
+  fields {
+    field_path = "timestamp"
+    order      = "DESCENDING"
+  }
+
+  depends_on = [
+    google_project_service.apis,
+    google_firestore_database.default
+  ]
+}
@@ -31,12 +31,34 @@ spec:
         app: lab-manager-v2-api
     spec:
       serviceAccountName: lab-manager
+      # Longer than GRACEFUL_TIMEOUT + preStop so gunicorn can drain in-flight requests
+      terminationGracePeriodSeconds: 45
       containers:
       - name: api
         image: "${var.region}-docker.pkg.dev/${var.project_id}/${google_artifact_registry_repository.lab_repo.repository_id}/lab-manager-v2-api:latest"
         imagePullPolicy: Always
         ports:
         - containerPort: 8080
+        # The CPU limit sets the cgroup quota that app.server sizes its worker count from
+        resources:
+          requests:
+            cpu: "1"
+            memory: "512Mi"
+          limits:
+            cpu: "2"
+            memory: "1Gi"
+        # /healthz returns 503 until secrets are loaded and startup work is done
+        readinessProbe:
+          httpGet:
+            path: /healthz
+            port: 8080
+          periodSeconds: 2
+          failureThreshold: 3
+        lifecycle:
+          preStop:
+            exec:
+              # Let the load balancer stop routing here before SIGTERM starts the drain
+              command: ["sleep", "5"]
         env:
         - name: GCP_PROJECT
           value: "${var.project_id}"
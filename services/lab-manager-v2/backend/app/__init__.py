@@ -1 +1,6 @@
 # Lab Manager v2
+
+from app import startup_profile
+
+# Must run before any other app module is imported to time their imports.
+startup_profile.install()
@@ -0,0 +1,334 @@
+"""Asynchronous audit-log writer and audit query helpers.
+
+log_audit_event() only enqueues; a background thread writes events to
+Firestore in WriteBatches of up to 500, flushed by size or time. When the
+queue is full the AUDIT_OVERFLOW_POLICY applies:
+
+- "block": wait up to AUDIT_BLOCK_TIMEOUT for space (request latency then
+  depends on Firestore again), then spill
+- "drop_oldest": discard the oldest queued event
+- "spill": append the event to AUDIT_SPILL_PATH as NDJSON; the file is
+  replayed into the queue at the next startup
+
+Spilled events are handed to the writer thread, which does the file I/O,
+so enqueue() never writes to disk on the caller's (event loop) thread.
+"""
+import base64
+import binascii
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from google.cloud import firestore
+from app.auth import get_db
+from app.config import (
+    AUDIT_LOGS_COLLECTION, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL,
+    AUDIT_OVERFLOW_POLICY, AUDIT_BLOCK_TIMEOUT, AUDIT_SPILL_PATH
+)
+from app.services import now_utc
+
+FIRESTORE_MAX_BATCH = 500
+KEYWORD_FIELDS = ("actor_email", "action", "target", "status")
+KEYWORD_MIN_PREFIX = 2
+KEYWORD_MAX_PREFIX = 24
+
+def search_keywords(event: Dict) -> List[str]:
+    """Lowercase tokens (and their prefixes) used for server-side search.
+
+    Each of KEYWORD_FIELDS contributes its full value plus every
+    alphanumeric token, expanded to prefixes so array_contains can answer
+    prefix queries such as "ali" for "alice@example.com".
+    """
+    keywords = set()
+    for field in KEYWORD_FIELDS:
+        value = str(event.get(field) or "").lower()
+        if not value:
+            continue
+        for token in {value, *re.split(r"[^a-z0-9]+", value)}:
+            token = token[:KEYWORD_MAX_PREFIX]
+            for end in range(KEYWORD_MIN_PREFIX, len(token) + 1):
+                keywords.add(token[:end])
+    return sorted(keywords)
+
+class AuditWriter:
+    def __init__(self, max_queue: int = AUDIT_QUEUE_SIZE, batch_size: int = AUDIT_BATCH_SIZE,
+                 flush_interval: float = AUDIT_FLUSH_INTERVAL, overflow: str = AUDIT_OVERFLOW_POLICY,
+                 spill_path: str = AUDIT_SPILL_PATH, block_timeout: float = AUDIT_BLOCK_TIMEOUT):
+        self.batch_size = max(1, min(batch_size, FIRESTORE_MAX_BATCH))
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.block_timeout = block_timeout
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=max_queue)
+        # Events waiting for the writer thread to spill them
+        self._overflow: "deque[Dict]" = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "batches": 0, "dropped": 0, "spilled": 0, "errors": 0}
+
+    # Producer side
+
+    def _count(self, stat: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[stat] += n
+
+    def enqueue(self, event: Dict) -> None:
+        self._ensure_started()
+        self._count("enqueued")
+        try:
+            if self.overflow == "block":
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+            return
+        except queue.Full:
+            pass
+        if self.overflow != "drop_oldest":
+            self._overflow.append(event)
+            return
+        try:
+            self._queue.get_nowait()
+            self._count("dropped")
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count("dropped")
+
+    def _spill_overflow(self) -> None:
+        events = []
+        while self._overflow:
+            events.append(self._overflow.popleft())
+        if events:
+            self._spill(events)
+
+    def _spill(self, events: List[Dict]) -> None:
+        try:
+            with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as spill:
+                for event in events:
+                    record = dict(event)
+                    if hasattr(record.get("timestamp"), "isoformat"):
+                        record["timestamp"] = record["timestamp"].isoformat()
+                    spill.write(json.dumps(record, default=str) + "\n")
+            self._count("spilled", len(events))
+        except Exception as e:
+            self._count("dropped", len(events))
+            print(f"WARNING: Failed to spill {len(events)} audit event(s): {e}")
+
+    def replay_spill(self) -> int:
+        """Re-enqueue events spilled by a previous process and remove the file."""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return 0
+        with self._spill_lock:
+            replay_path = f"{self.spill_path}.replay"
+            os.replace(self.spill_path, replay_path)
+        count = 0
+        with open(replay_path, encoding="utf-8") as spill:
+            for line in spill:
+                try:
+                    event = json.loads(line)
+                    if isinstance(event.get("timestamp"), str):
+                        event["timestamp"] = datetime.fromisoformat(event["timestamp"])
+                except ValueError:
+                    continue
+                self.enqueue(event)
+                count += 1
+        os.remove(replay_path)
+        return count
+
+    # Writer side
+
+    def _ensure_started(self) -> None:
+        if os.getpid() != self._pid:
+            # Forked child: the parent's writer thread does not exist here.
+            self._pid = os.getpid()
+            self._thread = None
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self) -> List[Dict]:
+        batch: List[Dict] = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 and batch:
+                break
+            try:
+                batch.append(self._queue.get(timeout=max(timeout, 0.05)))
+            except queue.Empty:
+                if batch or self._stopping.is_set():
+                    break
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            self._spill_overflow()
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            elif self._stopping.is_set():
+                self._spill_overflow()
+                return
+
+    def _write(self, events: List[Dict]) -> None:
+        try:
+            db = get_db()
+            logs = db.collection(AUDIT_LOGS_COLLECTION)
+            batch = db.batch()
+            for event in events:
+                batch.set(logs.document(), event)
+            batch.commit()
+            with self._stats_lock:
+                self._stats["written"] += len(events)
+                self._stats["batches"] += 1
+        except Exception as e:
+            self._count("errors")
+            print(f"WARNING: Failed to write {len(events)} audit event(s): {e}")
+            if self.overflow == "spill":
+                self._spill(events)
+            else:
+                self._count("dropped", len(events))
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        """Flush everything queued, then stop the writer thread."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                print(f"WARNING: Audit writer did not drain within {timeout}s ({self._queue.qsize()} left)")
+            self._thread = None
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {**stats, "queued": self._queue.qsize(), "overflow": len(self._overflow)}
+
+_writer = AuditWriter()
+
+def get_audit_writer() -> AuditWriter:
+    return _writer
+
+def log_audit_event(actor_email: str, actor_role: str, action: str, target: Optional[str] = None,
+                    status: str = "success", details: Optional[Dict] = None) -> None:
+    """Queue an audit event for asynchronous writing."""
+    try:
+        event = {
+            "timestamp": now_utc(),
+            "actor_email": actor_email,
+            "actor_role": actor_role,
+            "action": action,
+            "target": target,
+            "status": status,
+            "details": details or {},
+        }
+        event["search_keywords"] = search_keywords(event)
+        _writer.enqueue(event)
+    except Exception as e:
+        print(f"WARNING: Failed to log audit event: {e}")
+
+# Query engine
+
+AUDIT_ROLES = ["ADMIN", "STUDENT", "PARTICIPANT", "SYSTEM"]
+EXPORT_PAGE_SIZE = 500
+
+def encode_cursor(doc_id: str) -> str:
+    return base64.urlsafe_b64encode(doc_id.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        doc_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    # Characters outside the alphabet are dropped rather than rejected, which can leave nothing
+    if not doc_id:
+        raise ValueError("Invalid cursor")
+    return doc_id
+
+def build_audit_query(actor: Optional[str] = None, action: Optional[str] = None,
+                      status: Optional[str] = None, role: Optional[str] = None,
+                      search: Optional[str] = None, since: Optional[datetime] = None,
+                      until: Optional[datetime] = None):
+    """Build a timestamp-descending audit query with all filters applied server-side.
+
+    Equality filters are served by the (field, timestamp DESC) composite
+    indexes in firestore.tf, which Firestore merges for combined filters.
+    search is a single term matched against search_keywords (prefix match);
+    events written before that field existed are not searchable.
+    """
+    query = get_db().collection(AUDIT_LOGS_COLLECTION)
+    if actor:
+        query = query.where("actor_email", "==", actor.strip().lower())
+    if action:
+        query = query.where("action", "==", action.strip())
+    if status:
+        query = query.where("status", "==", status.strip())
+    if role and role.upper() in AUDIT_ROLES:
+        query = query.where("actor_role", "==", role.upper())
+    if search and search.strip():
+        term = search.strip().lower()[:KEYWORD_MAX_PREFIX]
+        query = query.where("search_keywords", "array_contains", term)
+    if since:
+        query = query.where("timestamp", ">=", since)
+    if until:
+        query = query.where("timestamp", "<", until)
+    return query.order_by("timestamp", direction=firestore.Query.DESCENDING)
+
+def _start_after(query, cursor: Optional[str]):
+    if not cursor:
+        return query
+    snap = get_db().collection(AUDIT_LOGS_COLLECTION).document(decode_cursor(cursor)).get()
+    if not snap.exists:
+        raise ValueError("Invalid cursor")
+    return query.start_after(snap)
+
+def serialize_audit_log(doc_id: str, data: Dict) -> Dict:
+    timestamp = data.get("timestamp")
+    if hasattr(timestamp, "isoformat"):
+        timestamp = timestamp.isoformat()
+    return {
+        "id": doc_id,
+        "timestamp": timestamp,
+        "role": data.get("actor_role", "UNKNOWN"),
+        "actor": data.get("actor_email", "unknown"),
+        "action": data.get("action", "unknown"),
+        "target": data.get("target", ""),
+        "status": data.get("status", "unknown"),
+        "details": data.get("details", {}),
+    }
+
+def query_audit_logs(limit: int = 50, cursor: Optional[str] = None, **filters) -> Tuple[List[Dict], Optional[str]]:
+    """Return one page of audit logs and the cursor for the next page (None at the end)."""
+    query = _start_after(build_audit_query(**filters), cursor).limit(limit)
+    docs = list(query.stream())
+    logs = [serialize_audit_log(doc.id, doc.to_dict()) for doc in docs]
+    next_cursor = encode_cursor(docs[-1].id) if len(docs) == limit else None
+    return logs, next_cursor
+
+def iter_audit_logs(page_size: int = EXPORT_PAGE_SIZE, **filters) -> Iterator[Dict]:
+    """Yield every matching audit log, one page in memory at a time."""
+    query = build_audit_query(**filters)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.limit(page_size).stream())
+        for doc in docs:
+            yield serialize_audit_log(doc.id, doc.to_dict())
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
@@ -1,15 +1,16 @@
 """Simplified authentication system with bcrypt and JWT."""
-import bcrypt
+import asyncio
 import jwt
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict
-from fastapi import HTTPException, Header
+from fastapi import HTTPException, Header, Query
 from pydantic import BaseModel, EmailStr
-from google.cloud import firestore
-from app.config import (
-    JWT_SECRET, JWT_ALGORITHM, TOKEN_EXPIRE_HOURS, USERS_COLLECTION,
-    GCP_PROJECT, FIRESTORE_DB
-)
+from app import hashing
+from app.clients import get_firestore_client, get_async_firestore_client
+from app.credential_cache import get_credential_cache
+from app.config import TOKEN_EXPIRE_HOURS, USERS_COLLECTION
+from app.secret_store import get_jwt_secret
+from app.tokens import UnknownKeyError, encode_token, decode_token, refresh_jwt_secret
 
 # Models
 class LoginRequest(BaseModel):
@@ -22,36 +23,57 @@ class LoginResponse(BaseModel):
 
 # Helper Functions
 def hash_password(password: str) -> str:
-    """Hash password with bcrypt."""
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    """Hash password with bcrypt (runs on the hashing process pool)."""
+    return hashing.hash_password(password)
 
 def verify_password(password: str, hashed: str) -> bool:
-    """Verify password against hash."""
-    return bcrypt.checkpw(password.encode(), hashed.encode())
+    """Verify password against hash (runs on the hashing process pool)."""
+    return hashing.verify_password(password, hashed)
 
 def is_master_password(password: str) -> bool:
     """Allow login with the lab_manager_auth_token secret value."""
-    return bool(JWT_SECRET) and password == JWT_SECRET
+    secret = get_jwt_secret()
+    return bool(secret) and password == secret
 
 def create_token(email: str, role: str) -> str:
     """Create JWT token."""
     expire = datetime.now(timezone.utc) + timedelta(hours=TOKEN_EXPIRE_HOURS)
     payload = {"sub": email, "role": role, "exp": expire}
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return encode_token(payload)
 
 def verify_token(token: str) -> Dict:
-    """Verify and decode JWT token."""
+    """Verify and decode JWT token (verified claims are cached until exp)."""
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = decode_token(token)
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def verify_token_async(token: str) -> Dict:
+    """verify_token() that re-reads the JWT secret once if the token's key is unknown.
+
+    Replicas pick up a rotated secret at slightly different times; a token
+    signed by one that rotated first carries a key id this one has not seen.
+    """
+    try:
+        return decode_token(token)
+    except UnknownKeyError:
+        await asyncio.to_thread(refresh_jwt_secret)
+    except jwt.InvalidTokenError:
+        pass
+    # Decode again to map any remaining failure to the right 401
+    return verify_token(token)
+
 # Firestore Operations
 def get_db():
-    return firestore.Client(project=GCP_PROJECT, database=FIRESTORE_DB)
+    """Return the process-wide shared Firestore client."""
+    return get_firestore_client()
+
+def get_async_db():
+    """Return the shared asyncio Firestore client (request handlers only)."""
+    return get_async_firestore_client()
 
 def create_user(email: str, password: str, role: str):
     """Create user in Firestore."""
@@ -73,23 +95,20 @@ def create_user(email: str, password: str, role: str):
     }
     
     db.collection(USERS_COLLECTION).add(user_data)
+    get_credential_cache().invalidate(email_lower)
     return user_data
 
-def authenticate_user(email: str, password: str) -> Optional[Dict]:
+async def authenticate_user(email: str, password: str) -> Optional[Dict]:
     """Authenticate user and return user data."""
-    db = get_db()
     email_lower = email.lower().strip()
+    cache = get_credential_cache()
     
-    # Find user
-    users = db.collection(USERS_COLLECTION).where("email", "==", email_lower).limit(1).stream()
-    user_list = list(users)
+    # Find user (cached briefly so login bursts skip the query)
+    user_id, user_data = await cache.aget_user(email_lower)
     
-    if not user_list:
+    if user_data is None:
         return None
     
-    user_doc = user_list[0]
-    user_data = user_doc.to_dict()
-    
     # Check active
     if not user_data.get("is_active", True):
         raise HTTPException(status_code=403, detail="Account deactivated")
@@ -97,17 +116,34 @@ def authenticate_user(email: str, password: str) -> Optional[Dict]:
     # Verify password (allow Secret Manager token as a master password)
     if is_master_password(password):
         return {"email": user_data["email"], "role": user_data["role"]}
-    if not verify_password(password, user_data["password_hash"]):
+    if cache.is_verified(email_lower, password, user_data["password_hash"]):
+        return {"email": user_data["email"], "role": user_data["role"]}
+    if not await hashing.verify_password_async(password, user_data["password_hash"]):
         return None
+    cache.remember_verified(email_lower, password, user_data["password_hash"])
+    
+    # Upgrade hashes made under an older cost policy, off the request path
+    if hashing.needs_rehash(user_data["password_hash"]):
+        def store_rehash(new_hash: str) -> None:
+            # Runs on a pool callback thread, so use the sync client
+            get_db().collection(USERS_COLLECTION).document(user_id).update({"password_hash": new_hash})
+            cache.invalidate(email_lower)
+        hashing.rehash_in_background(password, store_rehash)
     
     return {"email": user_data["email"], "role": user_data["role"]}
 
 # Dependency
-def get_current_user(authorization: Optional[str] = Header(None)) -> Dict:
+async def get_current_user(authorization: Optional[str] = Header(None)) -> Dict:
     """Get current user from token."""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing token")
     
     token = authorization.split(" ", 1)[1]
-    payload = verify_token(token)
+    payload = await verify_token_async(token)
     return {"email": payload["sub"], "role": payload.get("role", "student")}
+
+async def get_stream_user(authorization: Optional[str] = Header(None), access_token: Optional[str] = Query(None)) -> Dict:
+    """Like get_current_user, but also accepts ?access_token= (EventSource cannot set headers)."""
+    if not authorization and access_token:
+        authorization = f"Bearer {access_token}"
+    return await get_current_user(authorization)
@@ -0,0 +1,15 @@
+"""bcrypt entry points executed in the hashing process pool.
+
+Kept free of app imports so spawned workers start without loading
+configuration or Google Cloud clients.
+"""
+import bcrypt
+
+def hashpw(password: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds)).decode()
+
+def checkpw(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+def ping() -> bool:
+    return True
@@ -0,0 +1,142 @@
+"""Process-wide registry of shared Google Cloud clients."""
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+from app.config import GCP_PROJECT, FIRESTORE_DB
+
+_lock = threading.RLock()
+_clients: Dict[Tuple[str, ...], Any] = {}
+_credentials: Optional[Tuple[Any, Optional[str]]] = None
+_owner_pid = os.getpid()
+_created_total = 0
+
+def _reset_after_fork() -> None:
+    """Drop clients inherited from the parent; gRPC channels are not fork-safe."""
+    global _lock, _credentials, _owner_pid, _created_total
+    _lock = threading.RLock()
+    _clients.clear()
+    _credentials = None
+    _owner_pid = os.getpid()
+    _created_total = 0
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _get_credentials():
+    """Resolve Application Default Credentials once per process."""
+    global _credentials
+    if _credentials is None:
+        try:
+            import google.auth
+            _credentials = google.auth.default()
+        except Exception as e:
+            print(f"WARNING: Failed to resolve default credentials: {e}")
+            _credentials = (None, None)
+    return _credentials[0]
+
+def _get_or_create(key: Tuple[str, ...], factory: Callable[[], Any]) -> Any:
+    global _created_total
+    if os.getpid() != _owner_pid:
+        _reset_after_fork()
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory()
+            _clients[key] = client
+            _created_total += 1
+    return client
+
+def get_firestore_client(project: str = GCP_PROJECT, database: str = FIRESTORE_DB):
+    """Return the shared Firestore client for (project, database)."""
+    def factory():
+        from google.cloud import firestore
+        if os.getenv("FIRESTORE_EMULATOR_HOST"):
+            return firestore.Client(project=project, database=database)
+        return firestore.Client(project=project, database=database, credentials=_get_credentials())
+    return _get_or_create(("firestore", project, database), factory)
+
+def get_async_firestore_client(project: str = GCP_PROJECT, database: str = FIRESTORE_DB):
+    """Return the shared asyncio Firestore client for (project, database).
+
+    Its gRPC channel binds to the event loop of the first RPC, so only use it
+    from the server's event loop (request handlers, not worker threads).
+    """
+    def factory():
+        from google.cloud import firestore
+        if os.getenv("FIRESTORE_EMULATOR_HOST"):
+            return firestore.AsyncClient(project=project, database=database)
+        return firestore.AsyncClient(project=project, database=database, credentials=_get_credentials())
+    return _get_or_create(("firestore.async", project, database), factory)
+
+def get_run_services_client():
+    """Return the shared Cloud Run v2 Services client."""
+    def factory():
+        from google.cloud import run_v2
+        return run_v2.ServicesClient(credentials=_get_credentials())
+    return _get_or_create(("run_v2.services",), factory)
+
+def get_dns_client(project: str = GCP_PROJECT):
+    """Return the shared Cloud DNS client for a project."""
+    def factory():
+        from google.cloud import dns
+        return dns.Client(project=project, credentials=_get_credentials())
+    return _get_or_create(("dns", project), factory)
+
+def get_secret_manager_client():
+    """Return the shared Secret Manager client."""
+    def factory():
+        from google.cloud import secretmanager
+        return secretmanager.SecretManagerServiceClient(credentials=_get_credentials())
+    return _get_or_create(("secretmanager",), factory)
+
+def _has_open_channel(key: Tuple[str, ...], client: Any) -> bool:
+    if key[0] in ("firestore", "firestore.async"):
+        # The Firestore GAPIC client (and its channel) is built on first RPC.
+        return getattr(client, "_firestore_api_internal", None) is not None
+    if key[0] == "dns":
+        # HTTP-based; the connection pool lives on the authorized session.
+        return getattr(client, "_http_internal", None) is not None
+    return True
+
+def client_stats() -> Dict[str, int]:
+    """Return counts of live clients and open channels in this process."""
+    with _lock:
+        items = list(_clients.items())
+    return {
+        "pid": os.getpid(),
+        "clients": len(items),
+        "channels": sum(1 for key, client in items if _has_open_channel(key, client)),
+        "created_total": _created_total,
+    }
+
+async def close_async_clients() -> None:
+    """Close shared asyncio clients; must run on the event loop that used them."""
+    with _lock:
+        items = [(key, _clients.pop(key)) for key in list(_clients) if key[0].endswith(".async")]
+    for key, client in items:
+        try:
+            api = getattr(client, "_firestore_api_internal", None)
+            if api is not None:
+                await api.transport.close()
+        except Exception as e:
+            print(f"WARNING: Failed to close client {key[0]}: {e}")
+
+def close_clients() -> None:
+    """Close all shared clients (used on shutdown)."""
+    with _lock:
+        items = list(_clients.items())
+        _clients.clear()
+    for key, client in items:
+        try:
+            if key[0].endswith(".async"):
+                # Needs the event loop; see close_async_clients().
+                continue
+            if key[0] in ("run_v2.services", "secretmanager"):
+                client.transport.close()
+            elif hasattr(client, "close"):
+                client.close()
+        except Exception as e:
+            print(f"WARNING: Failed to close client {key[0]}: {e}")
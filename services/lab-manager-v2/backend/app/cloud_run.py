@@ -0,0 +1,278 @@
+"""Cloud Run control plane for attack-client services.
+
+CloudRunServices keeps a process-local index of the lab-manager services
+(name -> URI, and whether the public invoker grant is known to be in
+place), loaded by one list_services() sweep at startup and re-swept at
+most every CLOUD_RUN_INDEX_TTL_SECONDS. ensure_service() on a known
+service is a dictionary lookup, and a service missing from a fresh
+listing goes straight to create_service() and the IAM grant (a
+get_service() is only needed when the sweep failed). Services
+deleted by another replica can look alive here for up to the TTL.
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from app.clients import get_run_services_client
+from app.metrics import timed
+from app.config import (
+    GCP_PROJECT, GCP_REGION, ATTACK_CLIENT_IMAGE, CLOUD_RUN_BACKEND, CLOUD_RUN_INDEX_TTL_SECONDS
+)
+
+MANAGED_LABEL = ("managed-by", "lab-manager")
+INVOKER_ROLE = "roles/run.invoker"
+OPERATION_TIMEOUT = 300
+
+# Service dicts: {"name": "attack-client-x", "uri": "https://..."}
+
+def _fallback_uri(service_name: str) -> str:
+    return f"https://{service_name}-{GCP_PROJECT[:8]}.{GCP_REGION}.run.app"
+
+class GcpRunBackend:
+    """Cloud Run Admin API v2 over the shared ServicesClient."""
+
+    def __init__(self, project: str = GCP_PROJECT, region: str = GCP_REGION):
+        self.parent = f"projects/{project}/locations/{region}"
+
+    def _path(self, service_name: str) -> str:
+        return f"{self.parent}/services/{service_name}"
+
+    @staticmethod
+    def _to_service(service) -> Dict:
+        name = service.name.rsplit("/", 1)[-1]
+        uri = service.uri or (service.urls[0] if getattr(service, "urls", None) else "")
+        return {"name": name, "uri": uri or _fallback_uri(name)}
+
+    def list_services(self) -> List[Dict]:
+        key, value = MANAGED_LABEL
+        with timed("cloud_run", "list_services"):
+            return [self._to_service(service)
+                    for service in get_run_services_client().list_services(parent=self.parent)
+                    if service.labels.get(key) == value]
+
+    def get_service(self, service_name: str) -> Optional[Dict]:
+        from google.api_core.exceptions import NotFound
+        with timed("cloud_run", "get_service") as call:
+            try:
+                return self._to_service(get_run_services_client().get_service(name=self._path(service_name)))
+            except NotFound:
+                call.outcome = "not_found"
+                return None
+
+    def create_service(self, service_name: str) -> Dict:
+        """Create and wait for a service; raises AlreadyExists if it exists."""
+        # Imported on first use to keep them off the startup path
+        from google.cloud.run_v2 import types
+        container = types.Container(
+            image=ATTACK_CLIENT_IMAGE,
+            ports=[types.ContainerPort(container_port=8080)],
+            env=[types.EnvVar(name="ROLE", value="ATTACKER")],
+        )
+        service = types.Service(
+            labels={MANAGED_LABEL[0]: MANAGED_LABEL[1]},
+            template=types.RevisionTemplate(
+                containers=[container],
+                service_account=f"sa-attack-client@{GCP_PROJECT}.iam.gserviceaccount.com",
+            ),
+        )
+        request = types.CreateServiceRequest(parent=self.parent, service=service, service_id=service_name)
+        with timed("cloud_run", "create_service"):
+            operation = get_run_services_client().create_service(request=request)
+            return self._to_service(operation.result(timeout=OPERATION_TIMEOUT))
+
+    def grant_public(self, service_name: str) -> bool:
+        """Give allUsers the invoker role; returns False if it already had it (no write)."""
+        from google.iam.v1 import policy_pb2, iam_policy_pb2
+        client = get_run_services_client()
+        resource = self._path(service_name)
+        with timed("iam", "get_iam_policy"):
+            policy = client.get_iam_policy(request=iam_policy_pb2.GetIamPolicyRequest(resource=resource))
+        binding = next((b for b in policy.bindings if b.role == INVOKER_ROLE), None)
+        if binding is not None and "allUsers" in binding.members:
+            return False
+        if binding is None:
+            binding = policy_pb2.Binding(role=INVOKER_ROLE)
+            binding.members.append("allUsers")
+            policy.bindings.append(binding)
+        else:
+            binding.members.append("allUsers")
+        with timed("iam", "set_iam_policy"):
+            client.set_iam_policy(request=iam_policy_pb2.SetIamPolicyRequest(resource=resource, policy=policy))
+        return True
+
+    def delete_service(self, service_name: str) -> bool:
+        from google.api_core.exceptions import NotFound
+        with timed("cloud_run", "delete_service") as call:
+            try:
+                get_run_services_client().delete_service(name=self._path(service_name)).result(timeout=OPERATION_TIMEOUT)
+            except NotFound:
+                call.outcome = "not_found"
+                return False
+        return True
+
+class MemoryRunBackend:
+    """In-process Cloud Run for local development and tests."""
+
+    def __init__(self):
+        self.services: Dict[str, Dict] = {}
+        self.public: Dict[str, bool] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, call: str) -> None:
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    def list_services(self) -> List[Dict]:
+        with self._lock:
+            self._count("list_services")
+            return [dict(service) for service in self.services.values()]
+
+    def get_service(self, service_name: str) -> Optional[Dict]:
+        with self._lock:
+            self._count("get_service")
+            service = self.services.get(service_name)
+            return dict(service) if service else None
+
+    def create_service(self, service_name: str) -> Dict:
+        from google.api_core.exceptions import AlreadyExists
+        with self._lock:
+            self._count("create_service")
+            if service_name in self.services:
+                raise AlreadyExists(f"Service {service_name} already exists")
+            self.services[service_name] = {"name": service_name, "uri": f"https://{service_name}.run.app"}
+            return dict(self.services[service_name])
+
+    def grant_public(self, service_name: str) -> bool:
+        with self._lock:
+            self._count("get_iam_policy")
+            if self.public.get(service_name):
+                return False
+            self._count("set_iam_policy")
+            self.public[service_name] = True
+            return True
+
+    def delete_service(self, service_name: str) -> bool:
+        with self._lock:
+            self._count("delete_service")
+            self.public.pop(service_name, None)
+            return self.services.pop(service_name, None) is not None
+
+class CloudRunServices:
+    def __init__(self, backend, ttl: float = CLOUD_RUN_INDEX_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        # name -> {"uri": ..., "public": True | False | None (not checked)}
+        self._services: Dict[str, Dict] = {}
+        self._swept_at: Optional[float] = None
+        self._sweep_ok = False
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "sweeps": 0, "sweep_failures": 0, "creates": 0, "iam_grants": 0,
+                       "iam_already_public": 0, "deletes": 0}
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def sweep(self) -> int:
+        """Reload the index with one list_services() call; returns the number of services."""
+        services = self.backend.list_services()
+        with self._lock:
+            known = self._services
+            # Keep what this process learned about IAM; the listing does not include it
+            self._services = {s["name"]: {"uri": s["uri"], "public": (known.get(s["name"]) or {}).get("public")}
+                              for s in services}
+            self._swept_at = time.monotonic()
+            self._sweep_ok = True
+            self._stats["sweeps"] += 1
+        return len(services)
+
+    def _lookup(self, service_name: str) -> Tuple[Optional[Dict], bool]:
+        """(index entry or None, whether a miss means the service does not exist)."""
+        if self.ttl <= 0:
+            return None, False
+        if self._swept_at is None or time.monotonic() - self._swept_at >= self.ttl:
+            with self._lock:
+                if self._swept_at is None or time.monotonic() - self._swept_at >= self.ttl:
+                    try:
+                        self.sweep()
+                    except Exception:
+                        # Counted in stats(); per-service lookups until the next attempt
+                        self._count("sweep_failures")
+                        self._swept_at = time.monotonic()
+                        self._sweep_ok = False
+        with self._lock:
+            entry = self._services.get(service_name)
+            return (dict(entry) if entry else None), self._sweep_ok
+
+    def _remember(self, service_name: str, uri: str, public: Optional[bool]) -> None:
+        if self.ttl > 0:
+            with self._lock:
+                self._services[service_name] = {"uri": uri, "public": public}
+
+    def ensure_service(self, service_name: str) -> str:
+        """Return the URI of the service, creating it (publicly invokable) if needed."""
+        entry, indexed = self._lookup(service_name)
+        # Services found by a sweep or lookup were made public when they were created
+        if entry is not None and entry["public"] is not False:
+            self._count("hits")
+            return entry["uri"]
+
+        if entry is None:
+            self._count("misses")
+            # Not in a fresh listing: go straight to create (AlreadyExists covers a race)
+            service = None if indexed else self.backend.get_service(service_name)
+            if service is not None:
+                self._remember(service_name, service["uri"], None)
+                return service["uri"]
+            from google.api_core.exceptions import AlreadyExists
+            try:
+                service = self.backend.create_service(service_name)
+                self._count("creates")
+            except AlreadyExists:
+                # Created concurrently by another replica; the grant below is a no-op if it is public
+                service = self.backend.get_service(service_name) or {"uri": _fallback_uri(service_name)}
+            uri = service["uri"]
+        else:
+            uri = entry["uri"]
+
+        # New service, or one whose grant failed before
+        try:
+            self._count("iam_grants" if self.backend.grant_public(service_name) else "iam_already_public")
+            self._remember(service_name, uri, True)
+        except Exception as e:
+            print(f"WARNING: Failed to grant public access: {e}")
+            self._remember(service_name, uri, False)
+        return uri
+
+    def delete_service(self, service_name: str) -> bool:
+        """Delete a service; returns False if it did not exist."""
+        with self._lock:
+            self._services.pop(service_name, None)
+        deleted = self.backend.delete_service(service_name)
+        if deleted:
+            self._count("deletes")
+        return deleted
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["services"] = len(self._services)
+            stats["index_age_seconds"] = None if self._swept_at is None else round(time.monotonic() - self._swept_at, 1)
+        return stats
+
+_services: Optional[CloudRunServices] = None
+_services_lock = threading.Lock()
+
+def get_cloud_run() -> CloudRunServices:
+    """Return the process-wide Cloud Run services index."""
+    global _services
+    if _services is None:
+        with _services_lock:
+            if _services is None:
+                backend = MemoryRunBackend() if CLOUD_RUN_BACKEND == "memory" else GcpRunBackend()
+                _services = CloudRunServices(backend)
+    return _services
+
+def set_cloud_run(services: Optional[CloudRunServices]) -> None:
+    """Replace the process-wide instance (e.g. with a MemoryRunBackend in tests)."""
+    global _services
+    _services = services
@@ -1,69 +1,168 @@
-"""Configuration management with Secret Manager integration."""
+"""Configuration management (secrets are loaded by app.secret_store)."""
 import os
-from functools import lru_cache
-
-try:
-    from google.cloud import secretmanager
-    
-    @lru_cache(maxsize=32)
-    def _load_secret_from_sm(secret_id: str, project_id: str) -> str:
-        """Load secret from Secret Manager."""
-        try:
-            client = secretmanager.SecretManagerServiceClient()
-            name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-            resp = client.access_secret_version(request={"name": name})
-            return resp.payload.data.decode("utf-8").strip()
-        except Exception as e:
-            print(f"WARNING: Failed to load secret {secret_id}: {e}")
-            return ""
-except ImportError:
-    def _load_secret_from_sm(secret_id: str, project_id: str) -> str:
-        return ""
 
 # GCP Configuration
 GCP_PROJECT = os.getenv("GCP_PROJECT", "appsec-unilab")
 FIRESTORE_DB = os.getenv("FIRESTORE_DB", "(default)")
 GCP_REGION = os.getenv("GCP_REGION", "us-east1")
 
+# Secret Manager ids for secrets not set in the environment (see app.secret_store)
+JWT_SECRET_ID = os.getenv("JWT_SECRET_ID", "lab-manager-auth-token")
+RESEND_SECRET_ID = os.getenv("RESEND_SECRET_ID", "resend-key")
+SECRET_FETCH_TIMEOUT = float(os.getenv("SECRET_FETCH_TIMEOUT", "10"))
+# Secrets are re-read this often; a changed value keeps the previous one usable for the grace window.
+SECRET_REFRESH_SECONDS = int(os.getenv("SECRET_REFRESH_SECONDS", "300"))
+SECRET_GRACE_SECONDS = int(os.getenv("SECRET_GRACE_SECONDS", "900"))
+# JSON file of {secret name or id: value} used instead of Secret Manager (tests, local dev)
+SECRETS_FILE = os.getenv("SECRETS_FILE", "")
+
 # JWT Configuration
-JWT_SECRET_ENV = os.getenv("JWT_SECRET_KEY", "")
-JWT_SECRET = (
-    JWT_SECRET_ENV 
-    or _load_secret_from_sm("lab-manager-auth-token", GCP_PROJECT)
-    or "dev-secret-change-me-in-production"
-)
-JWT_ALGORITHM = "HS256"
+# Algorithm for new tokens: HS256 (JWT_SECRET_KEY) or EdDSA (JWT_EDDSA_PRIVATE_KEY).
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 TOKEN_EXPIRE_HOURS = int(os.getenv("TOKEN_EXPIRE_HOURS", "4"))
+# Retired keys that must still verify: comma-separated HS256 secrets and
+# concatenated Ed25519 public key PEMs.
+JWT_PREVIOUS_SECRETS = [s.strip() for s in os.getenv("JWT_PREVIOUS_SECRETS", "").split(",") if s.strip()]
+JWT_EDDSA_PRIVATE_KEY = os.getenv("JWT_EDDSA_PRIVATE_KEY", "").replace("\\n", "\n")
+JWT_EDDSA_PUBLIC_KEYS = [
+    block.strip() + "\n-----END PUBLIC KEY-----\n"
+    for block in os.getenv("JWT_EDDSA_PUBLIC_KEYS", "").replace("\\n", "\n").split("-----END PUBLIC KEY-----")
+    if block.strip()
+]
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+
+# Password hashing (bcrypt on a dedicated process pool; 0 workers = CPU count,
+# 0 max pending = 8 per worker). Stored hashes are upgraded when BCRYPT_ROUNDS changes.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "0"))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "0"))
+BCRYPT_ACQUIRE_TIMEOUT = float(os.getenv("BCRYPT_ACQUIRE_TIMEOUT", "2"))
+
+# Login cache: user lookups and recently verified passwords (0 TTL disables)
+CREDENTIAL_CACHE_TTL_SECONDS = float(os.getenv("CREDENTIAL_CACHE_TTL_SECONDS", "300"))
+CREDENTIAL_CACHE_MAX_ENTRIES = int(os.getenv("CREDENTIAL_CACHE_MAX_ENTRIES", "10000"))
+
+# Per-call timeouts (seconds): Firestore calls made by async handlers, and mail provider calls
+FIRESTORE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_TIMEOUT_SECONDS", "10"))
+EMAIL_TIMEOUT_SECONDS = float(os.getenv("EMAIL_TIMEOUT_SECONDS", "15"))
+
+# Outgoing email: "resend", "smtp" or "memory" (records messages in-process, for tests).
+# EMAIL_SEND_RATE is provider API calls per second (Resend's default limit is 2; 0 disables).
+MAIL_BACKEND = os.getenv("MAIL_BACKEND", "resend")
+MAIL_FROM = os.getenv("MAIL_FROM", "Amplify Lab <notifications@amplifys.us>")
+MANAGER_URL = os.getenv("MANAGER_URL", "https://manager.lab.amplifys.us")
+# Point at a local HTTP stub to test the Resend backend; MAIL_BACKEND=smtp sends to SMTP_HOST (e.g. MailHog)
+RESEND_API_URL = os.getenv("RESEND_API_URL", "https://api.resend.com")
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "1025"))
+EMAIL_SEND_RATE = float(os.getenv("EMAIL_SEND_RATE", "2"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "3"))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv("EMAIL_RETRY_BASE_SECONDS", "1.0"))
+
+# Mail outbox: request handlers queue messages in MAIL_OUTBOX_COLLECTION; a worker per process delivers them.
+# Unclaimed due messages are polled every MAIL_OUTBOX_POLL_SECONDS; a claim expires after the lease.
+MAIL_OUTBOX_CONCURRENCY = int(os.getenv("MAIL_OUTBOX_CONCURRENCY", "4"))
+MAIL_OUTBOX_POLL_SECONDS = float(os.getenv("MAIL_OUTBOX_POLL_SECONDS", "30"))
+MAIL_OUTBOX_LEASE_SECONDS = float(os.getenv("MAIL_OUTBOX_LEASE_SECONDS", "120"))
+MAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("MAIL_OUTBOX_MAX_ATTEMPTS", "8"))
+
+# Bulk invites: emails per provider batch call / Firestore WriteBatch (max 100), and batches in flight
+INVITE_BATCH_SIZE = min(100, int(os.getenv("INVITE_BATCH_SIZE", "100")))
+INVITE_EMAIL_CONCURRENCY = int(os.getenv("INVITE_EMAIL_CONCURRENCY", "4"))
 
 # Firestore Collections
 LABS_COLLECTION = os.getenv("LABS_COLLECTION", "labs")
 USERS_COLLECTION = os.getenv("USERS_COLLECTION", "users")
 INVITES_COLLECTION = os.getenv("INVITES_COLLECTION", "invites")
 AUDIT_LOGS_COLLECTION = os.getenv("AUDIT_LOGS_COLLECTION", "audit_logs")
+JOBS_COLLECTION = os.getenv("JOBS_COLLECTION", "provisioning_jobs")
+INVITE_JOBS_COLLECTION = os.getenv("INVITE_JOBS_COLLECTION", "invite_jobs")
+MAIL_OUTBOX_COLLECTION = os.getenv("MAIL_OUTBOX_COLLECTION", "mail_outbox")
+PROVISIONING_LEASES_COLLECTION = os.getenv("PROVISIONING_LEASES_COLLECTION", "provisioning_leases")
+WARM_POOL_COLLECTION = os.getenv("WARM_POOL_COLLECTION", "warm_pool")
+
+# In-process lab document cache (TTL 0 disables it)
+LAB_CACHE_TTL_SECONDS = float(os.getenv("LAB_CACHE_TTL_SECONDS", "30"))
+LAB_CACHE_MAX_ENTRIES = int(os.getenv("LAB_CACHE_MAX_ENTRIES", "5000"))
+
+# Audit log writer: bounded queue flushed in Firestore WriteBatches by size or time.
+# AUDIT_OVERFLOW_POLICY: "block", "drop_oldest" or "spill" (append NDJSON to AUDIT_SPILL_PATH)
+# AUDIT_BLOCK_TIMEOUT: how long "block" waits for space before spilling (callers include async routes)
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+AUDIT_OVERFLOW_POLICY = os.getenv("AUDIT_OVERFLOW_POLICY", "spill")
+AUDIT_BLOCK_TIMEOUT = float(os.getenv("AUDIT_BLOCK_TIMEOUT", "0.1"))
+AUDIT_SPILL_PATH = os.getenv("AUDIT_SPILL_PATH", "/tmp/lab-manager-audit-spill.ndjson")
+
+# Lab status Server-Sent Events
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+SSE_REPLAY_EVENTS = int(os.getenv("SSE_REPLAY_EVENTS", "32"))
 
 # DNS Configuration
 DNS_ZONE_NAME = os.getenv("DNS_ZONE_NAME", "appsec-unilab-zone")
 DNS_ZONE_DOMAIN = os.getenv("DNS_ZONE_DOMAIN", "lab.amplifys.us")
 AIR_ORIGIN_HOSTNAME = os.getenv("AIR_ORIGIN_HOSTNAME", "air-origin.lab.amplifys.us")
+# "gcp" (Cloud DNS) or "memory" (in-process zone for local development)
+DNS_BACKEND = os.getenv("DNS_BACKEND", "gcp")
+# Changes arriving within this window are merged into one Cloud DNS change set
+DNS_BATCH_WINDOW_MS = int(os.getenv("DNS_BATCH_WINDOW_MS", "200"))
+DNS_BATCH_MAX = int(os.getenv("DNS_BATCH_MAX", "100"))
+# Max age of the in-memory zone record index before an incremental refresh (0 disables the index)
+DNS_INDEX_TTL_SECONDS = float(os.getenv("DNS_INDEX_TTL_SECONDS", "60"))
+# Background DNS health probing of lab hostnames (seconds)
+DNS_PROBE_POSITIVE_TTL = float(os.getenv("DNS_PROBE_POSITIVE_TTL", "60"))
+DNS_PROBE_NEGATIVE_TTL = float(os.getenv("DNS_PROBE_NEGATIVE_TTL", "10"))
+DNS_PROBE_TIMEOUT = float(os.getenv("DNS_PROBE_TIMEOUT", "3"))
+DNS_PROBE_CONCURRENCY = int(os.getenv("DNS_PROBE_CONCURRENCY", "32"))
+DNS_PROBE_IDLE_SECONDS = float(os.getenv("DNS_PROBE_IDLE_SECONDS", "900"))
 
 # Cloud Run Configuration
 # Format: {region}-docker.pkg.dev/{project_id}/{repo_id}/attack-client:latest
 # Note: The attack client source is at https://github.com/alexbakimpv/amplify-attack-client
 # The actual deployed image should be in GCP Artifact Registry
 ATTACK_CLIENT_IMAGE = os.getenv("ATTACK_CLIENT_IMAGE", "")
+# "gcp" (Cloud Run Admin API) or "memory" (in-process services for local development and tests)
+CLOUD_RUN_BACKEND = os.getenv("CLOUD_RUN_BACKEND", "gcp")
+# Max age of the in-memory index of attack-client services before the next list sweep (0 disables it)
+CLOUD_RUN_INDEX_TTL_SECONDS = float(os.getenv("CLOUD_RUN_INDEX_TTL_SECONDS", "60"))
+
+# Provisioning worker pool (separate from the HTTP worker threads)
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "8"))
+# One provisioning job per lab across replicas: a job holds the lab's lease until it finishes,
+# or for at most PROVISIONING_LEASE_SECONDS if its process dies (Cloud Run creates wait up to 300s)
+PROVISIONING_LEASE_SECONDS = float(os.getenv("PROVISIONING_LEASE_SECONDS", "900"))
+# Per-stage rate limits (operations per second, 0 disables) and bulk pre-provisioning fan-out
+CLOUD_RUN_CREATE_RATE = float(os.getenv("CLOUD_RUN_CREATE_RATE", "2"))
+DNS_CHANGE_RATE = float(os.getenv("DNS_CHANGE_RATE", "5"))
+BULK_PROVISION_CONCURRENCY = int(os.getenv("BULK_PROVISION_CONCURRENCY", "16"))
+
+# Expired-lab reaper: every REAPER_INTERVAL_SECONDS (0 disables) each process reaps up to
+# REAPER_BUDGET labs that expired more than REAPER_GRACE_SECONDS ago, deleting at most
+# REAPER_CONCURRENCY Cloud Run services at a time. REAPER_DRY_RUN only reports what it would do.
+REAPER_INTERVAL_SECONDS = float(os.getenv("REAPER_INTERVAL_SECONDS", "300"))
+REAPER_BUDGET = int(os.getenv("REAPER_BUDGET", "50"))
+REAPER_CONCURRENCY = int(os.getenv("REAPER_CONCURRENCY", "4"))
+REAPER_GRACE_SECONDS = float(os.getenv("REAPER_GRACE_SECONDS", "600"))
+REAPER_LEASE_SECONDS = float(os.getenv("REAPER_LEASE_SECONDS", "900"))
+REAPER_DRY_RUN = os.getenv("REAPER_DRY_RUN", "false").lower() in ("1", "true", "yes")
+
+# Warm pool of pre-created attack-client services claimed on first login. The watermarks are the
+# defaults until set from the admin API (0 / 0 disables the pool); a refill runs every
+# WARM_POOL_REFILL_SECONDS and after each claim, WARM_POOL_CONCURRENCY creates at a time.
+WARM_POOL_LOW = int(os.getenv("WARM_POOL_LOW", "0"))
+WARM_POOL_HIGH = int(os.getenv("WARM_POOL_HIGH", "0"))
+WARM_POOL_MAX = int(os.getenv("WARM_POOL_MAX", "50"))
+WARM_POOL_REFILL_SECONDS = float(os.getenv("WARM_POOL_REFILL_SECONDS", "60"))
+WARM_POOL_CONCURRENCY = int(os.getenv("WARM_POOL_CONCURRENCY", "4"))
 
-# Email Configuration
-RESEND_API_KEY_ENV = os.getenv("RESEND_API_KEY", "")
-RESEND_API_KEY = (
-    RESEND_API_KEY_ENV 
-    or _load_secret_from_sm("resend-key", GCP_PROJECT)
-    or ""
-)
+# Prometheus metrics: /metrics requires "Authorization: Bearer <METRICS_TOKEN>" (the ingress
+# exposes every path) and is disabled without a token. Threadpool and component gauges are
+# sampled every METRICS_SAMPLE_SECONDS.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_SAMPLE_SECONDS = float(os.getenv("METRICS_SAMPLE_SECONDS", "5"))
 
 # CORS Configuration
 CORS_ORIGINS = os.getenv("CORS_ALLOW_ORIGINS", "http://localhost:5173,https://manager.lab.amplifys.us")
 CORS_ORIGINS_LIST = [o.strip() for o in CORS_ORIGINS.split(",") if o.strip()]
 
-# Print configuration status on import
-if JWT_SECRET != "dev-secret-change-me-in-production" and not JWT_SECRET_ENV:
-    print(f"✓ JWT_SECRET_KEY loaded from Secret Manager (project: {GCP_PROJECT})")
@@ -0,0 +1,201 @@
+"""Short-lived cache of user lookups and verified credentials for login.
+
+Two LRU + TTL maps:
+
+- users: email -> (user document id, data), so repeat logins skip
+  the Firestore query by email
+- verified: (email, HMAC(password)) -> password_hash that was verified, so
+  repeat logins skip bcrypt
+
+Passwords are never stored; the HMAC key is random per process. A verified
+entry only counts while the cached user still has the same password_hash.
+A Firestore listener on the users collection refreshes or drops cached users
+when their document changes on any replica; the TTL bounds staleness if the
+listener drops.
+"""
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from app.clients import get_firestore_client, get_async_firestore_client
+from app.config import (
+    USERS_COLLECTION, CREDENTIAL_CACHE_TTL_SECONDS, CREDENTIAL_CACHE_MAX_ENTRIES, FIRESTORE_TIMEOUT_SECONDS
+)
+
+_MISSING = object()
+
+class CredentialCache:
+    def __init__(self, ttl: float = CREDENTIAL_CACHE_TTL_SECONDS, max_entries: int = CREDENTIAL_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = secrets.token_bytes(32)
+        # email -> (expires_at, doc_id, data or None for "no such user")
+        self._users: "OrderedDict[str, Tuple[float, Optional[str], Optional[Dict]]]" = OrderedDict()
+        # (email, password digest) -> (expires_at, verified password_hash)
+        self._verified: "OrderedDict[Tuple[str, bytes], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._watch = None
+        self._stats = {"user_hits": 0, "user_misses": 0, "verify_hits": 0, "verify_misses": 0,
+                       "evictions": 0, "expirations": 0, "invalidations": 0, "listener_updates": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _digest(self, password: str) -> bytes:
+        return hmac.new(self._key, password.encode(), hashlib.sha256).digest()
+
+    def _get(self, entries: OrderedDict, key, stat: str):
+        entry = entries.get(key)
+        if entry is None:
+            self._stats[f"{stat}_misses"] += 1
+            return _MISSING
+        if entry[0] < time.monotonic():
+            del entries[key]
+            self._stats["expirations"] += 1
+            self._stats[f"{stat}_misses"] += 1
+            return _MISSING
+        entries.move_to_end(key)
+        self._stats[f"{stat}_hits"] += 1
+        return entry[1:]
+
+    def _put(self, entries: OrderedDict, key, value: Tuple) -> None:
+        entries[key] = (time.monotonic() + self.ttl, *value)
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    # User document lookup
+
+    def _cached_user(self, email: str):
+        if not self.enabled:
+            return _MISSING
+        with self._lock:
+            return self._get(self._users, email, "user")
+
+    def _remember_user(self, email: str, doc_id: Optional[str], data: Optional[Dict]) -> Tuple[Optional[str], Optional[Dict]]:
+        if self.enabled:
+            with self._lock:
+                self._put(self._users, email, (doc_id, data))
+        return doc_id, dict(data) if data is not None else None
+
+    def get_user(self, email: str) -> Tuple[Optional[str], Optional[Dict]]:
+        """Return (doc_id, data) for a user by email; data is None if there is no such user."""
+        cached = self._cached_user(email)
+        if cached is not _MISSING:
+            doc_id, data = cached
+            return doc_id, dict(data) if data is not None else None
+        users = get_firestore_client().collection(USERS_COLLECTION).where("email", "==", email).limit(1).stream()
+        for doc in users:
+            return self._remember_user(email, doc.id, doc.to_dict())
+        return self._remember_user(email, None, None)
+
+    async def aget_user(self, email: str) -> Tuple[Optional[str], Optional[Dict]]:
+        """get_user() for request handlers: misses are read with the asyncio client."""
+        cached = self._cached_user(email)
+        if cached is not _MISSING:
+            doc_id, data = cached
+            return doc_id, dict(data) if data is not None else None
+        query = get_async_firestore_client().collection(USERS_COLLECTION).where("email", "==", email).limit(1)
+        async for doc in query.stream(timeout=FIRESTORE_TIMEOUT_SECONDS):
+            return self._remember_user(email, doc.id, doc.to_dict())
+        return self._remember_user(email, None, None)
+
+    # Verified credentials
+
+    def is_verified(self, email: str, password: str, password_hash: str) -> bool:
+        """True if this password was verified against this exact hash recently."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            cached = self._get(self._verified, (email, self._digest(password)), "verify")
+        return cached is not _MISSING and hmac.compare_digest(cached[0], password_hash)
+
+    def remember_verified(self, email: str, password: str, password_hash: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._put(self._verified, (email, self._digest(password)), (password_hash,))
+
+    # Invalidation
+
+    def invalidate(self, email: str) -> None:
+        """Drop everything cached for a user (call after writing the user document)."""
+        with self._lock:
+            self._drop(email)
+
+    def _drop(self, email: str) -> None:
+        dropped = self._users.pop(email, None) is not None
+        for key in [k for k in self._verified if k[0] == email]:
+            del self._verified[key]
+            dropped = True
+        if dropped:
+            self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+            self._verified.clear()
+
+    def _on_snapshot(self, _docs, changes, _read_time) -> None:
+        for change in changes:
+            data = change.document.to_dict() or {}
+            email = data.get("email")
+            if not email:
+                continue
+            with self._lock:
+                entry = self._users.get(email)
+                if change.type.name == "REMOVED":
+                    self._drop(email)
+                elif entry is None:
+                    continue
+                elif entry[2] is None or (entry[2].get("password_hash"), entry[2].get("is_active", True)) != \
+                        (data.get("password_hash"), data.get("is_active", True)):
+                    # Credentials or activation changed: forget verified passwords too.
+                    self._drop(email)
+                else:
+                    self._users[email] = (time.monotonic() + self.ttl, change.document.id, data)
+                    self._stats["listener_updates"] += 1
+
+    def start_listener(self) -> None:
+        """Watch the users collection so changes on any replica reach this cache."""
+        if not self.enabled or self._watch is not None:
+            return
+        try:
+            self._watch = get_firestore_client().collection(USERS_COLLECTION).on_snapshot(self._on_snapshot)
+        except Exception as e:
+            print(f"WARNING: Failed to start credential cache listener (TTL-only invalidation): {e}")
+
+    def stop_listener(self) -> None:
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception as e:
+                print(f"WARNING: Failed to stop credential cache listener: {e}")
+            self._watch = None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["users"] = len(self._users)
+            stats["verified"] = len(self._verified)
+        for kind in ("user", "verify"):
+            total = stats[f"{kind}_hits"] + stats[f"{kind}_misses"]
+            stats[f"{kind}_hit_rate"] = round(stats[f"{kind}_hits"] / total, 4) if total else 0.0
+        stats["listener_active"] = bool(self._watch is not None and getattr(self._watch, "is_active", True))
+        return stats
+
+_cache: Optional[CredentialCache] = None
+_cache_lock = threading.Lock()
+
+def get_credential_cache() -> CredentialCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CredentialCache()
+    return _cache
@@ -0,0 +1,447 @@
+"""Batched Cloud DNS record-set changes.
+
+Callers submit upsert/delete operations; a background flusher merges
+everything that arrives within a short window into one ``zone.changes()``
+submission. Bulk callers can skip the window with ``apply()``. Existing
+record sets are resolved from a process-local ``ZoneIndex`` rather than
+per-call API listings.
+"""
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Dict, List, Optional, Tuple
+from app.config import (
+    DNS_ZONE_NAME, DNS_BACKEND, DNS_BATCH_WINDOW_MS, DNS_BATCH_MAX, DNS_INDEX_TTL_SECONDS
+)
+from app.metrics import timed
+
+# Record dicts: {"name": "x.lab.example.", "type": "CNAME", "ttl": 300, "rrdatas": ["t."]}
+# Change dicts: a record dict plus "action": "upsert" | "delete".
+
+class GcpZoneBackend:
+    """Cloud DNS managed zone accessed through google-cloud-dns."""
+
+    def __init__(self, zone_name: str = DNS_ZONE_NAME):
+        from app.clients import get_dns_client
+        self._zone = get_dns_client().zone(zone_name)
+
+    def _iterate(self, resource: str, items_key: str, item_to_value, extra_params: Optional[Dict] = None):
+        from google.api_core import page_iterator
+
+        zone = self._zone
+        client = zone._client
+        return page_iterator.HTTPIterator(
+            client=client,
+            api_request=client._connection.api_request,
+            path=f"/projects/{zone.project}/managedZones/{zone.name}/{resource}",
+            item_to_value=item_to_value,
+            items_key=items_key,
+            extra_params=extra_params,
+        )
+
+    @staticmethod
+    def _to_record(resource: Dict) -> Dict:
+        return {"name": resource["name"], "type": resource["type"], "ttl": resource.get("ttl"),
+                "rrdatas": list(resource.get("rrdatas", []))}
+
+    def list_all(self) -> List[Dict]:
+        with timed("cloud_dns", "list_rrsets"):
+            return list(self._iterate("rrsets", "rrsets", lambda _it, res: self._to_record(res)))
+
+    def latest_change_id(self) -> Optional[str]:
+        changes = self._iterate("changes", "changes", lambda _it, res: res,
+                                {"sortBy": "changeSequence", "sortOrder": "descending", "maxResults": 1})
+        with timed("cloud_dns", "list_changes"):
+            for change in changes:
+                return change["id"]
+        return None
+
+    def changes_since(self, change_id: str, limit: int = 1000) -> Optional[List[Dict]]:
+        """Return completed changes newer than change_id (oldest first), or None
+        if more than ``limit`` happened and a full reload is cheaper."""
+        newer: List[Dict] = []
+        changes = self._iterate("changes", "changes", lambda _it, res: res,
+                                {"sortBy": "changeSequence", "sortOrder": "descending"})
+        with timed("cloud_dns", "list_changes"):
+            for change in changes:
+                if int(change["id"]) <= int(change_id):
+                    break
+                if len(newer) >= limit:
+                    return None
+                newer.append({
+                    "id": change["id"],
+                    "additions": [self._to_record(r) for r in change.get("additions", [])],
+                    "deletions": [self._to_record(r) for r in change.get("deletions", [])],
+                })
+        newer.reverse()
+        return newer
+
+    def get(self, name: str, record_type: str) -> Optional[Dict]:
+        """Look up one record set by name/type using the API's list filter."""
+        from google.api_core import page_iterator
+        from google.cloud.dns.resource_record_set import ResourceRecordSet
+
+        zone = self._zone
+        client = zone._client
+        iterator = page_iterator.HTTPIterator(
+            client=client,
+            api_request=client._connection.api_request,
+            path=f"/projects/{zone.project}/managedZones/{zone.name}/rrsets",
+            item_to_value=lambda _it, resource: ResourceRecordSet.from_api_repr(resource, zone),
+            items_key="rrsets",
+            extra_params={"name": name, "type": record_type},
+        )
+        with timed("cloud_dns", "list_rrsets"):
+            for record in iterator:
+                if record.name == name and record.record_type == record_type:
+                    return {"name": record.name, "type": record.record_type, "ttl": record.ttl,
+                            "rrdatas": list(record.rrdatas)}
+        return None
+
+    def apply(self, additions: List[Dict], deletions: List[Dict]) -> Optional[str]:
+        changes = self._zone.changes()
+        for record in deletions:
+            changes.delete_record_set(self._zone.resource_record_set(
+                record["name"], record["type"], record["ttl"], record["rrdatas"]))
+        for record in additions:
+            changes.add_record_set(self._zone.resource_record_set(
+                record["name"], record["type"], record["ttl"], record["rrdatas"]))
+        with timed("cloud_dns", "create_change"):
+            changes.create()
+        return changes.name
+
+class MemoryZoneBackend:
+    """In-process zone for local development and tests."""
+
+    def __init__(self):
+        self.records: Dict[Tuple[str, str], Dict] = {}
+        self.change_log: List[Dict] = []
+        self.change_calls = 0
+        self.list_calls = 0
+        self._lock = threading.Lock()
+
+    def list_all(self) -> List[Dict]:
+        with self._lock:
+            self.list_calls += 1
+            return [dict(record) for record in self.records.values()]
+
+    def latest_change_id(self) -> Optional[str]:
+        with self._lock:
+            return self.change_log[-1]["id"] if self.change_log else None
+
+    def changes_since(self, change_id: str, limit: int = 1000) -> Optional[List[Dict]]:
+        with self._lock:
+            newer = [change for change in self.change_log if int(change["id"]) > int(change_id)]
+        return None if len(newer) > limit else newer
+
+    def get(self, name: str, record_type: str) -> Optional[Dict]:
+        with self._lock:
+            record = self.records.get((name, record_type))
+            return dict(record) if record else None
+
+    def apply(self, additions: List[Dict], deletions: List[Dict]) -> Optional[str]:
+        with self._lock:
+            for record in deletions:
+                key = (record["name"], record["type"])
+                if self.records.get(key, {}).get("rrdatas") != record["rrdatas"]:
+                    raise ValueError(f"Record {key} does not match deletion")
+            deleted = {(record["name"], record["type"]) for record in deletions}
+            for record in additions:
+                key = (record["name"], record["type"])
+                if key in self.records and key not in deleted:
+                    raise ValueError(f"Record {key} already exists")
+            for record in deletions:
+                self.records.pop((record["name"], record["type"]), None)
+            for record in additions:
+                self.records[(record["name"], record["type"])] = dict(record)
+            self.change_calls += 1
+            change_id = str(len(self.change_log) + 1)
+            self.change_log.append({"id": change_id, "additions": [dict(r) for r in additions],
+                                    "deletions": [dict(r) for r in deletions]})
+            return change_id
+
+def _complete(future: Future, outcome: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+    """Resolve a change's future, unless its waiter gave up and cancelled it (the change is applied anyway)."""
+    try:
+        if future.running() or future.set_running_or_notify_cancel():
+            if error is None:
+                future.set_result(outcome)
+            else:
+                future.set_exception(error)
+    except (RuntimeError, InvalidStateError):
+        # Already resolved
+        pass
+
+def _key(change: Dict) -> Tuple[str, str]:
+    return change["name"], change["type"]
+
+class ZoneIndex:
+    """Process-local map of a zone's record sets keyed by (name, type).
+
+    Loaded once with a full listing, then kept fresh by replaying the zone's
+    change log at most every ``ttl`` seconds, and updated in place after our
+    own successful changes. A ttl of 0 disables the index and every lookup
+    goes to the backend.
+    """
+
+    def __init__(self, backend, ttl: float = DNS_INDEX_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self._records: Dict[Tuple[str, str], Dict] = {}
+        self._change_id: Optional[str] = None
+        self._loaded = False
+        self._refreshed_at = 0.0
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "full_loads": 0, "incremental_refreshes": 0}
+
+    def get(self, name: str, record_type: str) -> Optional[Dict]:
+        if self.ttl <= 0:
+            return self.backend.get(name, record_type)
+        self._ensure_fresh()
+        with self._lock:
+            record = self._records.get((name, record_type))
+            self._stats["hits" if record else "misses"] += 1
+            return dict(record) if record else None
+
+    def invalidate(self) -> None:
+        """Force a refresh on the next lookup (e.g. after a rejected change)."""
+        with self._lock:
+            self._refreshed_at = 0.0
+
+    def _ensure_fresh(self) -> None:
+        if self._loaded and time.monotonic() - self._refreshed_at < self.ttl:
+            return
+        with self._lock:
+            if self._loaded and time.monotonic() - self._refreshed_at < self.ttl:
+                return
+            changes = None
+            if self._loaded and self._change_id is not None:
+                try:
+                    changes = self.backend.changes_since(self._change_id)
+                except Exception as e:
+                    print(f"WARNING: Incremental DNS zone refresh failed, reloading: {e}")
+            if changes is None:
+                self._load()
+            else:
+                for change in changes:
+                    self._apply_locked(change["additions"], change["deletions"], change["id"])
+                self._stats["incremental_refreshes"] += 1
+            self._refreshed_at = time.monotonic()
+
+    def _load(self) -> None:
+        # Read the change id first so nothing applied during the listing is skipped.
+        change_id = self.backend.latest_change_id()
+        records = self.backend.list_all()
+        self._records = {(r["name"], r["type"]): r for r in records}
+        self._change_id = change_id or "0"
+        self._loaded = True
+        self._stats["full_loads"] += 1
+
+    def apply(self, additions: List[Dict], deletions: List[Dict]) -> None:
+        """Record a change we just submitted successfully.
+
+        The change id is not advanced: changes made by others in between are
+        picked up (and ours replayed idempotently) on the next refresh.
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._apply_locked(additions, deletions, None)
+
+    def _apply_locked(self, additions: List[Dict], deletions: List[Dict], change_id: Optional[str]) -> None:
+        for record in deletions:
+            self._records.pop(_key(record), None)
+        for record in additions:
+            self._records[_key(record)] = dict(record)
+        if change_id is not None:
+            self._change_id = change_id
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "records": len(self._records), "change_id": self._change_id}
+
+class DnsChangeBatcher:
+    """Collects DNS operations and submits them as merged change sets."""
+
+    def __init__(self, backend, window_seconds: float = DNS_BATCH_WINDOW_MS / 1000.0,
+                 max_batch: int = DNS_BATCH_MAX, index: Optional[ZoneIndex] = None):
+        self.backend = backend
+        self.index = index or ZoneIndex(backend)
+        self.window = window_seconds
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Dict, Future]] = []
+        self._cond = threading.Condition()
+        # One flush at a time: the batcher thread and apply() callers (the reaper) share the index
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {
+            "operations": 0,
+            "batches": 0,
+            "changes_submitted": 0,
+            "noops": 0,
+            "errors": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "flush_ms_total": 0.0,
+            "flush_ms_max": 0.0,
+        }
+
+    # Submission
+
+    def submit(self, change: Dict) -> Future:
+        """Queue one change for the next flush; the future resolves to its outcome."""
+        future: Future = Future()
+        with self._cond:
+            self._pending.append((change, future))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="dns-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def upsert(self, name: str, record_type: str, rrdatas: List[str], ttl: int = 300) -> Future:
+        return self.submit({"action": "upsert", "name": name, "type": record_type, "ttl": ttl, "rrdatas": rrdatas})
+
+    def delete(self, name: str, record_type: str) -> Future:
+        return self.submit({"action": "delete", "name": name, "type": record_type})
+
+    def apply(self, changes: List[Dict]) -> List[str]:
+        """Submit changes immediately (no window), in chunks of max_batch."""
+        outcomes: List[str] = []
+        for start in range(0, len(changes), self.max_batch):
+            batch = [(change, Future()) for change in changes[start:start + self.max_batch]]
+            self._flush(batch)
+            for _change, future in batch:
+                try:
+                    outcomes.append(future.result())
+                except Exception as e:
+                    outcomes.append(f"error: {e}")
+        return outcomes
+
+    # Flushing
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # Keep the thread alive for later changes; nobody else will resolve these
+                print(f"ERROR: DNS batch flush failed: {e}")
+                for _change, future in batch:
+                    _complete(future, error=e)
+
+    def _plan(self, batch: List[Tuple[Dict, Future]]):
+        """Merge a batch (last operation per name/type wins) into additions/deletions."""
+        latest: Dict[Tuple[str, str], Dict] = {}
+        for change, _future in batch:
+            latest[_key(change)] = change
+
+        additions: List[Dict] = []
+        deletions: List[Dict] = []
+        outcomes: Dict[Tuple[str, str], str] = {}
+        for key, change in latest.items():
+            existing = self.index.get(*key)
+            if change["action"] == "delete":
+                if existing:
+                    deletions.append(existing)
+                    outcomes[key] = "deleted"
+                else:
+                    outcomes[key] = "noop"
+                continue
+            record = {"name": change["name"], "type": change["type"],
+                      "ttl": change.get("ttl", 300), "rrdatas": list(change["rrdatas"])}
+            if existing and existing["rrdatas"] == record["rrdatas"]:
+                outcomes[key] = "noop"
+                continue
+            if existing:
+                deletions.append(existing)
+                outcomes[key] = "updated"
+            else:
+                outcomes[key] = "created"
+            additions.append(record)
+        return additions, deletions, outcomes
+
+    def _flush(self, batch: List[Tuple[Dict, Future]], retried: bool = False) -> None:
+        if not batch:
+            return
+        started = time.monotonic()
+        try:
+            with self._flush_lock:
+                additions, deletions, outcomes = self._plan(batch)
+                if additions or deletions:
+                    self.backend.apply(additions, deletions)
+                    self.index.apply(additions, deletions)
+        except Exception as e:
+            # The index may be stale (someone else changed the zone); resync before retrying.
+            self.index.invalidate()
+            if len(batch) > 1:
+                # One bad record must not fail the whole batch: retry individually.
+                print(f"WARNING: DNS batch of {len(batch)} failed ({e}); retrying individually")
+                for item in batch:
+                    self._flush([item])
+                return
+            if not retried:
+                # Typically a conflict with a change made elsewhere (412): plan again on the resynced index
+                self._flush(batch, retried=True)
+                return
+            self._record(1, 0, started, error=True)
+            _complete(batch[0][1], error=e)
+            return
+
+        submitted = 1 if (additions or deletions) else 0
+        self._record(len(batch), submitted, started,
+                     noops=sum(1 for outcome in outcomes.values() if outcome == "noop"))
+        for change, future in batch:
+            _complete(future, outcomes[_key(change)])
+
+    def _record(self, size: int, submitted: int, started: float, noops: int = 0, error: bool = False) -> None:
+        elapsed_ms = (time.monotonic() - started) * 1000.0
+        with self._cond:
+            stats = self._stats
+            stats["operations"] += size
+            stats["batches"] += 1
+            stats["changes_submitted"] += submitted
+            stats["noops"] += noops
+            stats["errors"] += 1 if error else 0
+            stats["last_batch_size"] = size
+            stats["max_batch_size"] = max(stats["max_batch_size"], size)
+            stats["flush_ms_total"] += elapsed_ms
+            stats["flush_ms_max"] = max(stats["flush_ms_max"], elapsed_ms)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        batches = stats["batches"] or 1
+        stats["avg_batch_size"] = stats["operations"] / batches
+        stats["avg_flush_ms"] = stats["flush_ms_total"] / batches
+        return stats
+
+_batcher: Optional[DnsChangeBatcher] = None
+_batcher_lock = threading.Lock()
+
+def get_dns_batcher() -> DnsChangeBatcher:
+    """Return the process-wide batcher for DNS_ZONE_NAME."""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                backend = MemoryZoneBackend() if DNS_BACKEND == "memory" else GcpZoneBackend()
+                _batcher = DnsChangeBatcher(backend)
+    return _batcher
+
+def set_dns_batcher(batcher: Optional[DnsChangeBatcher]) -> None:
+    """Replace the process-wide batcher (e.g. with a MemoryZoneBackend in tests)."""
+    global _batcher
+    _batcher = batcher
@@ -0,0 +1,157 @@
+"""Background DNS health prober for lab hostnames.
+
+Request handlers only read cached results; resolution happens on the event
+loop in a background task. Hostnames are watched on first lookup and
+dropped once nobody has asked about them for DNS_PROBE_IDLE_SECONDS. A
+hostname reports None (unknown) until its first probe, so callers can tell
+"not checked yet" from "does not resolve".
+"""
+import asyncio
+import socket
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from app.config import (
+    DNS_PROBE_POSITIVE_TTL, DNS_PROBE_NEGATIVE_TTL, DNS_PROBE_TIMEOUT,
+    DNS_PROBE_CONCURRENCY, DNS_PROBE_IDLE_SECONDS
+)
+from app.metrics import timed
+
+Resolver = Callable[[str], Awaitable[bool]]
+
+async def resolve_with_getaddrinfo(hostname: str) -> bool:
+    """Default resolver: the loop's getaddrinfo, bounded by DNS_PROBE_TIMEOUT."""
+    loop = asyncio.get_running_loop()
+    try:
+        with timed("dns_resolve", "getaddrinfo"):
+            await asyncio.wait_for(loop.getaddrinfo(hostname, None, type=socket.SOCK_STREAM), DNS_PROBE_TIMEOUT)
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+class DnsHealthProber:
+    """Resolves watched hostnames on a schedule with positive/negative TTLs."""
+
+    def __init__(self, resolver: Resolver = resolve_with_getaddrinfo,
+                 positive_ttl: float = DNS_PROBE_POSITIVE_TTL,
+                 negative_ttl: float = DNS_PROBE_NEGATIVE_TTL,
+                 concurrency: int = DNS_PROBE_CONCURRENCY,
+                 idle_seconds: float = DNS_PROBE_IDLE_SECONDS):
+        self.resolver = resolver
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.concurrency = concurrency
+        self.idle_seconds = idle_seconds
+        # hostname -> {"ok": Optional[bool], "checked_at", "next_check", "last_seen"}
+        self._hosts: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def resolves(self, hostname: Optional[str]) -> Optional[bool]:
+        """Return the cached result, watching the hostname if it is new.
+
+        Returns None (unknown) until the hostname's first probe completes.
+        """
+        if not hostname:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            entry = self._hosts.get(hostname)
+            if entry is None:
+                entry = {"ok": None, "checked_at": None, "next_check": now, "last_seen": now}
+                self._hosts[hostname] = entry
+                new = True
+            else:
+                entry["last_seen"] = now
+                new = False
+        if new:
+            self._wake()
+        return entry["ok"]
+
+    def snapshot(self) -> Dict[str, Optional[bool]]:
+        with self._lock:
+            return {hostname: entry["ok"] for hostname, entry in self._hosts.items()}
+
+    def _wake(self) -> None:
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def probe_due(self) -> int:
+        """Probe every hostname whose TTL has lapsed; returns how many were probed."""
+        now = time.monotonic()
+        with self._lock:
+            for hostname in [h for h, e in self._hosts.items() if now - e["last_seen"] > self.idle_seconds]:
+                del self._hosts[hostname]
+            due = [h for h, e in self._hosts.items() if e["next_check"] <= now]
+        if not due:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def probe(hostname: str) -> None:
+            async with semaphore:
+                try:
+                    ok = await self.resolver(hostname)
+                except Exception:
+                    ok = False
+            checked_at = time.monotonic()
+            with self._lock:
+                entry = self._hosts.get(hostname)
+                if entry is not None:
+                    entry["ok"] = ok
+                    entry["checked_at"] = checked_at
+                    entry["next_check"] = checked_at + (self.positive_ttl if ok else self.negative_ttl)
+
+        await asyncio.gather(*(probe(hostname) for hostname in due))
+        return len(due)
+
+    def _seconds_until_next(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            if not self._hosts:
+                return self.positive_ttl
+            return max(0.0, min(e["next_check"] for e in self._hosts.values()) - now)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.probe_due()
+            except Exception as e:
+                print(f"WARNING: DNS probe cycle failed: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.5, self._seconds_until_next()))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        """Start probing on the running event loop."""
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+_prober: Optional[DnsHealthProber] = None
+
+def get_dns_prober() -> DnsHealthProber:
+    global _prober
+    if _prober is None:
+        _prober = DnsHealthProber()
+    return _prober
+
+def set_dns_prober(prober: Optional[DnsHealthProber]) -> None:
+    """Replace the process-wide prober (e.g. with an injected resolver in tests)."""
+    global _prober
+    _prober = prober
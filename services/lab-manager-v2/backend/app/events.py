@@ -0,0 +1,168 @@
+"""Per-replica fan-out hub for lab status Server-Sent Events.
+
+Each lab with at least one connected viewer gets exactly one upstream
+Firestore document listener, shared by every viewer on this replica. Status
+payloads are rendered by the labs router and only pushed when they change.
+"""
+import asyncio
+import itertools
+import json
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, Optional, Set, Tuple
+from app.auth import get_db
+from app.config import LABS_COLLECTION, SSE_HEARTBEAT_SECONDS, SSE_REPLAY_EVENTS
+from app.lab_cache import get_lab_cache
+
+Renderer = Callable[[str, Optional[Dict]], Dict]
+
+_event_ids = itertools.count(1)
+
+def format_sse(event_id: int, event: str, payload: Dict) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+class _Topic:
+    def __init__(self):
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.watch = None
+        self.data: Optional[Dict] = None
+        self.loaded = False
+        self.payload: Optional[Dict] = None
+        self.events: Deque[Tuple[int, Dict]] = deque(maxlen=SSE_REPLAY_EVENTS)
+
+class LabEventHub:
+    def __init__(self, renderer: Optional[Renderer] = None):
+        self.renderer = renderer
+        self._topics: Dict[str, _Topic] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def set_renderer(self, renderer: Renderer) -> None:
+        self.renderer = renderer
+
+    # Upstream (called from Firestore listener / worker threads)
+
+    def notify(self, lab_id: str, data: Optional[Dict] = None, loaded: bool = False) -> None:
+        """Thread-safe: push fresh lab data (or just re-render) for a lab with viewers."""
+        if self._loop is None or lab_id not in self._topics:
+            return
+        self._loop.call_soon_threadsafe(self._apply, lab_id, data, loaded)
+
+    def refresh(self, lab_id: str) -> None:
+        """Thread-safe: re-read a lab document and push it to its viewers, if any.
+
+        Called by the provisioning pipeline after it writes, so viewers do not
+        depend solely on listener latency.
+        """
+        if self._loop is None or lab_id not in self._topics:
+            return
+        asyncio.run_coroutine_threadsafe(self._refetch(lab_id), self._loop)
+
+    async def _refetch(self, lab_id: str) -> None:
+        try:
+            data = await get_lab_cache().aget(lab_id)
+        except Exception as e:
+            print(f"WARNING: Failed to refresh lab {lab_id} for event stream: {e}")
+            return
+        self._apply(lab_id, data, loaded=True)
+
+    def _listen(self, lab_id: str):
+        def on_snapshot(docs, _changes, _read_time):
+            snap = docs[0] if docs else None
+            data = snap.to_dict() if snap is not None and snap.exists else None
+            self.notify(lab_id, data, loaded=True)
+        return get_db().collection(LABS_COLLECTION).document(lab_id).on_snapshot(on_snapshot)
+
+    # Event-loop side
+
+    def _apply(self, lab_id: str, data: Optional[Dict], loaded: bool) -> None:
+        topic = self._topics.get(lab_id)
+        if topic is None:
+            return
+        if loaded:
+            topic.data = data
+            topic.loaded = True
+        if not topic.loaded:
+            return
+        payload = self.renderer(lab_id, topic.data)
+        if payload == topic.payload:
+            return
+        topic.payload = payload
+        event_id = next(_event_ids)
+        topic.events.append((event_id, payload))
+        for queue in topic.subscribers:
+            if queue.full():
+                # Slow consumer: drop its oldest pending event rather than block the hub.
+                queue.get_nowait()
+            queue.put_nowait((event_id, payload))
+
+    def _subscribe(self, lab_id: str, queue: asyncio.Queue) -> _Topic:
+        self._loop = asyncio.get_running_loop()
+        topic = self._topics.get(lab_id)
+        if topic is None:
+            topic = _Topic()
+            self._topics[lab_id] = topic
+            try:
+                topic.watch = self._listen(lab_id)
+            except Exception as e:
+                print(f"WARNING: Failed to start lab listener for {lab_id}: {e}")
+        topic.subscribers.add(queue)
+        return topic
+
+    def _unsubscribe(self, lab_id: str, queue: asyncio.Queue) -> None:
+        topic = self._topics.get(lab_id)
+        if topic is None:
+            return
+        topic.subscribers.discard(queue)
+        if not topic.subscribers:
+            del self._topics[lab_id]
+            if topic.watch is not None:
+                try:
+                    topic.watch.unsubscribe()
+                except Exception as e:
+                    print(f"WARNING: Failed to stop lab listener for {lab_id}: {e}")
+
+    async def stream(self, lab_id: str, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """Yield SSE frames for one viewer until the client disconnects."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_REPLAY_EVENTS)
+        topic = self._subscribe(lab_id, queue)
+        try:
+            if topic.watch is None and not topic.loaded:
+                await self._refetch(lab_id)
+            yield f"retry: {int(SSE_HEARTBEAT_SECONDS * 1000)}\n\n"
+            # Event ids are per process: a Last-Event-ID this topic did not issue (expired, or
+            # from another worker or replica) says nothing about what the client has seen.
+            if last_event_id is not None and any(i == last_event_id for i, _ in topic.events):
+                sent_id = last_event_id
+                replay = [(i, p) for i, p in topic.events if i > last_event_id]
+            else:
+                # Start from the current state, or from the first event once the lab loads.
+                sent_id = 0
+                replay = list(topic.events)[-1:]
+            for event_id, payload in replay:
+                yield format_sse(event_id, "status", payload)
+                sent_id = event_id
+            while True:
+                try:
+                    event_id, payload = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Re-render so DNS readiness and expiry transitions are pushed too.
+                    self._apply(lab_id, None, loaded=False)
+                    if queue.empty():
+                        yield ": heartbeat\n\n"
+                    continue
+                if event_id > sent_id:
+                    yield format_sse(event_id, "status", payload)
+                    sent_id = event_id
+        finally:
+            self._unsubscribe(lab_id, queue)
+
+    def stats(self) -> Dict:
+        return {
+            "topics": len(self._topics),
+            "subscribers": sum(len(t.subscribers) for t in self._topics.values()),
+            "listeners": sum(1 for t in self._topics.values() if t.watch is not None),
+        }
+
+_hub = LabEventHub()
+
+def get_event_hub() -> LabEventHub:
+    return _hub
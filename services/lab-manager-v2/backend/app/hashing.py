@@ -0,0 +1,114 @@
+"""Password hashing service backed by a dedicated process pool.
+
+bcrypt is CPU-bound (~250 ms per call at cost 12), so it runs in worker
+processes instead of the request thread pool. In-flight hashing work is
+capped; callers that cannot get a slot within BCRYPT_ACQUIRE_TIMEOUT get a
+429 rather than queueing without bound.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Optional
+from fastapi import HTTPException
+from app import bcrypt_worker
+from app.config import BCRYPT_ROUNDS, BCRYPT_WORKERS, BCRYPT_MAX_PENDING, BCRYPT_ACQUIRE_TIMEOUT
+
+def _cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+WORKERS = BCRYPT_WORKERS or _cpu_count()
+MAX_PENDING = BCRYPT_MAX_PENDING or WORKERS * 8
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # spawn, not fork: the parent holds gRPC channels and threads.
+                _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+                _pool_pid = os.getpid()
+    return _pool
+
+def _submit(fn: Callable, *args) -> Future:
+    if not _slots.acquire(timeout=BCRYPT_ACQUIRE_TIMEOUT):
+        raise HTTPException(
+            status_code=429,
+            detail="Too many concurrent sign-ins, please retry",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        future = _get_pool().submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _f: _slots.release())
+    return future
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    """Hash a password with the configured bcrypt cost."""
+    return _submit(bcrypt_worker.hashpw, password.encode(), rounds).result()
+
+def verify_password(password: str, hashed: str) -> bool:
+    """Verify a password against a bcrypt hash."""
+    return _submit(bcrypt_worker.checkpw, password.encode(), hashed.encode()).result()
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    """verify_password for async callers (does not block the event loop)."""
+    future = await asyncio.to_thread(_submit, bcrypt_worker.checkpw, password.encode(), hashed.encode())
+    return await asyncio.wrap_future(future)
+
+def hash_cost(hashed: str) -> Optional[int]:
+    """Return the cost factor encoded in a "$2b$12$..." hash."""
+    parts = hashed.split("$")
+    try:
+        return int(parts[2])
+    except (IndexError, ValueError):
+        return None
+
+def needs_rehash(hashed: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    return hash_cost(hashed) != rounds
+
+def rehash_in_background(password: str, on_done: Callable[[str], None], rounds: int = BCRYPT_ROUNDS) -> None:
+    """Compute a hash at the current cost and hand it to on_done, off the request path.
+
+    Skipped silently when the pool is saturated; the next login retries.
+    """
+    if not _slots.acquire(blocking=False):
+        return
+    try:
+        future = _get_pool().submit(bcrypt_worker.hashpw, password.encode(), rounds)
+    except Exception as e:
+        _slots.release()
+        print(f"WARNING: Failed to schedule password rehash: {e}")
+        return
+
+    def done(f: Future) -> None:
+        _slots.release()
+        try:
+            on_done(f.result())
+        except Exception as e:
+            print(f"WARNING: Password rehash failed: {e}")
+
+    future.add_done_callback(done)
+
+def warm_up() -> None:
+    """Start the worker processes ahead of the first login."""
+    pool = _get_pool()
+    for future in [pool.submit(bcrypt_worker.ping) for _ in range(WORKERS)]:
+        future.result()
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
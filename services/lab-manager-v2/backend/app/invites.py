@@ -0,0 +1,295 @@
+"""Bulk participant invites as a background job.
+
+start_bulk_invite() records a job and returns at once; the pipeline then
+
+1. drops invalid and repeated emails, and emails whose existing invite was
+   already sent (Firestore "in" queries, 30 emails each)
+2. writes each batch of INVITE_BATCH_SIZE invite documents together with
+   their app.outbox messages in one Firestore WriteBatch, the messages
+   claimed by the job, so no invite is recorded without its queued email
+3. sends the batch in one provider call, at most INVITE_EMAIL_CONCURRENCY
+   batches in flight, through app.mail (per-provider rate limit, retries
+   with jitter); a batch the provider rejects outright is retried one
+   message at a time so one bad address does not fail the rest
+4. records the outcomes in a second WriteBatch: sent messages are marked
+   sent, retryable failures are released to the outbox worker ("queued"),
+   and a message whose batch never got that far is picked up by the worker
+   once the job's claim expires
+
+Progress events are kept in memory for the NDJSON stream on the replica
+running the job; the job document in INVITE_JOBS_COLLECTION carries the
+counts for status polling from any replica.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+from google.cloud import firestore
+from app import mail
+from app.audit import log_audit_event
+from app.auth import get_db
+from app.config import (
+    INVITES_COLLECTION, INVITE_JOBS_COLLECTION, INVITE_BATCH_SIZE, INVITE_EMAIL_CONCURRENCY, MAIL_OUTBOX_COLLECTION,
+    MAIL_OUTBOX_LEASE_SECONDS
+)
+from app.jobs import JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, TERMINAL_STATES
+from app.outbox import MAIL_FAILED, MAIL_PENDING, MAIL_SENDING, MAIL_SENT, get_mail_outbox, outbox_message, retry_at
+from app.services import invite_email_message, now_utc
+
+# Firestore "in" filters accept at most 30 values
+IN_QUERY_MAX = 30
+STREAM_HEARTBEAT_SECONDS = 15
+# Finished jobs whose progress events stay streamable on this replica
+RECENT_JOBS_MAX = 50
+
+class _InviteJob:
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.events: List[Dict] = []
+        self.finished = False
+        self._cond = threading.Condition()
+
+    def emit(self, event: Dict) -> None:
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    def finish(self) -> None:
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def iter_events(self) -> Iterator[Dict]:
+        """Replay past events, then follow new ones until the job finishes."""
+        index = 0
+        while True:
+            with self._cond:
+                if index >= len(self.events) and not self.finished:
+                    self._cond.wait(STREAM_HEARTBEAT_SECONDS)
+                batch = self.events[index:]
+                index += len(batch)
+                done = self.finished and index >= len(self.events)
+            if not batch and not done:
+                yield {"event": "heartbeat"}
+            yield from batch
+            if done:
+                return
+
+_jobs: "OrderedDict[str, _InviteJob]" = OrderedDict()
+_jobs_lock = threading.Lock()
+
+def _job_docs():
+    return get_db().collection(INVITE_JOBS_COLLECTION)
+
+def _normalize(participants: List[Dict], job: _InviteJob, counts: Dict) -> "OrderedDict[str, Optional[str]]":
+    """email -> name for valid, first-seen participants."""
+    unique: "OrderedDict[str, Optional[str]]" = OrderedDict()
+    for idx, participant in enumerate(participants):
+        email = (participant.get("email") or "").strip().lower()
+        if not email or "@" not in email:
+            counts["invalid"] += 1
+            job.emit({"event": "progress", "index": idx, "email": email, "state": "invalid"})
+        elif email in unique:
+            counts["skipped"] += 1
+            job.emit({"event": "progress", "index": idx, "email": email, "state": "duplicate"})
+        else:
+            unique[email] = participant.get("name")
+    return unique
+
+def _existing_invites(emails: List[str]) -> Dict[str, Tuple[str, bool]]:
+    """email -> (invite doc id, email_sent) for emails that already have an invite."""
+    invites = get_db().collection(INVITES_COLLECTION)
+    existing: Dict[str, Tuple[str, bool]] = {}
+    for start in range(0, len(emails), IN_QUERY_MAX):
+        chunk = emails[start:start + IN_QUERY_MAX]
+        for snap in invites.where("email", "in", chunk).select(["email", "email_sent"]).stream():
+            data = snap.to_dict()
+            email = data.get("email")
+            # Prefer an invite that was sent over older unsent duplicates
+            if email not in existing or (data.get("email_sent") and not existing[email][1]):
+                existing[email] = (snap.id, bool(data.get("email_sent")))
+    return existing
+
+def _queue(batch: List[Tuple[str, Optional[str], Optional[str]]], invited_by: str, job_id: str) -> List[Tuple]:
+    """Write a batch's invite documents and their outbox messages in one WriteBatch.
+
+    The messages are written already claimed by this job, so the outbox worker
+    only delivers those the job does not get to record (e.g. its replica died).
+    Returns (invite_ref, mail_ref, message) per email.
+    """
+    db = get_db()
+    invites = db.collection(INVITES_COLLECTION)
+    outbox = db.collection(MAIL_OUTBOX_COLLECTION)
+    write = db.batch()
+    now = now_utc()
+    lease_until = now + timedelta(seconds=MAIL_OUTBOX_LEASE_SECONDS)
+    queued = []
+    for email, name, doc_id in batch:
+        invite_ref = invites.document(doc_id) if doc_id else invites.document()
+        mail_ref = outbox.document()
+        message = invite_email_message(email, name)
+        data = {
+            "email": email,
+            "name": name,
+            "invited_by": invited_by,
+            "invited_at": now,
+            "status": "pending",
+            "email_sent": False,
+            "job_id": job_id,
+            "mail_id": mail_ref.id,
+        }
+        if doc_id:
+            write.update(invite_ref, data)
+        else:
+            write.set(invite_ref, data)
+        write.set(mail_ref, {**outbox_message(message, ref=f"{INVITES_COLLECTION}/{invite_ref.id}"),
+                             "state": MAIL_SENDING, "next_attempt_at": lease_until})
+        queued.append((invite_ref, mail_ref, message))
+    write.commit()
+    return queued
+
+def _send(queued: List[Tuple], idempotency_key: str) -> List[Tuple[Optional[str], Optional[mail.MailError]]]:
+    """Send one queued batch; returns (provider id, error) per message."""
+    messages = [message for _invite_ref, _mail_ref, message in queued]
+    try:
+        return [(provider_id, None) for provider_id in mail.send_batch(messages, idempotency_key)]
+    except mail.MailError as e:
+        if e.retryable or len(queued) == 1:
+            return [(None, e)] * len(queued)
+        print(f"WARNING: Invite batch of {len(queued)} rejected ({e}); sending individually")
+    results: List[Tuple[Optional[str], Optional[mail.MailError]]] = []
+    for _invite_ref, mail_ref, message in queued:
+        try:
+            # Keyed like the outbox's own deliveries, so a retry there is not sent twice
+            results.append((mail.send(message, mail_ref.id), None))
+        except mail.MailError as e:
+            results.append((None, e))
+    return results
+
+def _record(queued: List[Tuple], results: List[Tuple[Optional[str], Optional[mail.MailError]]]) -> List[str]:
+    """Record each message's outcome in one WriteBatch; returns its state: sent, queued or failed.
+
+    Retryable failures are released to the outbox worker, which retries them with backoff.
+    """
+    db = get_db()
+    write = db.batch()
+    now = now_utc()
+    states = []
+    for (invite_ref, mail_ref, _message), (provider_id, error) in zip(queued, results):
+        if error is None:
+            write.update(mail_ref, {"state": MAIL_SENT, "attempts": 1, "provider_id": provider_id, "sent_at": now,
+                                    "next_attempt_at": firestore.DELETE_FIELD, "updated_at": now})
+            write.update(invite_ref, {"email_sent": True, "email_sent_at": now})
+            states.append("sent")
+        elif error.retryable:
+            write.update(mail_ref, {"state": MAIL_PENDING, "attempts": 1, "error": str(error),
+                                    "next_attempt_at": retry_at(1), "updated_at": now})
+            states.append("queued")
+        else:
+            write.update(mail_ref, {"state": MAIL_FAILED, "attempts": 1, "error": str(error),
+                                    "next_attempt_at": firestore.DELETE_FIELD, "updated_at": now})
+            states.append("failed")
+    write.commit()
+    if "queued" in states:
+        get_mail_outbox().wake()
+    return states
+
+def _deliver(batch: List[Tuple[str, Optional[str], Optional[str]]], invited_by: str, job_id: str,
+             idempotency_key: str) -> Tuple[List[Tuple], List[Tuple[Optional[str], Optional[mail.MailError]]]]:
+    queued = _queue(batch, invited_by, job_id)
+    return queued, _send(queued, idempotency_key)
+
+def _run(job: _InviteJob, participants: List[Dict], invited_by: str) -> None:
+    job_ref = _job_docs().document(job.job_id)
+    counts = {"sent": 0, "queued": 0, "failed": 0, "skipped": 0, "invalid": 0}
+    state, error = JOB_SUCCEEDED, None
+    try:
+        unique = _normalize(participants, job, counts)
+        existing = _existing_invites(list(unique))
+        pending = []
+        for email, name in unique.items():
+            doc_id, sent = existing.get(email, (None, False))
+            if sent:
+                counts["skipped"] += 1
+                job.emit({"event": "progress", "email": email, "state": "already_invited"})
+            else:
+                pending.append((email, name, doc_id))
+
+        batches = [pending[i:i + INVITE_BATCH_SIZE] for i in range(0, len(pending), INVITE_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=max(1, INVITE_EMAIL_CONCURRENCY), thread_name_prefix="invite-mail") as pool:
+            futures = {pool.submit(_deliver, batch, invited_by, job.job_id, f"invite-{job.job_id}-{i}"): batch
+                       for i, batch in enumerate(batches)}
+            for future in as_completed(futures):
+                batch = futures[future]
+                queued, results = future.result()
+                states = _record(queued, results)
+                for (email, _name, _doc_id), (_provider_id, batch_error), batch_state in zip(batch, results, states):
+                    counts[batch_state] += 1
+                    event = {"event": "progress", "email": email, "state": batch_state}
+                    if batch_error:
+                        event["error"] = str(batch_error)
+                    job.emit(event)
+                job_ref.update({"counts": counts, "updated_at": now_utc()})
+    except Exception as e:
+        print(f"ERROR: Bulk invite job {job.job_id} failed: {e}")
+        state, error = JOB_FAILED, str(e)
+    finally:
+        try:
+            job_ref.update({"state": state, "counts": counts, "error": error,
+                            "updated_at": now_utc(), "finished_at": now_utc()})
+        except Exception as e:
+            print(f"WARNING: Failed to record bulk invite job {job.job_id} result: {e}")
+        job.emit({"event": "summary", "job_id": job.job_id, "state": state, "total": len(participants),
+                  "error": error, **counts})
+        job.finish()
+        log_audit_event(invited_by, "ADMIN", "invite_participants_bulk", f"{len(participants)} participants",
+                        "success" if state == JOB_SUCCEEDED and counts["sent"] > 0 else "error",
+                        {"job_id": job.job_id, "error": error, **counts})
+
+def start_bulk_invite(participants: List[Dict], invited_by: str) -> Dict:
+    """Record a bulk invite job and run it in the background; returns the job record."""
+    job_id = uuid.uuid4().hex
+    now = now_utc()
+    record = {
+        "kind": "invite_bulk",
+        "state": JOB_RUNNING,
+        "total": len(participants),
+        "counts": {},
+        "invited_by": invited_by,
+        "created_at": now,
+        "updated_at": now,
+        "error": None,
+    }
+    _job_docs().document(job_id).set(record)
+    job = _InviteJob(job_id)
+    with _jobs_lock:
+        _jobs[job_id] = job
+        finished = [jid for jid, j in _jobs.items() if j.finished]
+        for jid in finished[:max(0, len(finished) - RECENT_JOBS_MAX)]:
+            del _jobs[jid]
+    threading.Thread(target=_run, args=(job, participants, invited_by),
+                     name=f"invite-{job_id[:8]}", daemon=True).start()
+    return {"job_id": job_id, **record}
+
+def get_invite_job(job_id: str) -> Optional[Dict]:
+    snap = _job_docs().document(job_id).get()
+    if not snap.exists:
+        return None
+    result = {"job_id": job_id}
+    for key, value in snap.to_dict().items():
+        result[key] = value.isoformat() if hasattr(value, "isoformat") else value
+    return result
+
+def iter_invite_events(job_id: str) -> Optional[Iterator[Dict]]:
+    """Progress events for a job started on this replica; for other jobs, a single status event."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job.iter_events()
+    status = get_invite_job(job_id)
+    if status is None:
+        return None
+    event = "summary" if status.get("state") in TERMINAL_STATES else "status"
+    return iter([{"event": event, **status}])
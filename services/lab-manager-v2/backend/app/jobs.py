@@ -0,0 +1,543 @@
+"""Background provisioning jobs for attack-client labs."""
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore
+from app.audit import log_audit_event
+from app.auth import get_db
+from app.config import (
+    LABS_COLLECTION, JOBS_COLLECTION, PROVISIONING_LEASES_COLLECTION, AIR_ORIGIN_HOSTNAME, TOKEN_EXPIRE_HOURS,
+    PROVISIONING_WORKERS, PROVISIONING_LEASE_SECONDS, CLOUD_RUN_CREATE_RATE, DNS_CHANGE_RATE,
+    BULK_PROVISION_CONCURRENCY, FIRESTORE_TIMEOUT_SECONDS
+)
+from app.events import get_event_hub
+from app.lab_cache import get_lab_cache
+from app.ratelimit import RateLimiter
+from app.warm_pool import get_warm_pool
+from app.services import (
+    create_cloud_run_service, create_dns_record, make_dns_hostname,
+    stable_lab_id_from_email, now_utc
+)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+TERMINAL_STATES = {JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED}
+
+# Lab statuses; app.reaper takes expired labs through "reaping" to "expired"
+LAB_ACTIVE = "active"
+LAB_REAPING = "reaping"
+LAB_EXPIRED = "expired"
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested."""
+
+class LabBeingReaped(Exception):
+    """The lab's service and CNAME are being torn down; retry once the reaper has finished."""
+
+def being_reaped(lab: Dict) -> bool:
+    lease = lab.get("reap_lease_until")
+    return lab.get("status") == LAB_REAPING and lease is not None and lease > now_utc()
+
+# Provisioning backends; swapped for fakes in tests.
+_backends: Dict[str, Callable] = {
+    "create_service": create_cloud_run_service,
+    "create_dns": create_dns_record,
+}
+
+def set_backends(create_service: Optional[Callable] = None, create_dns: Optional[Callable] = None) -> None:
+    """Override the Cloud Run / DNS backends used by provisioning jobs."""
+    if create_service is not None:
+        _backends["create_service"] = create_service
+    if create_dns is not None:
+        _backends["create_dns"] = create_dns
+
+# Shared across the login/reset worker pool and bulk pre-provisioning.
+_stage_limits = {
+    "create_service": RateLimiter(CLOUD_RUN_CREATE_RATE),
+    "create_dns": RateLimiter(DNS_CHANGE_RATE),
+}
+
+def _call_stage(stage: str, *args):
+    _stage_limits[stage].acquire()
+    return _backends[stage](*args)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_futures: Dict[str, Future] = {}
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=PROVISIONING_WORKERS, thread_name_prefix="provision"
+                )
+    return _executor
+
+def shutdown_workers(wait: bool = False) -> None:
+    """Stop the worker pool; queued jobs stay queued in Firestore for resume."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait, cancel_futures=True)
+            _executor = None
+    _futures.clear()
+
+def worker_stats() -> Dict[str, int]:
+    """Provisioning pool occupancy: jobs running, and submitted but waiting for a thread."""
+    futures = list(_futures.values())
+    busy = sum(1 for future in futures if future.running())
+    return {"busy": busy, "limit": PROVISIONING_WORKERS, "waiting": len(futures) - busy}
+
+def _jobs():
+    return get_db().collection(JOBS_COLLECTION)
+
+def service_name_for(lab_id: str) -> str:
+    return f"attack-client-{lab_id.lower()}"
+
+def _serialize(job_id: str, data: Dict) -> Dict:
+    result = {"job_id": job_id}
+    for key, value in data.items():
+        result[key] = value.isoformat() if hasattr(value, "isoformat") else value
+    return result
+
+# Single flight per lab: lab_id -> future of the job record, from the first
+# start_lab_provisioning() call in this process until that job finishes. The
+# record is set before the job is submitted, so the job can always find and
+# drop its flight.
+_flights: Dict[str, Future] = {}
+_flights_lock = threading.Lock()
+
+def _leases():
+    return get_db().collection(PROVISIONING_LEASES_COLLECTION)
+
+@firestore.transactional
+def _acquire_lease(transaction, lease_ref, lab_ref, kind: str, job_id: str, email: str):
+    """Take the lab's provisioning lease for job_id.
+
+    Returns (True, None) when acquired, otherwise (False, job id to attach to):
+    the live lease holder, or for a create, the job of a lab another replica
+    already created (None if it has none). Raises LabBeingReaped while the
+    reaper holds the lab.
+    """
+    snap = lease_ref.get(transaction=transaction)
+    lab = lab_ref.get(transaction=transaction)
+    if lab.exists and being_reaped(lab.to_dict()):
+        raise LabBeingReaped(lab_ref.id)
+    if snap.exists:
+        lease = snap.to_dict()
+        if lease.get("lease_until") is not None and lease["lease_until"] > now_utc():
+            return False, lease.get("job_id")
+    if kind == "create":
+        if lab.exists:
+            return False, (lab.to_dict().get("attack") or {}).get("job_id")
+    now = now_utc()
+    transaction.set(lease_ref, {
+        "job_id": job_id,
+        "kind": kind,
+        "owner_email": email,
+        "acquired_at": now,
+        "lease_until": now + timedelta(seconds=PROVISIONING_LEASE_SECONDS),
+    })
+    return True, None
+
+@firestore.transactional
+def _release_lease(transaction, lease_ref, job_id: str) -> None:
+    snap = lease_ref.get(transaction=transaction)
+    if snap.exists and snap.to_dict().get("job_id") == job_id:
+        transaction.delete(lease_ref)
+
+def _is_flight_of(flight: Future, job_id: str) -> bool:
+    return flight.done() and flight.exception() is None and flight.result().get("job_id") == job_id
+
+def _drop_flight(job_id: str, lab_id: Optional[str] = None) -> None:
+    """Forget the local flight of job_id (a flight still pending belongs to a newer leader)."""
+    with _flights_lock:
+        lab_ids = [lab_id] if lab_id is not None else list(_flights)
+        for key in lab_ids:
+            flight = _flights.get(key)
+            if flight is not None and _is_flight_of(flight, job_id):
+                del _flights[key]
+
+def _release(lab_id: str, job_id: str) -> None:
+    """Drop the lab's lease and local flight once job_id has finished."""
+    _drop_flight(job_id, lab_id)
+    try:
+        _release_lease(get_db().transaction(), _leases().document(lab_id), job_id)
+    except Exception as e:
+        print(f"WARNING: Failed to release provisioning lease for {lab_id} (expires on its own): {e}")
+
+def _attached(lab_id: str, job_id: Optional[str]) -> Dict:
+    job = get_job(job_id) if job_id else None
+    if job is None:
+        job = {"job_id": None, "lab_id": lab_id, "state": None}
+    return {**job, "attached": True}
+
+def start_lab_provisioning(email: str, kind: str = "create", expires_in_hours: Optional[float] = None,
+                           submit: bool = True) -> Dict:
+    """Persist a job, mark the lab as provisioning and hand the job to the worker pool.
+
+    kind is "create" for a first login (the lab document is written here) or
+    "reset" to reprovision an existing lab. With submit=False the caller runs
+    the job itself via run_job().
+
+    At most one job per lab runs at a time: concurrent callers in this
+    process share the first caller's job, and a job on another replica is
+    found through the lab's lease. Either way the caller gets the in-flight
+    job with "attached": True and no new job is started.
+    """
+    lab_id = stable_lab_id_from_email(email)
+    with _flights_lock:
+        flight = _flights.get(lab_id)
+        leader = flight is None
+        if leader:
+            flight = _flights[lab_id] = Future()
+    if not leader:
+        return {**flight.result(timeout=FIRESTORE_TIMEOUT_SECONDS * 3), "attached": True}
+
+    try:
+        job = _start_lab_provisioning(email, lab_id, kind, expires_in_hours)
+    except BaseException as e:
+        with _flights_lock:
+            _flights.pop(lab_id, None)
+        flight.set_exception(e)
+        raise
+    if job.get("attached"):
+        # Running elsewhere: nothing for this process to wait on
+        with _flights_lock:
+            _flights.pop(lab_id, None)
+    flight.set_result(job)
+    if submit and not job.get("attached"):
+        _submit(job["job_id"])
+    return job
+
+@firestore.transactional
+def _extend(transaction, lab_ref, email: str, expires_at) -> str:
+    """Move the lab's expiry; returns "extended", "created", or the status that prevented it."""
+    snap = lab_ref.get(transaction=transaction)
+    if not snap.exists:
+        transaction.set(lab_ref, {
+            "owner_email": email,
+            "lab_name": lab_ref.id,
+            "created_at": now_utc(),
+            "expires_at": expires_at,
+            "status": LAB_ACTIVE,
+            "attack": {"state": "pending"},
+        })
+        return "created"
+    lab = snap.to_dict()
+    if being_reaped(lab):
+        return LAB_REAPING
+    if lab.get("status") in (LAB_REAPING, LAB_EXPIRED):
+        # Torn down (or its reaper died part way): there is nothing left to extend
+        return LAB_EXPIRED
+    transaction.update(lab_ref, {"expires_at": expires_at})
+    return "extended"
+
+def extend_lab_session(email: str, minutes: int) -> Dict:
+    """Extend the user's lab session; a lab the reaper already tore down is reprovisioned.
+
+    Raises LabBeingReaped while its teardown is in progress.
+    """
+    db = get_db()
+    lab_id = stable_lab_id_from_email(email)
+    expires_at = now_utc() + timedelta(minutes=minutes)
+    outcome = _extend(db.transaction(), db.collection(LABS_COLLECTION).document(lab_id), email, expires_at)
+    if outcome == LAB_REAPING:
+        raise LabBeingReaped(lab_id)
+    result = {"new_expiry": expires_at.isoformat()}
+    if outcome == LAB_EXPIRED:
+        # A reset revives the lab with a new service, CNAME and expiry
+        job = start_lab_provisioning(email, kind="reset", expires_in_hours=minutes / 60)
+        result["provisioning_job_id"] = job["job_id"]
+    else:
+        get_lab_cache().invalidate(lab_id)
+    return result
+
+def _start_lab_provisioning(email: str, lab_id: str, kind: str, expires_in_hours: Optional[float]) -> Dict:
+    db = get_db()
+    lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
+    job_id = uuid.uuid4().hex
+    acquired, holder = _acquire_lease(db.transaction(), _leases().document(lab_id), lab_ref, kind, job_id, email)
+    if not acquired:
+        return _attached(lab_id, holder)
+    now = now_utc()
+    expires_at = now + timedelta(hours=expires_in_hours or TOKEN_EXPIRE_HOURS)
+    job = {
+        "kind": kind,
+        "lab_id": lab_id,
+        "owner_email": email,
+        "state": JOB_QUEUED,
+        "cancel_requested": False,
+        "created_at": now,
+        "updated_at": now,
+        "error": None,
+        "result": None,
+    }
+    _jobs().document(job_id).set(job)
+
+    attack = {"state": "provisioning", "job_id": job_id}
+    lab_data = {
+        "lab_name": lab_id,
+        "owner_email": email,
+        "status": LAB_ACTIVE,
+        "owner_status": f"{email}|{LAB_ACTIVE}",
+        "created_at": now,
+        "expires_at": expires_at,
+        "attack": attack,
+        "victims": {},
+        "imperva": {},
+    }
+    if kind == "create":
+        lab_ref.set(lab_data)
+    else:
+        try:
+            # A reset also revives a lab the reaper already tore down. Field paths keep
+            # attack.cloud_run_service, the service the job reprovisions.
+            lab_ref.update({"expires_at": expires_at, "attack.state": "provisioning", "attack.job_id": job_id,
+                            "attack.error": firestore.DELETE_FIELD, "status": LAB_ACTIVE,
+                            "owner_status": f"{email}|{LAB_ACTIVE}"})
+        except NotFound:
+            lab_ref.set(lab_data)
+    get_lab_cache().invalidate(lab_id)
+    get_event_hub().refresh(lab_id)
+    return _serialize(job_id, job)
+
+def _submit(job_id: str) -> None:
+    future = _get_executor().submit(run_job, job_id)
+    _futures[job_id] = future
+    future.add_done_callback(lambda _f: _futures.pop(job_id, None))
+
+@firestore.transactional
+def _claim(transaction, job_ref) -> Optional[Dict]:
+    """Move a queued job to running; returns None if someone else owns it.
+
+    A job cancelled while queued is marked cancelled and returned with that state.
+    """
+    snap = job_ref.get(transaction=transaction)
+    if not snap.exists:
+        return None
+    job = snap.to_dict()
+    if job.get("state") != JOB_QUEUED:
+        return None
+    if job.get("cancel_requested"):
+        transaction.update(job_ref, {"state": JOB_CANCELLED, "updated_at": now_utc(), "finished_at": now_utc()})
+        return {**job, "state": JOB_CANCELLED}
+    transaction.update(job_ref, {"state": JOB_RUNNING, "started_at": now_utc(), "updated_at": now_utc()})
+    return job
+
+def _action(job: Dict) -> str:
+    return "lab_created" if job.get("kind") == "create" else "lab_reset"
+
+def _check_cancel(job_ref) -> None:
+    snap = job_ref.get(field_paths=["cancel_requested"])
+    if snap.exists and snap.get("cancel_requested"):
+        raise JobCancelled()
+
+def run_job(job_id: str) -> Optional[str]:
+    """Execute a queued job in the calling thread; returns its final state."""
+    db = get_db()
+    job_ref = _jobs().document(job_id)
+    job = _claim(db.transaction(), job_ref)
+    if job is None:
+        # Another worker owns (or finished) the job and its lease; only the local flight is ours
+        _drop_flight(job_id)
+        return None
+
+    try:
+        if job["state"] == JOB_CANCELLED:
+            # Cancelled while queued (on another replica, or future.cancel() lost the race)
+            _cancel_lab(job_id, job["lab_id"], job.get("owner_email"), _action(job))
+            return JOB_CANCELLED
+        return _run_claimed(job_id, job)
+    finally:
+        _release(job["lab_id"], job_id)
+
+def _service_for(kind: str, lab_ref) -> Tuple[str, Optional[str]]:
+    """Cloud Run service for a job, and its URL when it is already running.
+
+    A lab keeps the service it is bound to (a reset reuses it); a new lab
+    takes one from the warm pool if there is one, else gets its own.
+    """
+    snap = lab_ref.get(field_paths=["attack.cloud_run_service"])
+    bound = ((snap.to_dict() or {}).get("attack") or {}).get("cloud_run_service") if snap.exists else None
+    if bound:
+        return bound, None
+    if kind == "create":
+        claimed = get_warm_pool().claim(lab_ref)
+        if claimed is not None:
+            return claimed
+    return service_name_for(lab_ref.id), None
+
+def _failed_attack(job_id: str, error: str, service_name: Optional[str] = None) -> Dict:
+    """Lab update for a failed or cancelled job.
+
+    Field paths leave the rest of the attack map alone, so a service the lab
+    is bound to stays bound and a reset reuses it instead of leaking it.
+    """
+    attack = {"attack.state": "error", "attack.job_id": job_id, "attack.error": error}
+    if service_name:
+        attack["attack.cloud_run_service"] = service_name
+    return attack
+
+def _cancel_lab(job_id: str, lab_id: str, email: Optional[str], action: str) -> None:
+    """Record a job cancelled before it ran on its lab (which was left "provisioning")."""
+    try:
+        get_db().collection(LABS_COLLECTION).document(lab_id).update(_failed_attack(job_id, "Provisioning cancelled"))
+    except NotFound:
+        return
+    get_lab_cache().invalidate(lab_id)
+    get_event_hub().refresh(lab_id)
+    log_audit_event(email, "SYSTEM", action, lab_id, "cancelled", {"job_id": job_id})
+
+def _run_claimed(job_id: str, job: Dict) -> str:
+    db = get_db()
+    job_ref = _jobs().document(job_id)
+    lab_id = job["lab_id"]
+    email = job["owner_email"]
+    lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
+    action = _action(job)
+    service_name = None
+    try:
+        dns_hostname = make_dns_hostname(email, scenario_id="air")
+        service_name, cloud_run_url = _service_for(job["kind"], lab_ref)
+        if cloud_run_url is None:
+            cloud_run_url = _call_stage("create_service", service_name, dns_hostname)
+        _check_cancel(job_ref)
+        _call_stage("create_dns", dns_hostname, AIR_ORIGIN_HOSTNAME)
+        _check_cancel(job_ref)
+
+        attack = {
+            "state": "ready",
+            "job_id": job_id,
+            "cloud_run_service": service_name,
+            "cloud_run_url": cloud_run_url,
+            "dns_hostname": dns_hostname,
+        }
+        lab_ref.update({"attack": attack})
+        get_lab_cache().invalidate(lab_id)
+        get_event_hub().refresh(lab_id)
+        job_ref.update({
+            "state": JOB_SUCCEEDED,
+            "result": {"cloud_run_url": cloud_run_url, "dns_hostname": dns_hostname},
+            "updated_at": now_utc(),
+            "finished_at": now_utc(),
+        })
+        log_audit_event(email, "SYSTEM", action, lab_id, "success", {"job_id": job_id})
+        return JOB_SUCCEEDED
+    except JobCancelled:
+        lab_ref.update(_failed_attack(job_id, "Provisioning cancelled", service_name))
+        get_lab_cache().invalidate(lab_id)
+        get_event_hub().refresh(lab_id)
+        job_ref.update({"state": JOB_CANCELLED, "updated_at": now_utc(), "finished_at": now_utc()})
+        log_audit_event(email, "SYSTEM", action, lab_id, "cancelled", {"job_id": job_id})
+        return JOB_CANCELLED
+    except Exception as e:
+        print(f"ERROR: Provisioning job {job_id} failed: {e}")
+        lab_ref.update(_failed_attack(job_id, str(e), service_name))
+        get_lab_cache().invalidate(lab_id)
+        get_event_hub().refresh(lab_id)
+        job_ref.update({"state": JOB_FAILED, "error": str(e), "updated_at": now_utc(), "finished_at": now_utc()})
+        log_audit_event(email, "SYSTEM", action, lab_id, "error", {"job_id": job_id, "error": str(e)})
+        return JOB_FAILED
+
+def get_job(job_id: str) -> Optional[Dict]:
+    """Return a job record, or None if it does not exist."""
+    snap = _jobs().document(job_id).get()
+    if not snap.exists:
+        return None
+    return _serialize(job_id, snap.to_dict())
+
+def cancel_job(job_id: str) -> Optional[Dict]:
+    """Request cancellation of a job.
+
+    Queued jobs are cancelled immediately; running jobs stop at the next
+    stage boundary (an in-flight Cloud Run operation is not interrupted).
+    """
+    job_ref = _jobs().document(job_id)
+    snap = job_ref.get()
+    if not snap.exists:
+        return None
+    job = snap.to_dict()
+    if job.get("state") in TERMINAL_STATES:
+        return _serialize(job_id, job)
+
+    job_ref.update({"cancel_requested": True, "updated_at": now_utc()})
+    future = _futures.get(job_id)
+    if job.get("state") == JOB_QUEUED and future is not None and future.cancel():
+        job_ref.update({"state": JOB_CANCELLED, "finished_at": now_utc()})
+        _cancel_lab(job_id, job["lab_id"], job.get("owner_email"), _action(job))
+        _release(job["lab_id"], job_id)
+    return get_job(job_id)
+
+def resume_queued_jobs() -> int:
+    """Resubmit jobs left queued by a previous process (claims are transactional)."""
+    try:
+        pending = list(_jobs().where("state", "==", JOB_QUEUED).stream())
+    except Exception as e:
+        print(f"WARNING: Failed to list queued provisioning jobs: {e}")
+        return 0
+    for snap in pending:
+        if snap.id not in _futures:
+            _submit(snap.id)
+    return len(pending)
+
+def provision_labs_bulk(emails: List[str], concurrency: Optional[int] = None,
+                        expires_in_hours: Optional[float] = None) -> Iterator[Dict]:
+    """Pre-create labs for a roster, yielding one progress event per lab.
+
+    Jobs run on a bounded executor private to this call so a large roster
+    does not starve the login/reset worker pool; Cloud Run and DNS calls
+    still share the per-stage rate limits. Labs that already exist are
+    skipped. If the consumer stops iterating, in-flight jobs keep running.
+    """
+    db = get_db()
+    total = len(emails)
+    max_workers = max(1, min(concurrency or BULK_PROVISION_CONCURRENCY, BULK_PROVISION_CONCURRENCY))
+    counts = {"queued": 0, "skipped": 0, JOB_SUCCEEDED: 0, JOB_FAILED: 0, JOB_CANCELLED: 0}
+    done = 0
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bulk-provision")
+    futures = {}
+    try:
+        for email in emails:
+            lab_id = stable_lab_id_from_email(email)
+            if db.collection(LABS_COLLECTION).document(lab_id).get().exists:
+                done += 1
+                counts["skipped"] += 1
+                yield {"event": "progress", "email": email, "lab_id": lab_id, "state": "skipped",
+                       "done": done, "total": total}
+                continue
+            job = start_lab_provisioning(email, kind="create", expires_in_hours=expires_in_hours, submit=False)
+            if job.get("attached"):
+                # A login (here or on another replica) got there first
+                done += 1
+                counts["skipped"] += 1
+                yield {"event": "progress", "email": email, "lab_id": lab_id, "job_id": job["job_id"],
+                       "state": "skipped", "done": done, "total": total}
+                continue
+            counts["queued"] += 1
+            futures[executor.submit(run_job, job["job_id"])] = (email, lab_id, job["job_id"])
+
+        for future in as_completed(futures):
+            email, lab_id, job_id = futures[future]
+            try:
+                state = future.result() or JOB_FAILED
+            except Exception as e:
+                print(f"ERROR: Bulk provisioning job {job_id} crashed: {e}")
+                state = JOB_FAILED
+            done += 1
+            counts[state] = counts.get(state, 0) + 1
+            yield {"event": "progress", "email": email, "lab_id": lab_id, "job_id": job_id,
+                   "state": state, "done": done, "total": total}
+    finally:
+        executor.shutdown(wait=False)
+
+    yield {"event": "summary", "total": total, **counts}
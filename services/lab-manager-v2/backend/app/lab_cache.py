@@ -0,0 +1,169 @@
+"""Read-through cache of lab documents.
+
+Entries are keyed by lab id (stable_lab_id_from_email) with LRU + TTL
+eviction. A Firestore listener on active labs keeps cached entries
+coherent across replicas; the TTL bounds staleness if the listener drops.
+A miss is only stored if the key was not invalidated (or updated by the
+listener) while it was being read, so a read racing a write cannot put
+the old document back.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from app.auth import get_db, get_async_db
+from app.config import LABS_COLLECTION, LAB_CACHE_TTL_SECONDS, LAB_CACHE_MAX_ENTRIES, FIRESTORE_TIMEOUT_SECONDS
+
+_MISSING = object()
+
+class LabCache:
+    def __init__(self, ttl: float = LAB_CACHE_TTL_SECONDS, max_entries: int = LAB_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # lab_id -> (expires_at, data or None for "does not exist")
+        self._entries: "OrderedDict[str, Tuple[float, Optional[Dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # lab_id -> [generation, misses in flight]; only kept while a miss for the key is being read
+        self._loading: Dict[str, List[int]] = {}
+        self._watch = None
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                       "invalidations": 0, "listener_updates": 0}
+
+    def get(self, lab_id: str) -> Optional[Dict]:
+        """Return a copy of the lab document, or None if it does not exist."""
+        if self.ttl <= 0:
+            return self._load(lab_id)
+        cached, generation = self._lookup(lab_id)
+        if cached is not _MISSING:
+            return copy.deepcopy(cached)
+        try:
+            data = self._load(lab_id)
+        except BaseException:
+            self._store(lab_id, _MISSING, generation)
+            raise
+        self._store(lab_id, data, generation)
+        return copy.deepcopy(data)
+
+    async def aget(self, lab_id: str) -> Optional[Dict]:
+        """get() for request handlers: misses are read with the asyncio client."""
+        if self.ttl <= 0:
+            snap = await get_async_db().collection(LABS_COLLECTION).document(lab_id).get(timeout=FIRESTORE_TIMEOUT_SECONDS)
+            return snap.to_dict() if snap.exists else None
+        cached, generation = self._lookup(lab_id)
+        if cached is not _MISSING:
+            return copy.deepcopy(cached)
+        try:
+            snap = await get_async_db().collection(LABS_COLLECTION).document(lab_id).get(timeout=FIRESTORE_TIMEOUT_SECONDS)
+        except BaseException:
+            self._store(lab_id, _MISSING, generation)
+            raise
+        data = snap.to_dict() if snap.exists else None
+        self._store(lab_id, data, generation)
+        return copy.deepcopy(data)
+
+    def _lookup(self, lab_id: str) -> Tuple[object, int]:
+        """(cached data, 0) on a hit; on a miss (_MISSING, generation) for _store()."""
+        with self._lock:
+            entry = self._entries.get(lab_id)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(lab_id)
+                self._stats["hits"] += 1
+                return entry[1], 0
+            if entry is not None:
+                del self._entries[lab_id]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            loading = self._loading.setdefault(lab_id, [0, 0])
+            loading[1] += 1
+            return _MISSING, loading[0]
+
+    def _load(self, lab_id: str) -> Optional[Dict]:
+        snap = get_db().collection(LABS_COLLECTION).document(lab_id).get()
+        return snap.to_dict() if snap.exists else None
+
+    def _store(self, lab_id: str, data, generation: int) -> None:
+        """Finish a miss: cache data unless the key changed since _lookup() (or the read failed)."""
+        with self._lock:
+            loading = self._loading[lab_id]
+            loading[1] -= 1
+            if loading[1] == 0:
+                del self._loading[lab_id]
+            if data is _MISSING or loading[0] != generation:
+                return
+            self._entries[lab_id] = (time.monotonic() + self.ttl, data)
+            self._entries.move_to_end(lab_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, lab_id: str) -> None:
+        """Drop an entry (call after writing the lab document)."""
+        with self._lock:
+            self._bump(lab_id)
+            if self._entries.pop(lab_id, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def _bump(self, lab_id: str) -> None:
+        # Caller holds the lock: misses for lab_id now in flight will not be stored
+        if lab_id in self._loading:
+            self._loading[lab_id][0] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for lab_id in self._loading:
+                self._bump(lab_id)
+            self._entries.clear()
+
+    # Cross-replica coherence
+
+    def _on_snapshot(self, _docs, changes, _read_time) -> None:
+        for change in changes:
+            lab_id = change.document.id
+            with self._lock:
+                self._bump(lab_id)
+                if lab_id not in self._entries:
+                    continue
+                if change.type.name == "REMOVED":
+                    # Left the "active" query (or was deleted): refetch on next read.
+                    del self._entries[lab_id]
+                    self._stats["invalidations"] += 1
+                else:
+                    self._entries[lab_id] = (time.monotonic() + self.ttl, change.document.to_dict())
+                    self._stats["listener_updates"] += 1
+
+    def start_listener(self) -> None:
+        """Watch active labs so writes from other replicas refresh cached entries."""
+        if self.ttl <= 0 or self._watch is not None:
+            return
+        try:
+            query = get_db().collection(LABS_COLLECTION).where("status", "==", "active")
+            self._watch = query.on_snapshot(self._on_snapshot)
+        except Exception as e:
+            print(f"WARNING: Failed to start lab cache listener (TTL-only invalidation): {e}")
+
+    def stop_listener(self) -> None:
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception as e:
+                print(f"WARNING: Failed to stop lab cache listener: {e}")
+            self._watch = None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        stats["listener_active"] = bool(self._watch is not None and getattr(self._watch, "is_active", True))
+        return stats
+
+_cache: Optional[LabCache] = None
+_cache_lock = threading.Lock()
+
+def get_lab_cache() -> LabCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LabCache()
+    return _cache
@@ -0,0 +1,228 @@
+"""Outgoing email: provider backends, per-provider rate limits and retries.
+
+MAIL_BACKEND selects the provider: "resend" (REST API over a pooled
+keep-alive session; RESEND_API_URL can point at a local HTTP stub), "smtp"
+(a local SMTP stub such as MailHog) or "memory", an in-process sink that
+records messages instead of sending them (tests). send() and send_batch()
+take the provider's rate limit before each API call and retry transient
+failures (rate limiting, 5xx, connection errors) with jittered exponential
+backoff, reusing the caller's idempotency key.
+"""
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+from app.config import (
+    MAIL_BACKEND, RESEND_API_URL, SMTP_HOST, SMTP_PORT, EMAIL_SEND_RATE, EMAIL_MAX_ATTEMPTS,
+    EMAIL_RETRY_BASE_SECONDS, EMAIL_TIMEOUT_SECONDS
+)
+from app.metrics import timed
+from app.ratelimit import RateLimiter
+from app.secret_store import get_resend_api_key, get_secret_store
+
+HTTP_POOL_SIZE = 16
+# Resend accepts up to 100 messages per batch call
+MAX_BATCH = 100
+
+class MailError(Exception):
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+class ResendBackend:
+    """Resend's REST API over one pooled, keep-alive HTTP session per process."""
+
+    name = "resend"
+
+    def __init__(self, api_url: str = RESEND_API_URL, timeout: float = EMAIL_TIMEOUT_SECONDS):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _get_session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    # Imported on first use to keep it off the startup path
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
+                    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
+                    self._session = session
+        return self._session
+
+    def send(self, message: Dict, idempotency_key: Optional[str] = None) -> Optional[str]:
+        return (self._post("/emails", message, idempotency_key) or {}).get("id")
+
+    def send_batch(self, messages: List[Dict], idempotency_key: Optional[str] = None) -> List[Optional[str]]:
+        result = self._post("/emails/batch", messages, idempotency_key) or {}
+        ids = [item.get("id") for item in result.get("data", [])]
+        return ids + [None] * (len(messages) - len(ids))
+
+    def _post(self, path: str, body, idempotency_key: Optional[str]):
+        api_key = get_resend_api_key()
+        if not api_key:
+            raise MailError("RESEND_API_KEY not configured")
+        import requests
+
+        # During a rotation grace window, fall back to the previous key if the new one is not live yet
+        previous_key = get_secret_store().previous("resend")
+        for key in [api_key] + ([previous_key] if previous_key else []):
+            headers = {"Authorization": f"Bearer {key}"}
+            if idempotency_key:
+                headers["Idempotency-Key"] = idempotency_key
+            try:
+                with timed("resend", "send_batch" if path.endswith("/batch") else "send") as call:
+                    resp = self._get_session().post(self.api_url + path, json=body, headers=headers, timeout=self.timeout)
+                    if resp.status_code >= 300:
+                        call.outcome = "error"
+            except requests.RequestException as e:
+                raise MailError(f"Resend request failed: {e}", retryable=True)
+            if resp.status_code < 300:
+                return resp.json() if resp.content else None
+            if resp.status_code in (401, 403) and previous_key and key != previous_key:
+                print(f"WARNING: Resend rejected the current API key ({resp.status_code}), retrying with the previous one")
+                continue
+            try:
+                detail = resp.json().get("message") or resp.text
+            except ValueError:
+                detail = resp.text
+            raise MailError(f"Resend error {resp.status_code}: {detail}",
+                            retryable=resp.status_code == 429 or resp.status_code >= 500)
+
+class SmtpBackend:
+    """Plain SMTP over one reused connection, for a local stub such as MailHog."""
+
+    name = "smtp"
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, timeout: float = EMAIL_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def send(self, message: Dict, idempotency_key: Optional[str] = None) -> Optional[str]:
+        import smtplib
+        from email.message import EmailMessage
+        mime = EmailMessage()
+        mime["From"] = message["from"]
+        mime["To"] = ", ".join(message["to"])
+        mime["Subject"] = message["subject"]
+        if idempotency_key:
+            mime["Message-ID"] = f"<{idempotency_key}@lab-manager>"
+        mime.set_content(message["html"], subtype="html")
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    with timed("smtp", "send"):
+                        if self._conn is None:
+                            self._conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+                        self._conn.send_message(mime)
+                    return idempotency_key
+                except smtplib.SMTPServerDisconnected:
+                    # Stale pooled connection: reconnect once
+                    self._conn = None
+                    if attempt:
+                        raise MailError("SMTP server disconnected", retryable=True)
+                except (OSError, smtplib.SMTPException) as e:
+                    self._conn = None
+                    raise MailError(f"SMTP send failed: {e}", retryable=not isinstance(e, smtplib.SMTPRecipientsRefused))
+
+    def send_batch(self, messages: List[Dict], idempotency_key: Optional[str] = None) -> List[Optional[str]]:
+        return [self.send(message, f"{idempotency_key}-{i}" if idempotency_key else None)
+                for i, message in enumerate(messages)]
+
+class MemoryMailSink:
+    """Records messages instead of sending them (local development and tests)."""
+
+    name = "memory"
+
+    def __init__(self):
+        self.sent: List[Dict] = []
+        self.calls = 0
+        self._failures: List[bool] = []
+        self._idempotent: Dict[str, List[Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def fail_next(self, count: int = 1, retryable: bool = True) -> None:
+        """Make the next count calls fail."""
+        with self._lock:
+            self._failures.extend([retryable] * count)
+
+    def send(self, message: Dict, idempotency_key: Optional[str] = None) -> Optional[str]:
+        return self.send_batch([message], idempotency_key)[0]
+
+    def send_batch(self, messages: List[Dict], idempotency_key: Optional[str] = None) -> List[Optional[str]]:
+        with self._lock:
+            self.calls += 1
+            if self._failures:
+                raise MailError("Simulated mail failure", retryable=self._failures.pop(0))
+            # Like the provider, a repeated idempotency key returns the first result without sending
+            if idempotency_key in self._idempotent:
+                return list(self._idempotent[idempotency_key])
+            ids = []
+            for message in messages:
+                self.sent.append(dict(message))
+                ids.append(f"memory-{len(self.sent)}")
+            if idempotency_key:
+                self._idempotent[idempotency_key] = ids
+            return ids
+
+# Provider API calls per second; providers not listed are not limited.
+_provider_rates = {"resend": EMAIL_SEND_RATE}
+_limits: Dict[str, RateLimiter] = {}
+_limits_lock = threading.Lock()
+
+def _limiter(provider: str) -> RateLimiter:
+    with _limits_lock:
+        if provider not in _limits:
+            _limits[provider] = RateLimiter(_provider_rates.get(provider, 0))
+        return _limits[provider]
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_mail_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backends = {"memory": MemoryMailSink, "smtp": SmtpBackend}
+                _backend = backends.get(MAIL_BACKEND, ResendBackend)()
+    return _backend
+
+def set_mail_backend(backend) -> None:
+    """Replace the process-wide backend (e.g. with a MemoryMailSink in tests)."""
+    global _backend
+    _backend = backend
+
+def _with_retries(call, attempts: int):
+    backend = get_mail_backend()
+    for attempt in range(1, attempts + 1):
+        _limiter(backend.name).acquire()
+        try:
+            return call(backend)
+        except MailError as e:
+            if not e.retryable or attempt == attempts:
+                raise
+            # Full jitter so concurrent senders do not retry in lockstep
+            delay = random.uniform(0, EMAIL_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+            print(f"WARNING: Mail {backend.name} attempt {attempt}/{attempts} failed ({e}); retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def send(message: Dict, idempotency_key: Optional[str] = None, attempts: int = EMAIL_MAX_ATTEMPTS) -> Optional[str]:
+    """Send one message; returns the provider message id. Raises MailError.
+
+    Retries reuse idempotency_key, so a send whose response was lost is not delivered twice.
+    """
+    return _with_retries(lambda backend: backend.send(message, idempotency_key), attempts)
+
+def send_batch(messages: List[Dict], idempotency_key: Optional[str] = None,
+               attempts: int = EMAIL_MAX_ATTEMPTS) -> List[Optional[str]]:
+    """Send up to MAX_BATCH messages in one provider call; returns their ids. Raises MailError."""
+    if len(messages) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} messages per batch")
+    return _with_retries(lambda backend: backend.send_batch(messages, idempotency_key), attempts)
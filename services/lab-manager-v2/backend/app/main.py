@@ -1,9 +1,53 @@
 """Main FastAPI application."""
-from fastapi import FastAPI
+import asyncio
+import hmac
+import os
+import threading
+from typing import Callable, List, Optional
+from fastapi import FastAPI, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from app.routers import auth, labs, admin
 from app.auth import create_user, get_db
-from app.config import CORS_ORIGINS_LIST, USERS_COLLECTION, GCP_PROJECT
+from app import hashing, metrics, startup_profile
+from app.audit import get_audit_writer
+from app.clients import close_clients, close_async_clients
+from app.cloud_run import get_cloud_run
+from app.credential_cache import get_credential_cache
+from app.dns_health import get_dns_prober
+from app.events import get_event_hub
+from app.jobs import resume_queued_jobs, shutdown_workers, worker_stats
+from app.lab_cache import get_lab_cache
+from app.outbox import get_mail_outbox
+from app.reaper import get_lab_reaper
+from app.secret_store import get_secret_store
+from app.tokens import get_claims_cache
+from app.warm_pool import get_warm_pool
+from app.config import (
+    CORS_ORIGINS_LIST, USERS_COLLECTION, GCP_PROJECT, METRICS_TOKEN, METRICS_SAMPLE_SECONDS, SECRET_FETCH_TIMEOUT
+)
+
+# Set by app.server once run_startup_once() has run in the master process
+STARTUP_DONE_ENV = "LAB_MANAGER_STARTUP_DONE"
+
+_startup_done = threading.Event()
+# Background startup steps that raised; reported by /healthz
+_startup_failures: List[str] = []
+_metrics_sampler: Optional[asyncio.Task] = None
+
+metrics.instrument_firestore()
+metrics.register_threadpool("provisioning", worker_stats)
+for _name, _stats in (("lab_cache", lambda: get_lab_cache().stats()),
+                      ("credential_cache", lambda: get_credential_cache().stats()),
+                      ("claims_cache", lambda: get_claims_cache().stats()),
+                      ("cloud_run", lambda: get_cloud_run().stats()),
+                      ("event_hub", lambda: get_event_hub().stats()),
+                      ("audit_writer", lambda: get_audit_writer().stats()),
+                      ("mail_outbox", lambda: get_mail_outbox().stats()),
+                      ("lab_reaper", lambda: get_lab_reaper().stats()),
+                      ("warm_pool", lambda: get_warm_pool().stats())):
+    metrics.register_component(_name, _stats)
 
 app = FastAPI(title="Lab Manager API", version="2.0.0")
 
@@ -16,6 +60,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so latency includes CORS and error handling
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Include routers
 app.include_router(auth.router)
 app.include_router(labs.router)
@@ -27,11 +74,48 @@ def root():
 
 @app.get("/healthz")
 def healthz():
+    """Readiness: 503 until secrets are loaded and background startup has finished."""
+    waiting = get_secret_store().pending()
+    if not _startup_done.is_set():
+        waiting.append("startup")
+    if waiting:
+        return JSONResponse({"ok": False, "waiting_for": waiting}, status_code=503)
+    if _startup_failures:
+        return {"ok": True, "failed_startup_steps": list(_startup_failures)}
     return {"ok": True}
 
-@app.on_event("startup")
-def startup_event():
-    """Seed initial users on startup."""
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(authorization: Optional[str] = Header(None)):
+    """Prometheus exposition for all workers; 404 unless METRICS_TOKEN is set and presented."""
+    if not METRICS_TOKEN or not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    metrics.sample()
+    body, content_type = await run_in_threadpool(metrics.render)
+    return Response(body, media_type=content_type)
+
+async def _sample_metrics():
+    while True:
+        try:
+            metrics.sample()
+        except Exception as e:
+            print(f"WARNING: Metrics sampling failed: {e}")
+        await asyncio.sleep(METRICS_SAMPLE_SECONDS)
+
+def run_startup_once():
+    """One-time startup work: seed users and replay spilled audit events.
+    
+    Under app.server this runs once in the master process before workers fork;
+    a plain `uvicorn app.main:app` runs it from startup_event instead.
+    """
+    with startup_profile.step("seed users"):
+        _seed_users()
+    
+    with startup_profile.step("replay audit spill"):
+        replayed = get_audit_writer().replay_spill()
+    if replayed:
+        print(f"✓ Replayed {replayed} spilled audit event(s)")
+
+def _seed_users():
     try:
         db = get_db()
         
@@ -54,3 +138,86 @@ def startup_event():
                     print(f"✗ Error creating {user_data['email']}: {e}")
     except Exception as e:
         print(f"WARNING: Failed to seed users: {e}")
+
+def _startup_step(name: str, fn: Callable[[], None]) -> None:
+    """Run one background startup step; a failure is logged and reported by /healthz, not fatal."""
+    with startup_profile.step(name):
+        try:
+            fn()
+        except Exception as e:
+            _startup_failures.append(name)
+            print(f"WARNING: Startup step '{name}' failed: {e}")
+
+def _resume_queued_jobs():
+    # Safe in every worker: job claims are transactional
+    resumed = resume_queued_jobs()
+    if resumed:
+        print(f"✓ Resumed {resumed} queued provisioning job(s)")
+
+def _wait_for_secrets():
+    if not get_secret_store().wait(timeout=SECRET_FETCH_TIMEOUT):
+        print(f"WARNING: Secrets not loaded after {SECRET_FETCH_TIMEOUT}s: {', '.join(get_secret_store().pending())}")
+
+def _background_startup():
+    """Per-process startup work, run off the critical path; /healthz waits for it."""
+    try:
+        with startup_profile.step("warm bcrypt pool"):
+            try:
+                hashing.warm_up()
+            except Exception as e:
+                print(f"WARNING: Failed to start password hashing workers: {e}")
+        
+        if not os.getenv(STARTUP_DONE_ENV):
+            _startup_step("run startup once", run_startup_once)
+        
+        with startup_profile.step("index Cloud Run services"):
+            try:
+                get_cloud_run().sweep()
+            except Exception as e:
+                print(f"WARNING: Failed to list Cloud Run services (indexed on first use): {e}")
+        
+        _startup_step("resume queued jobs", _resume_queued_jobs)
+        _startup_step("start lab cache listener", lambda: get_lab_cache().start_listener())
+        _startup_step("start credential cache listener", lambda: get_credential_cache().start_listener())
+        _startup_step("wait for secrets", _wait_for_secrets)
+        # Per process: threads do not survive the fork from the gunicorn master
+        _startup_step("start secret refresher", lambda: get_secret_store().start_refresher())
+        _startup_step("start mail outbox", lambda: get_mail_outbox().start())
+        _startup_step("start lab reaper", lambda: get_lab_reaper().start())
+        _startup_step("start warm pool", lambda: get_warm_pool().start())
+    finally:
+        # Ready even after a failed step: /healthz reports it, and secrets are checked separately
+        _startup_done.set()
+        startup_profile.report("worker startup")
+
+@app.on_event("startup")
+def startup_event():
+    """Start secret fetches and per-process startup in the background so the server listens immediately."""
+    get_secret_store().prefetch()
+    threading.Thread(target=_background_startup, name="startup", daemon=True).start()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Start background tasks that run on the event loop."""
+    global _metrics_sampler
+    get_dns_prober().start()
+    if METRICS_SAMPLE_SECONDS > 0:
+        _metrics_sampler = asyncio.create_task(_sample_metrics())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background work and release shared Google Cloud clients."""
+    await get_dns_prober().stop()
+    if _metrics_sampler is not None:
+        _metrics_sampler.cancel()
+    get_lab_cache().stop_listener()
+    get_credential_cache().stop_listener()
+    get_secret_store().stop_refresher()
+    get_mail_outbox().stop()
+    get_lab_reaper().stop()
+    get_warm_pool().stop()
+    shutdown_workers()
+    get_audit_writer().shutdown()
+    hashing.shutdown()
+    await close_async_clients()
+    close_clients()
@@ -0,0 +1,250 @@
+"""Prometheus metrics, served at /metrics.
+
+- lab_manager_http_request_duration_seconds{route,method,status}: route is
+  the matched route template ("/api/v1/labs/{lab_id}"), or "unmatched"
+- lab_manager_http_requests_in_flight
+- lab_manager_threadpool{pool,state}: busy/limit/waiting for the event
+  loop's worker threads (sync routes, run_in_threadpool) and the
+  provisioning pool
+- lab_manager_dependency_duration_seconds{dependency,operation,outcome}:
+  every call to Firestore, Cloud Run, IAM, Cloud DNS, Secret Manager, the
+  mail provider and the resolver, timed with timed() at the call site
+  (Firestore through instrument_firestore())
+- lab_manager_component_stat{component,stat}: the integer counters and
+  sizes of the stats() of caches and background workers
+
+Every label takes values from a fixed set in the code, never from paths,
+ids or error messages. Under app.server each worker writes its samples to
+PROMETHEUS_MULTIPROC_DIR and /metrics reads back the sum over all workers.
+"""
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Tuple
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+HTTP_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+REQUEST_LATENCY = Histogram(
+    "lab_manager_http_request_duration_seconds", "HTTP request latency (streamed responses until the last chunk)",
+    ["route", "method", "status"], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    "lab_manager_http_requests_in_flight", "HTTP requests being handled, including open event streams",
+    multiprocess_mode="livesum")
+THREADPOOL = Gauge(
+    "lab_manager_threadpool", "Worker threads busy, available and waited for, per pool",
+    ["pool", "state"], multiprocess_mode="livesum")
+DEPENDENCY_LATENCY = Histogram(
+    "lab_manager_dependency_duration_seconds", "Latency of calls to external services",
+    ["dependency", "operation", "outcome"], buckets=LATENCY_BUCKETS)
+COMPONENT_STAT = Gauge(
+    "lab_manager_component_stat", "Counters and sizes reported by in-process caches and workers",
+    ["component", "stat"], multiprocess_mode="livesum")
+
+class _Call:
+    __slots__ = ("outcome",)
+
+    def __init__(self):
+        self.outcome = "ok"
+
+@contextmanager
+def timed(dependency: str, operation: str) -> Iterator[_Call]:
+    """Time one external call; outcome is "error" if it raises (or if the caller sets call.outcome)."""
+    call = _Call()
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException:
+        call.outcome = "error"
+        raise
+    finally:
+        DEPENDENCY_LATENCY.labels(dependency, operation, call.outcome).observe(time.perf_counter() - started)
+
+# HTTP
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and in-flight requests by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # Set by the router on a match; CORS preflights and 404s never reach a route
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"] if scope["method"] in HTTP_METHODS else "other"
+            REQUEST_LATENCY.labels(route, method, str(status)).observe(time.perf_counter() - started)
+
+# Firestore
+
+# Set while a Firestore call is timed, so the RPCs it makes internally
+# (DocumentReference.set -> WriteBatch.commit) are not counted twice
+_in_firestore_call = contextvars.ContextVar("in_firestore_call", default=False)
+_firestore_instrumented = False
+
+def _time_firestore(operation: str, fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _in_firestore_call.get():
+            return fn(*args, **kwargs)
+        token = _in_firestore_call.set(True)
+        try:
+            with timed("firestore", operation):
+                return fn(*args, **kwargs)
+        finally:
+            _in_firestore_call.reset(token)
+    return wrapper
+
+def _time_firestore_async(operation: str, fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if _in_firestore_call.get():
+            return await fn(*args, **kwargs)
+        token = _in_firestore_call.set(True)
+        try:
+            with timed("firestore", operation):
+                return await fn(*args, **kwargs)
+        finally:
+            _in_firestore_call.reset(token)
+    return wrapper
+
+def _time_firestore_stream(fn: Callable) -> Callable:
+    """Query.stream(): the time spent fetching results, not the caller's work between them."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        def results():
+            iterator = iter(fn(*args, **kwargs))
+            spent, outcome = 0.0, "ok"
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    except BaseException:
+                        outcome = "error"
+                        raise
+                    finally:
+                        spent += time.perf_counter() - started
+                    yield item
+            finally:
+                DEPENDENCY_LATENCY.labels("firestore", "query", outcome).observe(spent)
+        return results()
+    return wrapper
+
+def _time_firestore_stream_async(fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        async def results():
+            iterator = fn(*args, **kwargs).__aiter__()
+            spent, outcome = 0.0, "ok"
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    except BaseException:
+                        outcome = "error"
+                        raise
+                    finally:
+                        spent += time.perf_counter() - started
+                    yield item
+            finally:
+                DEPENDENCY_LATENCY.labels("firestore", "query", outcome).observe(spent)
+        return results()
+    return wrapper
+
+def instrument_firestore() -> None:
+    """Time document reads and writes, queries, batches and transaction RPCs of both Firestore clients."""
+    global _firestore_instrumented
+    if _firestore_instrumented:
+        return
+    _firestore_instrumented = True
+    from google.cloud.firestore_v1 import (
+        async_batch, async_collection, async_document, async_query, async_transaction,
+        batch, collection, document, query, transaction
+    )
+    for operation in ("get", "set", "update", "delete", "create"):
+        setattr(document.DocumentReference, operation,
+                _time_firestore(operation, getattr(document.DocumentReference, operation)))
+        setattr(async_document.AsyncDocumentReference, operation,
+                _time_firestore_async(operation, getattr(async_document.AsyncDocumentReference, operation)))
+    collection.CollectionReference.add = _time_firestore("add", collection.CollectionReference.add)
+    async_collection.AsyncCollectionReference.add = _time_firestore_async(
+        "add", async_collection.AsyncCollectionReference.add)
+    # Collection and query get() go through stream()
+    query.Query.stream = _time_firestore_stream(query.Query.stream)
+    async_query.AsyncQuery.stream = _time_firestore_stream_async(async_query.AsyncQuery.stream)
+    batch.WriteBatch.commit = _time_firestore("batch_commit", batch.WriteBatch.commit)
+    async_batch.AsyncWriteBatch.commit = _time_firestore_async("batch_commit", async_batch.AsyncWriteBatch.commit)
+    for name, operation in (("_begin", "transaction_begin"), ("_commit", "transaction_commit"),
+                            ("_rollback", "transaction_rollback")):
+        setattr(transaction.Transaction, name, _time_firestore(operation, getattr(transaction.Transaction, name)))
+        setattr(async_transaction.AsyncTransaction, name,
+                _time_firestore_async(operation, getattr(async_transaction.AsyncTransaction, name)))
+
+# Sampled gauges
+
+_components: Dict[str, Callable[[], Dict]] = {}
+_threadpools: Dict[str, Callable[[], Dict]] = {}
+
+def register_component(name: str, stats: Callable[[], Dict]) -> None:
+    """Export the integer fields of stats() (rates, averages and nested maps are left to the admin API)."""
+    _components[name] = stats
+
+def register_threadpool(name: str, stats: Callable[[], Dict]) -> None:
+    """Export a pool's occupancy; stats() returns {"busy", "limit", "waiting"}."""
+    _threadpools[name] = stats
+
+def _anyio_threadpool() -> Dict:
+    import anyio.to_thread
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {"busy": limiter.borrowed_tokens, "limit": limiter.total_tokens,
+            "waiting": limiter.statistics().tasks_waiting}
+
+def sample() -> None:
+    """Refresh the threadpool and component gauges of this process; call from the event loop."""
+    for name, stats in [("anyio", _anyio_threadpool)] + list(_threadpools.items()):
+        for state, value in stats().items():
+            THREADPOOL.labels(name, state).set(value)
+    for name, stats in list(_components.items()):
+        try:
+            values = stats()
+        except Exception as e:
+            print(f"WARNING: Metrics sampling of {name} stats failed: {e}")
+            continue
+        for key, value in values.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                COMPONENT_STAT.labels(name, key).set(value)
+
+def render() -> Tuple[bytes, str]:
+    """The exposition of every worker (or of this process outside app.server) and its content type."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,203 @@
+"""Mail outbox: durable, retried email delivery off the request path.
+
+Request handlers never call the mail provider. They write an outbox
+document (outbox_message()), in the same batch as the document it belongs
+to where there is one, and wake the local worker. Each process runs one
+MailOutbox worker that claims due messages transactionally and delivers
+them through app.mail with the message id as the idempotency key, so a
+delivery retried after a lost response is not sent twice.
+
+next_attempt_at drives the queue: due messages have it in the past, a claim
+pushes it out by MAIL_OUTBOX_LEASE_SECONDS (a message whose worker died is
+picked up again after the lease), failures back off exponentially, and it
+is removed once a message is sent or has failed MAIL_OUTBOX_MAX_ATTEMPTS
+times. A message's "ref" names a document (e.g. invites/<id>) whose
+email_sent flag is set on delivery.
+"""
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, Optional
+from google.cloud import firestore
+from app import mail
+from app.auth import get_db
+from app.config import (
+    MAIL_OUTBOX_COLLECTION, MAIL_OUTBOX_CONCURRENCY, MAIL_OUTBOX_POLL_SECONDS, MAIL_OUTBOX_LEASE_SECONDS,
+    MAIL_OUTBOX_MAX_ATTEMPTS, EMAIL_RETRY_BASE_SECONDS
+)
+from app.services import now_utc
+
+MAIL_PENDING = "pending"
+MAIL_SENDING = "sending"
+MAIL_SENT = "sent"
+MAIL_FAILED = "failed"
+# Due messages claimed per drain pass
+DRAIN_BATCH = 50
+MAX_BACKOFF_SECONDS = 600
+
+def outbox_message(message: Dict, ref: Optional[str] = None) -> Dict:
+    """Outbox document for a message built by app.services (e.g. invite_email_message())."""
+    now = now_utc()
+    return {
+        "state": MAIL_PENDING,
+        "message": message,
+        "ref": ref,
+        "attempts": 0,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+        "next_attempt_at": now,
+    }
+
+def retry_at(attempts: int):
+    """When to try a message again after its attempts-th failure (jittered exponential backoff)."""
+    delay = min(MAX_BACKOFF_SECONDS, EMAIL_RETRY_BASE_SECONDS * 2 ** attempts) * random.uniform(0.5, 1)
+    return now_utc() + timedelta(seconds=delay)
+
+@firestore.transactional
+def _claim(transaction, mail_ref, lease_until) -> Optional[Dict]:
+    """Lease a due message; returns None if it is not due or another worker owns it."""
+    snap = mail_ref.get(transaction=transaction)
+    if not snap.exists:
+        return None
+    data = snap.to_dict()
+    due = data.get("next_attempt_at")
+    if data.get("state") not in (MAIL_PENDING, MAIL_SENDING) or due is None or due > now_utc():
+        return None
+    transaction.update(mail_ref, {"state": MAIL_SENDING, "next_attempt_at": lease_until, "updated_at": now_utc()})
+    return data
+
+class MailOutbox:
+    def __init__(self, concurrency: int = MAIL_OUTBOX_CONCURRENCY, poll_seconds: float = MAIL_OUTBOX_POLL_SECONDS,
+                 lease_seconds: float = MAIL_OUTBOX_LEASE_SECONDS, max_attempts: int = MAIL_OUTBOX_MAX_ATTEMPTS):
+        self.concurrency = max(1, concurrency)
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stats = {"sent": 0, "failed": 0, "retried": 0, "claim_conflicts": 0, "drains": 0}
+
+    def _messages(self):
+        return get_db().collection(MAIL_OUTBOX_COLLECTION)
+
+    def enqueue(self, message: Dict, ref: Optional[str] = None) -> str:
+        """Queue a message on its own (prefer writing outbox_message() in the caller's batch)."""
+        mail_ref = self._messages().document()
+        mail_ref.set(outbox_message(message, ref))
+        self.wake()
+        return mail_ref.id
+
+    def wake(self) -> None:
+        """Drain now instead of at the next poll (call after committing outbox documents)."""
+        self._wakeup.set()
+
+    # Worker
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="mail-outbox")
+            self._thread = threading.Thread(target=self._run, name="mail-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stop the worker; claimed messages not yet delivered are retried after their lease."""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=timeout)
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                drained = self.drain()
+            except Exception as e:
+                print(f"WARNING: Mail outbox drain failed: {e}")
+                drained = 0
+            # A full pass means more messages are probably due
+            if drained < DRAIN_BATCH:
+                self._wakeup.wait(self.poll_seconds)
+
+    def drain(self) -> int:
+        """Claim and deliver the messages due now; returns how many were due."""
+        db = get_db()
+        now = now_utc()
+        lease_until = now + timedelta(seconds=self.lease_seconds)
+        due = list(self._messages().where("next_attempt_at", "<=", now)
+                   .order_by("next_attempt_at").limit(DRAIN_BATCH).stream())
+        claimed = []
+        for snap in due:
+            data = _claim(db.transaction(), snap.reference, lease_until)
+            if data is None:
+                self._count("claim_conflicts")
+            else:
+                claimed.append((snap.reference, data))
+        pool = self._pool
+        if pool is not None:
+            list(pool.map(lambda item: self._deliver(*item), claimed))
+        else:
+            for mail_ref, data in claimed:
+                self._deliver(mail_ref, data)
+        self._count("drains")
+        return len(due)
+
+    def _deliver(self, mail_ref, data: Dict) -> None:
+        attempts = data.get("attempts", 0) + 1
+        try:
+            # One attempt per claim: retries are rescheduled in Firestore rather than slept on
+            provider_id = mail.send(data["message"], idempotency_key=mail_ref.id, attempts=1)
+        except Exception as e:
+            # Anything but a retryable provider error (e.g. a malformed message) fails the message
+            if isinstance(e, mail.MailError) and e.retryable and attempts < self.max_attempts:
+                mail_ref.update({"state": MAIL_PENDING, "attempts": attempts, "error": str(e),
+                                 "next_attempt_at": retry_at(attempts), "updated_at": now_utc()})
+                self._count("retried")
+            else:
+                mail_ref.update({"state": MAIL_FAILED, "attempts": attempts, "error": str(e),
+                                 "next_attempt_at": firestore.DELETE_FIELD, "updated_at": now_utc()})
+                self._count("failed")
+                print(f"ERROR: Mail {mail_ref.id} failed after {attempts} attempt(s): {e}")
+            return
+        mail_ref.update({"state": MAIL_SENT, "attempts": attempts, "error": None, "provider_id": provider_id,
+                         "sent_at": now_utc(), "next_attempt_at": firestore.DELETE_FIELD, "updated_at": now_utc()})
+        self._count("sent")
+        if data.get("ref"):
+            try:
+                get_db().document(data["ref"]).update({"email_sent": True, "email_sent_at": now_utc()})
+            except Exception as e:
+                print(f"WARNING: Mail {mail_ref.id} sent but {data['ref']} was not updated: {e}")
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+_outbox: Optional[MailOutbox] = None
+_outbox_lock = threading.Lock()
+
+def get_mail_outbox() -> MailOutbox:
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = MailOutbox()
+    return _outbox
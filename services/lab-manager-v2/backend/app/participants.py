@@ -0,0 +1,87 @@
+"""Participant (active lab) listing for the admin dashboard.
+
+Queries select only the columns the endpoint returns, so the attack,
+victims and imperva maps of each lab are never read. Pages are cursor
+based; iter_participants() walks every page with one page in memory, for
+the streamed full listing.
+"""
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from google.cloud import firestore
+from app.audit import encode_cursor, decode_cursor
+from app.auth import get_db
+from app.config import LABS_COLLECTION
+
+PARTICIPANT_FIELDS = ["owner_email", "lab_name", "status", "created_at", "expires_at"]
+# Each needs a labs(status ASC, field ASC|DESC) composite index (firestore.tf)
+SORT_FIELDS = {"expires_at": "expires_at", "created_at": "created_at", "email": "owner_email"}
+PAGE_MAX = 500
+STREAM_PAGE_SIZE = 500
+
+def build_participants_query(sort: Optional[str] = None, order: str = "asc",
+                             expires_after: Optional[datetime] = None, expires_before: Optional[datetime] = None):
+    """Active labs, projected to PARTICIPANT_FIELDS, optionally sorted and filtered by expiry.
+
+    Expiry filters are range filters on expires_at, so they need sort=expires_at
+    (the default when one is given). Raises ValueError for unsupported options.
+    """
+    if sort is not None and sort not in SORT_FIELDS:
+        raise ValueError(f"sort must be one of: {', '.join(SORT_FIELDS)}")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+    if expires_after or expires_before:
+        if sort not in (None, "expires_at"):
+            raise ValueError("Expiry filters require sort=expires_at")
+        sort = "expires_at"
+
+    query = get_db().collection(LABS_COLLECTION).where("status", "==", "active")
+    if expires_after:
+        query = query.where("expires_at", ">=", expires_after)
+    if expires_before:
+        query = query.where("expires_at", "<", expires_before)
+    if sort:
+        direction = firestore.Query.DESCENDING if order == "desc" else firestore.Query.ASCENDING
+        query = query.order_by(SORT_FIELDS[sort], direction=direction)
+    return query.select(PARTICIPANT_FIELDS)
+
+def _start_after(query, cursor: Optional[str]):
+    if not cursor:
+        return query
+    snap = get_db().collection(LABS_COLLECTION).document(decode_cursor(cursor)).get(field_paths=PARTICIPANT_FIELDS)
+    if not snap.exists:
+        raise ValueError("Invalid cursor")
+    return query.start_after(snap)
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+def serialize_participant(lab_id: str, data: Dict) -> Dict:
+    return {
+        "email": data.get("owner_email"),
+        "lab_id": lab_id,
+        "lab_name": data.get("lab_name"),
+        "status": data.get("status"),
+        "created_at": _iso(data.get("created_at")),
+        "expires_at": _iso(data.get("expires_at")),
+    }
+
+def query_participants(limit: int = 100, cursor: Optional[str] = None, **options) -> Tuple[List[Dict], Optional[str]]:
+    """Return one page of participants and the cursor for the next page (None at the end)."""
+    query = _start_after(build_participants_query(**options), cursor).limit(limit)
+    docs = list(query.stream())
+    participants = [serialize_participant(doc.id, doc.to_dict()) for doc in docs]
+    next_cursor = encode_cursor(docs[-1].id) if len(docs) == limit else None
+    return participants, next_cursor
+
+def iter_participants(page_size: int = STREAM_PAGE_SIZE, **options) -> Iterator[Dict]:
+    """Yield every matching participant, one page in memory at a time."""
+    query = build_participants_query(**options)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.limit(page_size).stream())
+        for doc in docs:
+            yield serialize_participant(doc.id, doc.to_dict())
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
@@ -0,0 +1,280 @@
+"""Expired-lab reaper.
+
+get_lab_current() reports a lab as expired once expires_at has passed, but
+its attack-client Cloud Run service and per-lab CNAME keep running. Each
+reaper pass
+
+1. queries labs that expired more than REAPER_GRACE_SECONDS ago, oldest
+   first, through the labs(status, expires_at) index
+2. claims up to REAPER_BUDGET of them transactionally (status "reaping"
+   with a lease), so replicas reaping at the same time never share a lab
+   and a lab whose session was extended meanwhile is left alone
+3. deletes their Cloud Run services, REAPER_CONCURRENCY at a time
+4. removes their CNAMEs in one batched DNS change
+5. marks them expired, each in a transaction that checks the claim is
+   still this pass's
+
+A lab whose teardown fails keeps its "reaping" claim and is retried by a
+later pass once the lease runs out. Resets and extensions are refused
+while a lab is being reaped; a lab changed anyway since its claim is
+reported as superseded and not marked expired. A dry run stops after
+step 1 and reports what would be deleted.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
+from google.cloud import firestore
+from app.audit import log_audit_event
+from app.auth import get_db
+from app.config import (
+    LABS_COLLECTION, REAPER_INTERVAL_SECONDS, REAPER_BUDGET, REAPER_CONCURRENCY, REAPER_GRACE_SECONDS,
+    REAPER_LEASE_SECONDS, REAPER_DRY_RUN
+)
+from app.dns_changes import get_dns_batcher
+from app.events import get_event_hub
+from app.jobs import LAB_ACTIVE, LAB_EXPIRED, LAB_REAPING, service_name_for
+from app.lab_cache import get_lab_cache
+from app.services import delete_cloud_run_service, dns_record_name, now_utc
+
+REAP_FIELDS = ["owner_email", "status", "expires_at", "reap_lease_until", "attack.dns_hostname",
+               "attack.cloud_run_service"]
+
+# Teardown backends; swapped for fakes in tests.
+_backends: Dict[str, Callable] = {
+    "delete_service": delete_cloud_run_service,
+}
+
+def set_backends(delete_service: Optional[Callable] = None) -> None:
+    """Override the Cloud Run backend used by the reaper (DNS goes through set_dns_batcher())."""
+    if delete_service is not None:
+        _backends["delete_service"] = delete_service
+
+def _labs():
+    return get_db().collection(LABS_COLLECTION)
+
+def _candidate(snap) -> Dict:
+    data = snap.to_dict()
+    attack = data.get("attack") or {}
+    dns_hostname = attack.get("dns_hostname")
+    return {
+        "lab_id": snap.id,
+        "owner_email": data.get("owner_email"),
+        "expires_at": data.get("expires_at"),
+        # Labs given a warm pool service are bound to it by name
+        "service_name": attack.get("cloud_run_service") or service_name_for(snap.id),
+        "dns_record": dns_record_name(dns_hostname) if dns_hostname else None,
+    }
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+@firestore.transactional
+def _claim(transaction, lab_ref, cutoff, lease_until) -> bool:
+    """Mark an expired lab as being reaped; False if it was extended or another reaper holds it."""
+    snap = lab_ref.get(transaction=transaction)
+    if not snap.exists:
+        return False
+    data = snap.to_dict()
+    expires_at = data.get("expires_at")
+    if expires_at is None or expires_at >= cutoff:
+        return False
+    if data.get("status") == LAB_REAPING:
+        lease = data.get("reap_lease_until")
+        if lease is not None and lease > now_utc():
+            return False
+    elif data.get("status") != LAB_ACTIVE:
+        return False
+    transaction.update(lab_ref, {"status": LAB_REAPING, "reap_lease_until": lease_until})
+    return True
+
+@firestore.transactional
+def _mark_expired(transaction, lab_ref, cutoff, lease_until, owner_email: str, reaped_at) -> bool:
+    """Record a finished teardown; False if the lab was reset, extended or reclaimed since this pass claimed it."""
+    snap = lab_ref.get(transaction=transaction)
+    if not snap.exists:
+        return False
+    data = snap.to_dict()
+    if data.get("status") != LAB_REAPING or data.get("reap_lease_until") != lease_until:
+        return False
+    expires_at = data.get("expires_at")
+    if expires_at is None or expires_at >= cutoff:
+        return False
+    transaction.update(lab_ref, {
+        "status": LAB_EXPIRED,
+        "owner_status": f"{owner_email}|{LAB_EXPIRED}",
+        "attack.state": LAB_EXPIRED,
+        "reaped_at": reaped_at,
+        "reap_lease_until": firestore.DELETE_FIELD,
+    })
+    return True
+
+class LabReaper:
+    def __init__(self, interval_seconds: float = REAPER_INTERVAL_SECONDS, budget: int = REAPER_BUDGET,
+                 concurrency: int = REAPER_CONCURRENCY, grace_seconds: float = REAPER_GRACE_SECONDS,
+                 lease_seconds: float = REAPER_LEASE_SECONDS, dry_run: bool = REAPER_DRY_RUN):
+        self.interval_seconds = interval_seconds
+        self.budget = budget
+        self.concurrency = max(1, concurrency)
+        self.grace_seconds = grace_seconds
+        self.lease_seconds = lease_seconds
+        self.dry_run = dry_run
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # One pass at a time per process (the background loop and admin-triggered runs)
+        self._run_lock = threading.Lock()
+        self._stats = {"runs": 0, "reaped": 0, "failed": 0, "services_deleted": 0, "dns_deleted": 0,
+                       "last_run_at": None, "last_run_ms": 0.0}
+
+    # Worker
+
+    def start(self) -> None:
+        if self.interval_seconds <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="lab-reaper", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stop the loop; a pass in progress finishes its current step, unfinished claims are retried after the lease."""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=timeout)
+        with self._lock:
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval_seconds):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"WARNING: Lab reaper pass failed: {e}")
+
+    # Passes
+
+    def find_expired(self, limit: int) -> List[Dict]:
+        """Labs past expiry and grace that are active or have a reaping claim, oldest first."""
+        cutoff = now_utc() - timedelta(seconds=self.grace_seconds)
+        query = (_labs().where("status", "in", [LAB_ACTIVE, LAB_REAPING])
+                 .where("expires_at", "<", cutoff)
+                 .order_by("expires_at")
+                 .select(REAP_FIELDS)
+                 .limit(limit))
+        return [_candidate(snap) for snap in query.stream()]
+
+    def run_once(self, dry_run: Optional[bool] = None, budget: Optional[int] = None) -> Dict:
+        """Reap up to budget expired labs; returns a report of what was (or would be) done."""
+        dry_run = self.dry_run if dry_run is None else dry_run
+        budget = self.budget if budget is None else budget
+        with self._run_lock:
+            started = time.monotonic()
+            report = self._reap(dry_run, max(0, budget))
+            report["duration_ms"] = round((time.monotonic() - started) * 1000.0, 1)
+        if not dry_run:
+            with self._lock:
+                stats = self._stats
+                stats["runs"] += 1
+                stats["reaped"] += len(report["reaped"])
+                stats["failed"] += len(report["failed"])
+                stats["services_deleted"] += report["services_deleted"]
+                stats["dns_deleted"] += report["dns_deleted"]
+                stats["last_run_at"] = now_utc().isoformat()
+                stats["last_run_ms"] = report["duration_ms"]
+            if report["reaped"] or report["failed"]:
+                print(f"✓ Lab reaper: {len(report['reaped'])} reaped, {len(report['failed'])} failed "
+                      f"in {report['duration_ms']:.0f}ms")
+        return report
+
+    def _reap(self, dry_run: bool, budget: int) -> Dict:
+        report = {"dry_run": dry_run, "candidates": [], "reaped": [], "skipped": [], "superseded": [], "failed": {},
+                  "services_deleted": 0, "services_missing": 0, "dns_deleted": 0}
+        if budget == 0:
+            return report
+        # Over-fetch: labs another replica is reaping right now do not count against the budget
+        candidates = self.find_expired(budget if dry_run else budget * 2)
+        if dry_run:
+            report["candidates"] = [{**c, "expires_at": _iso(c["expires_at"])} for c in candidates[:budget]]
+            return report
+
+        db = get_db()
+        cutoff = now_utc() - timedelta(seconds=self.grace_seconds)
+        lease_until = now_utc() + timedelta(seconds=self.lease_seconds)
+        claimed: List[Dict] = []
+        for candidate in candidates:
+            if len(claimed) >= budget:
+                break
+            if _claim(db.transaction(), _labs().document(candidate["lab_id"]), cutoff, lease_until):
+                claimed.append(candidate)
+            else:
+                report["skipped"].append(candidate["lab_id"])
+        report["candidates"] = [c["lab_id"] for c in claimed]
+        if not claimed:
+            return report
+
+        # 1. Cloud Run services, bounded fan-out
+        def delete(candidate: Dict):
+            try:
+                return candidate, _backends["delete_service"](candidate["service_name"]), None
+            except Exception as e:
+                return candidate, None, e
+
+        done: List[Dict] = []
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(claimed)), thread_name_prefix="reaper") as pool:
+            for candidate, deleted, error in pool.map(delete, claimed):
+                if error is not None:
+                    print(f"WARNING: Reaper failed to delete {candidate['service_name']}: {error}")
+                    report["failed"][candidate["lab_id"]] = f"delete_service: {error}"
+                    continue
+                report["services_deleted" if deleted else "services_missing"] += 1
+                done.append(candidate)
+
+        # 2. DNS records, one batched change
+        deletions = [{"action": "delete", "name": c["dns_record"], "type": "CNAME"} for c in done if c["dns_record"]]
+        if deletions:
+            outcomes = dict(zip((d["name"] for d in deletions), get_dns_batcher().apply(deletions)))
+            for candidate in list(done):
+                outcome = outcomes.get(candidate["dns_record"])
+                if outcome is not None and outcome.startswith("error"):
+                    report["failed"][candidate["lab_id"]] = f"delete_dns: {outcome}"
+                    done.remove(candidate)
+                elif outcome == "deleted":
+                    report["dns_deleted"] += 1
+
+        # 3. Lab status, only where this pass's claim still stands
+        now = now_utc()
+        for candidate in done:
+            lab_ref = _labs().document(candidate["lab_id"])
+            if _mark_expired(db.transaction(), lab_ref, cutoff, lease_until, candidate["owner_email"], now):
+                get_lab_cache().invalidate(candidate["lab_id"])
+                get_event_hub().refresh(candidate["lab_id"])
+                report["reaped"].append(candidate["lab_id"])
+                log_audit_event(candidate["owner_email"], "SYSTEM", "lab_reaped", candidate["lab_id"], "success",
+                                {"service_name": candidate["service_name"], "dns_record": candidate["dns_record"]})
+            else:
+                print(f"WARNING: Lab {candidate['lab_id']} changed while being reaped; not marked expired")
+                report["superseded"].append(candidate["lab_id"])
+        return report
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        stats["dry_run"] = self.dry_run
+        return stats
+
+_reaper: Optional[LabReaper] = None
+_reaper_lock = threading.Lock()
+
+def get_lab_reaper() -> LabReaper:
+    global _reaper
+    if _reaper is None:
+        with _reaper_lock:
+            if _reaper is None:
+                _reaper = LabReaper()
+    return _reaper
@@ -1,205 +1,311 @@
 """Admin routes."""
+import asyncio
+import csv
+import io
+import json
+from datetime import datetime
 from typing import Dict, Optional, List
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from google.cloud import firestore
-from app.auth import get_current_user, get_db
-from app.config import LABS_COLLECTION, INVITES_COLLECTION, AUDIT_LOGS_COLLECTION
-from app.services import send_invite_email, now_utc
+from app.audit import log_audit_event, query_audit_logs, iter_audit_logs
+from app.auth import get_current_user, get_async_db
+from app.credential_cache import get_credential_cache
+from app.config import INVITES_COLLECTION, MAIL_OUTBOX_COLLECTION, FIRESTORE_TIMEOUT_SECONDS
+from app.invites import get_invite_job, iter_invite_events, start_bulk_invite
+from app.jobs import provision_labs_bulk
+from app.participants import (
+    PAGE_MAX as PARTICIPANTS_PAGE_MAX, build_participants_query, iter_participants, query_participants
+)
+from app.outbox import get_mail_outbox, outbox_message
+from app.reaper import get_lab_reaper
+from app.services import invite_email_message, now_utc
+from app.warm_pool import get_warm_pool
+from app.tokens import get_claims_cache, get_key_ring
 
 router = APIRouter(prefix="/api/v1/admin", tags=["admin"])
 
-def require_admin(user: Dict = Depends(get_current_user)) -> Dict:
+AUDIT_PAGE_MAX = 500
+
+async def require_admin(user: Dict = Depends(get_current_user)) -> Dict:
     """Require admin role."""
     if user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Forbidden")
     return user
 
-def log_audit_event(actor_email: str, actor_role: str, action: str, target: str = None, status: str = "success", details: dict = None):
-    """Log audit event."""
-    try:
-        db = get_db()
-        db.collection(AUDIT_LOGS_COLLECTION).add({
-            "timestamp": now_utc(),
-            "actor_email": actor_email,
-            "actor_role": actor_role,
-            "action": action,
-            "target": target,
-            "status": status,
-            "details": details or {},
-        })
-    except Exception as e:
-        print(f"WARNING: Failed to log audit event: {e}")
-
 class InviteParticipantRequest(BaseModel):
     email: str
 
 class InviteBulkRequest(BaseModel):
     participants: List[Dict]
 
+class WarmPoolRequest(BaseModel):
+    low: int
+    high: int
+
+class ProvisionBulkRequest(BaseModel):
+    participants: List[Dict]
+    concurrency: Optional[int] = None
+    expires_in_hours: Optional[float] = None
+
 @router.get("/participants")
-def get_participants(user: Dict = Depends(require_admin)):
-    """Get all participants."""
-    db = get_db()
-    labs = db.collection(LABS_COLLECTION).where("status", "==", "active").stream()
-    participants = []
-    for lab in labs:
-        data = lab.to_dict()
-        created_at = data.get("created_at")
-        expires_at = data.get("expires_at")
-        participants.append({
-            "email": data.get("owner_email"),
-            "lab_id": lab.id,
-            "lab_name": data.get("lab_name"),
-            "status": data.get("status"),
-            "created_at": created_at.isoformat() if hasattr(created_at, 'isoformat') else str(created_at),
-            "expires_at": expires_at.isoformat() if hasattr(expires_at, 'isoformat') else str(expires_at),
-        })
-    return {"participants": participants}
+async def get_participants(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    expires_after: Optional[datetime] = None,
+    expires_before: Optional[datetime] = None,
+    user: Dict = Depends(require_admin),
+):
+    """Active participants, projected to the returned columns.
+
+    With limit, returns one page and next_cursor. Without it, streams every
+    participant as one JSON document, reading one page of labs at a time.
+    """
+    options = {"sort": sort, "order": order, "expires_after": expires_after, "expires_before": expires_before}
+    try:
+        if limit is not None:
+            participants, next_cursor = await asyncio.to_thread(
+                query_participants, limit=max(1, min(limit, PARTICIPANTS_PAGE_MAX)), cursor=cursor, **options
+            )
+            return {"participants": participants, "next_cursor": next_cursor}
+        build_participants_query(**options)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(_json_list("participants", iter_participants(**options)), media_type="application/json")
+
+def _json_list(key: str, items):
+    """Stream {key: [...], "next_cursor": null} without holding the list in memory."""
+    yield f'{{"{key}": ['
+    for i, item in enumerate(items):
+        yield ("," if i else "") + json.dumps(item, default=str)
+    yield '], "next_cursor": null}'
 
 @router.get("/users")
-def get_users(user: Dict = Depends(require_admin)):
+async def get_users(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    expires_after: Optional[datetime] = None,
+    expires_before: Optional[datetime] = None,
+    user: Dict = Depends(require_admin),
+):
     """Alias for participants."""
-    return get_participants(user)
+    return await get_participants(limit, cursor, sort, order, expires_after, expires_before, user)
 
 @router.get("/admins")
-def get_admins(user: Dict = Depends(require_admin)):
+async def get_admins(user: Dict = Depends(require_admin)):
     """Get admins."""
     return {"admins": []}
 
 @router.get("/profile")
-def get_profile(user: Dict = Depends(require_admin)):
+async def get_profile(user: Dict = Depends(require_admin)):
     """Get admin profile."""
     return {"email": user["email"], "display_name": "Admin", "notes": ""}
 
 @router.put("/profile")
-def update_profile(body: Dict, user: Dict = Depends(require_admin)):
+async def update_profile(body: Dict, user: Dict = Depends(require_admin)):
     """Update admin profile."""
     return {"ok": True}
 
+@router.get("/auth-cache/stats")
+async def get_auth_cache_stats(user: Dict = Depends(require_admin)):
+    """Login and token cache hit rates, sizes and evictions."""
+    return {
+        "credentials": get_credential_cache().stats(),
+        "tokens": get_claims_cache().stats(),
+        "signing_keys": {"active": get_key_ring().active_kid, "kids": get_key_ring().kids()},
+    }
+
 @router.get("/audit-logs")
-def get_audit_logs(limit: int = 50, role_filter: Optional[str] = None, search: Optional[str] = None, user: Dict = Depends(require_admin)):
-    """Get audit logs."""
-    db = get_db()
-    logs = db.collection(AUDIT_LOGS_COLLECTION)
-    
-    query = logs.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limit)
-    
-    if role_filter and role_filter.upper() in ["ADMIN", "STUDENT", "PARTICIPANT", "SYSTEM"]:
-        query = query.where("actor_role", "==", role_filter.upper())
-    
-    log_docs = list(query.stream())
-    audit_logs = []
+async def get_audit_logs(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    role_filter: Optional[str] = None,
+    search: Optional[str] = None,
+    actor: Optional[str] = None,
+    action: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    user: Dict = Depends(require_admin),
+):
+    """Get audit logs, newest first, with cursor pagination and server-side filters."""
+    limit = max(1, min(limit, AUDIT_PAGE_MAX))
+    try:
+        logs, next_cursor = await asyncio.to_thread(
+            query_audit_logs, limit=limit, cursor=cursor, actor=actor, action=action, status=status,
+            role=role_filter, search=search, since=since, until=until,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"logs": logs, "next_cursor": next_cursor}
+
+@router.get("/audit-logs/export")
+async def export_audit_logs(
+    format: str = "ndjson",
+    role_filter: Optional[str] = None,
+    search: Optional[str] = None,
+    actor: Optional[str] = None,
+    action: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    user: Dict = Depends(require_admin),
+):
+    """Stream matching audit logs as NDJSON or CSV without loading them into memory."""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    logs = iter_audit_logs(actor=actor, action=action, status=status, role=role_filter,
+                           search=search, since=since, until=until)
     
-    for doc in log_docs:
-        data = doc.to_dict()
-        
-        if search:
-            search_lower = search.lower()
-            if not any(
-                search_lower in str(data.get("actor_email", "")).lower() or
-                search_lower in str(data.get("action", "")).lower() or
-                search_lower in str(data.get("target", "")).lower() or
-                search_lower in str(data.get("status", "")).lower()
-                for _ in [None]
-            ):
-                continue
-        
-        timestamp = data.get("timestamp")
-        if hasattr(timestamp, 'isoformat'):
-            timestamp = timestamp.isoformat()
-        elif hasattr(timestamp, 'seconds'):
-            from datetime import datetime, timezone
-            timestamp = datetime.fromtimestamp(timestamp.seconds, tz=timezone.utc).isoformat()
-        
-        audit_logs.append({
-            "id": doc.id,
-            "timestamp": timestamp,
-            "role": data.get("actor_role", "UNKNOWN"),
-            "actor": data.get("actor_email", "unknown"),
-            "action": data.get("action", "unknown"),
-            "target": data.get("target", ""),
-            "status": data.get("status", "unknown"),
-            "details": data.get("details", {}),
-        })
+    if format == "ndjson":
+        body = (json.dumps(log, default=str) + "\n" for log in logs)
+        media_type = "application/x-ndjson"
+    else:
+        body = _csv_rows(logs)
+        media_type = "text/csv"
     
-    return {"logs": audit_logs}
+    log_audit_event(user["email"], "ADMIN", "export_audit_logs", format, "success")
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="audit-logs.{format}"'},
+    )
+
+def _csv_rows(logs):
+    columns = ["id", "timestamp", "role", "actor", "action", "target", "status", "details"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    for log in logs:
+        log = dict(log, details=json.dumps(log.get("details") or {}, default=str))
+        writer.writerow([log.get(column, "") for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
 
 @router.post("/participants/invite")
-def invite_participant(req: InviteParticipantRequest, user: Dict = Depends(require_admin)):
-    """Invite a participant."""
+async def invite_participant(req: InviteParticipantRequest, user: Dict = Depends(require_admin)):
+    """Invite a participant; the email is queued in the mail outbox and sent in the background."""
     email = req.email.strip().lower()
     if not email or "@" not in email:
         raise HTTPException(status_code=400, detail="Invalid email address")
     
     try:
-        email_sent = send_invite_email(email)
-        db = get_db()
-        db.collection(INVITES_COLLECTION).add({
+        db = get_async_db()
+        invite_ref = db.collection(INVITES_COLLECTION).document()
+        mail_ref = db.collection(MAIL_OUTBOX_COLLECTION).document()
+        # One commit: the invite is never recorded without its queued email, or vice versa
+        batch = db.batch()
+        batch.set(invite_ref, {
             "email": email,
             "invited_by": user["email"],
             "invited_at": now_utc(),
             "status": "pending",
-            "email_sent": email_sent,
+            "email_sent": False,
+            "mail_id": mail_ref.id,
         })
-        log_audit_event(user["email"], "ADMIN", "invite_participant", email, "success" if email_sent else "partial")
-        return {"success": True, "email_sent": email_sent}
+        batch.set(mail_ref, outbox_message(invite_email_message(email), ref=f"{INVITES_COLLECTION}/{invite_ref.id}"))
+        await batch.commit(timeout=FIRESTORE_TIMEOUT_SECONDS)
+        get_mail_outbox().wake()
+        log_audit_event(user["email"], "ADMIN", "invite_participant", email, "success", {"mail_id": mail_ref.id})
+        return {"success": True, "email_sent": False, "email_queued": True, "mail_id": mail_ref.id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to invite: {str(e)}")
 
-@router.post("/participants/invite-bulk")
-def invite_participants_bulk(req: InviteBulkRequest, user: Dict = Depends(require_admin)):
-    """Bulk invite participants."""
+@router.post("/participants/invite-bulk", status_code=202)
+async def invite_participants_bulk(req: InviteBulkRequest, user: Dict = Depends(require_admin)):
+    """Start a bulk invite job; poll its status or stream its NDJSON progress events."""
     if not req.participants:
         raise HTTPException(status_code=400, detail="No participants provided")
     
-    db = get_db()
-    invites = db.collection(INVITES_COLLECTION)
-    success_count = 0
-    email_sent_count = 0
-    errors = []
-    
-    for idx, participant in enumerate(req.participants):
-        try:
-            email = (participant.get("email") or "").strip().lower()
-            if not email or "@" not in email:
-                errors.append(f"Participant {idx + 1}: Invalid email")
-                continue
-            
-            name = participant.get("name")
-            email_sent = send_invite_email(email, name)
-            if email_sent:
-                email_sent_count += 1
-            
-            invites.add({
-                "email": email,
-                "name": name,
-                "invited_by": user["email"],
-                "invited_at": now_utc(),
-                "status": "pending",
-                "email_sent": email_sent,
-            })
-            success_count += 1
-        except Exception as e:
-            errors.append(f"Error processing participant {idx + 1}: {str(e)}")
-    
-    result = {
-        "success": success_count > 0,
-        "count": success_count,
-        "emails_sent": email_sent_count,
-        "total_requested": len(req.participants)
+    job = await asyncio.to_thread(start_bulk_invite, req.participants, user["email"])
+    log_audit_event(user["email"], "ADMIN", "invite_participants_bulk", f"{len(req.participants)} participants",
+                    "queued", {"job_id": job["job_id"]})
+    return {
+        "success": True,
+        "job_id": job["job_id"],
+        "count": len(req.participants),
+        "total_requested": len(req.participants),
+        "status_url": f"{router.prefix}/participants/invite-bulk/{job['job_id']}",
+        "events_url": f"{router.prefix}/participants/invite-bulk/{job['job_id']}/events",
     }
+
+@router.get("/participants/invite-bulk/{job_id}")
+async def get_bulk_invite_job(job_id: str, user: Dict = Depends(require_admin)):
+    """Status and counts of a bulk invite job (from any replica)."""
+    job = await asyncio.to_thread(get_invite_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/participants/invite-bulk/{job_id}/events")
+async def stream_bulk_invite_job(job_id: str, user: Dict = Depends(require_admin)):
+    """NDJSON progress events of a bulk invite job, replayed from the start."""
+    events = await asyncio.to_thread(iter_invite_events, job_id)
+    if events is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse((json.dumps(event, default=str) + "\n" for event in events),
+                             media_type="application/x-ndjson")
+
+@router.post("/participants/provision-bulk")
+async def provision_participants_bulk(req: ProvisionBulkRequest, user: Dict = Depends(require_admin)):
+    """Pre-create labs for a roster; streams NDJSON progress events."""
+    if not req.participants:
+        raise HTTPException(status_code=400, detail="No participants provided")
+    
+    emails = []
+    seen = set()
+    for participant in req.participants:
+        email = (participant.get("email") or "").strip().lower()
+        if email and "@" in email and email not in seen:
+            seen.add(email)
+            emails.append(email)
+    if not emails:
+        raise HTTPException(status_code=400, detail="No valid participant emails provided")
     
-    if errors:
-        result["errors"] = errors
-        result["error_count"] = len(errors)
+    log_audit_event(user["email"], "ADMIN", "provision_participants_bulk", f"{len(emails)} participants", "queued")
     
-    log_audit_event(user["email"], "ADMIN", "invite_participants_bulk", f"{len(req.participants)} participants", "success" if success_count > 0 else "error", result)
+    def stream():
+        for event in provision_labs_bulk(emails, req.concurrency, req.expires_in_hours):
+            yield json.dumps(event) + "\n"
     
-    return result
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@router.post("/labs/reap")
+async def reap_expired_labs(dry_run: bool = True, budget: Optional[int] = None, user: Dict = Depends(require_admin)):
+    """Run an expired-lab reaper pass now; dry_run (the default) only lists what would be deleted."""
+    if budget is not None and budget < 0:
+        raise HTTPException(status_code=400, detail="budget must be >= 0")
+    report = await asyncio.to_thread(get_lab_reaper().run_once, dry_run, budget)
+    if not dry_run:
+        log_audit_event(user["email"], "ADMIN", "reap_expired_labs", f"{len(report['reaped'])} labs",
+                        "error" if report["failed"] else "success", {"failed": report["failed"]})
+    return {**report, "stats": get_lab_reaper().stats()}
+
+@router.get("/warm-pool")
+async def get_warm_pool_status(user: Dict = Depends(require_admin)):
+    """Warm pool watermarks, ready/creating services, hit rate and claim latency."""
+    return await asyncio.to_thread(get_warm_pool().status)
+
+@router.put("/warm-pool")
+async def update_warm_pool(req: WarmPoolRequest, user: Dict = Depends(require_admin)):
+    """Set the warm pool watermarks (0 / 0 disables the pool); a refill starts right away."""
+    try:
+        watermarks = await asyncio.to_thread(get_warm_pool().set_watermarks, req.low, req.high, user["email"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    log_audit_event(user["email"], "ADMIN", "update_warm_pool", f"{req.low}-{req.high}", "success", watermarks)
+    return await asyncio.to_thread(get_warm_pool().status)
 
 @router.post("/admins/invite")
-def invite_admin(req: InviteParticipantRequest, user: Dict = Depends(require_admin)):
+async def invite_admin(req: InviteParticipantRequest, user: Dict = Depends(require_admin)):
     """Invite an admin."""
     email = req.email.strip().lower()
     if not email or "@" not in email:
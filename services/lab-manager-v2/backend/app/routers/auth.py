@@ -1,74 +1,44 @@
 """Authentication routes."""
+import asyncio
 from datetime import timedelta
 from fastapi import APIRouter, HTTPException
 from google.cloud import firestore
-from app.auth import LoginRequest, LoginResponse, create_token, authenticate_user, get_db, TOKEN_EXPIRE_HOURS
-from app.config import LABS_COLLECTION, INVITES_COLLECTION, AUDIT_LOGS_COLLECTION, AIR_ORIGIN_HOSTNAME
-from app.services import stable_lab_id_from_email, create_cloud_run_service, create_dns_record, make_dns_hostname, now_utc
+from app.audit import log_audit_event
+from app.auth import LoginRequest, LoginResponse, create_token, authenticate_user, get_async_db, TOKEN_EXPIRE_HOURS
+from app.config import LABS_COLLECTION, INVITES_COLLECTION, FIRESTORE_TIMEOUT_SECONDS
+from app.jobs import start_lab_provisioning
+from app.lab_cache import get_lab_cache
+from app.services import stable_lab_id_from_email, now_utc
 
 router = APIRouter(prefix="/api/v1/auth", tags=["auth"])
 
-def log_audit_event(actor_email: str, actor_role: str, action: str, target: str = None, status: str = "success", details: dict = None):
-    """Log audit event."""
-    try:
-        db = get_db()
-        db.collection(AUDIT_LOGS_COLLECTION).add({
-            "timestamp": now_utc(),
-            "actor_email": actor_email,
-            "actor_role": actor_role,
-            "action": action,
-            "target": target,
-            "status": status,
-            "details": details or {},
-        })
-    except Exception as e:
-        print(f"WARNING: Failed to log audit event: {e}")
-
 @router.post("/login", response_model=LoginResponse)
-def login(request: LoginRequest):
+async def login(request: LoginRequest):
     """Authenticate user and return token."""
-    user = authenticate_user(request.email, request.password)
+    user = await authenticate_user(request.email, request.password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     token = create_token(user["email"], user["role"])
     lab_id = stable_lab_id_from_email(user["email"])
     
-    # For students, ensure lab exists
+    # For students, ensure lab exists; provisioning runs on the job worker pool
+    provisioning_job_id = None
     if user["role"] == "student":
-        db = get_db()
+        db = get_async_db()
         lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
-        lab_doc = lab_ref.get()
+        lab_doc = await lab_ref.get(timeout=FIRESTORE_TIMEOUT_SECONDS)
         
         if not lab_doc.exists:
             try:
-                dns_hostname = make_dns_hostname(request.email, scenario_id="air")
-                service_name = f"attack-client-{lab_id.lower()}"
-                cloud_run_url = create_cloud_run_service(service_name, dns_hostname)
-                create_dns_record(dns_hostname, AIR_ORIGIN_HOSTNAME)
-                
-                session_expires = now_utc() + timedelta(hours=TOKEN_EXPIRE_HOURS)
-                lab_ref.set({
-                    "lab_name": lab_id,
-                    "owner_email": user["email"],
-                    "status": "active",
-                    "owner_status": f"{user['email']}|active",
-                    "created_at": now_utc(),
-                    "expires_at": session_expires,
-                    "attack": {
-                        "state": "ready",
-                        "cloud_run_service": service_name,
-                        "cloud_run_url": cloud_run_url,
-                        "dns_hostname": dns_hostname,
-                    },
-                    "victims": {},
-                    "imperva": {},
-                })
-                log_audit_event(user["email"], "STUDENT", "lab_created", lab_id, "success")
+                job = await asyncio.to_thread(start_lab_provisioning, user["email"], kind="create")
+                provisioning_job_id = job["job_id"]
+                log_audit_event(user["email"], "STUDENT", "lab_created", lab_id,
+                                "attached" if job.get("attached") else "queued", {"job_id": provisioning_job_id})
             except Exception as e:
-                print(f"Warning: Failed to create lab resources: {e}")
+                print(f"Warning: Failed to queue lab provisioning: {e}")
                 session_expires = now_utc() + timedelta(hours=TOKEN_EXPIRE_HOURS)
-                lab_ref.set({
+                await lab_ref.set({
                     "lab_name": lab_id,
                     "owner_email": user["email"],
                     "status": "active",
@@ -77,7 +47,8 @@ def login(request: LoginRequest):
                     "attack": {"state": "error", "error": str(e)},
                     "victims": {},
                     "imperva": {},
-                })
+                }, timeout=FIRESTORE_TIMEOUT_SECONDS)
+                get_lab_cache().invalidate(lab_id)
     
     log_audit_event(user["email"], user["role"].upper(), "login", lab_id, "success")
     
@@ -90,10 +61,12 @@ def login(request: LoginRequest):
         "scenario_id": "air",
         "session_expires_at": session_expires.isoformat(),
     }
+    if provisioning_job_id:
+        user_response["provisioning_job_id"] = provisioning_job_id
     
     return LoginResponse(access_token=token, user=user_response)
 
 @router.post("/logout")
-def logout():
+async def logout():
     """Logout endpoint (client-side token removal)."""
     return {"message": "Logged out successfully"}
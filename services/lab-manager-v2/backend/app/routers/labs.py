@@ -1,16 +1,21 @@
 """Lab management routes."""
+import asyncio
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
-import socket
 from typing import Dict, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from google.cloud import firestore
-from app.auth import get_current_user, get_db
-from app.config import LABS_COLLECTION, INVITES_COLLECTION, AUDIT_LOGS_COLLECTION
+from app.audit import log_audit_event
+from app.auth import get_current_user, get_stream_user, get_async_db
+from app.config import LABS_COLLECTION, INVITES_COLLECTION, FIRESTORE_TIMEOUT_SECONDS
+from app.dns_health import get_dns_prober
+from app.events import get_event_hub
+from app.lab_cache import get_lab_cache
+from app.jobs import LabBeingReaped, start_lab_provisioning, extend_lab_session, get_job, cancel_job
 from app.services import (
-    stable_lab_id_from_email, create_cloud_run_service, create_dns_record,
-    make_dns_hostname, now_utc
+    stable_lab_id_from_email, create_dns_record_async, make_dns_hostname, now_utc
 )
 
 router = APIRouter(prefix="/api/v1", tags=["labs"])
@@ -24,15 +29,9 @@ def _debug_log(payload: Dict) -> None:
     except Exception:
         pass
 
-def _dns_resolves(hostname: Optional[str]) -> bool:
-    """Return True if hostname resolves via DNS."""
-    if not hostname:
-        return False
-    try:
-        socket.gethostbyname(hostname)
-        return True
-    except Exception:
-        return False
+def _dns_resolves(hostname: Optional[str]) -> Optional[bool]:
+    """Return True if hostname resolves via DNS (cached by the background prober), None before its first probe."""
+    return get_dns_prober().resolves(hostname)
 
 DEFAULT_SCENARIOS = {
     "air": {
@@ -46,6 +45,55 @@ DEFAULT_SCENARIOS = {
     }
 }
 
+def _lab_status(data: Dict) -> str:
+    """Map a lab document to its display status (expiry first, then attack state)."""
+    expires_at = data.get("expires_at")
+    if expires_at:
+        if hasattr(expires_at, 'timestamp'):
+            # Firestore timestamp
+            expiry_time = expires_at
+        else:
+            expiry_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+        if datetime.now(timezone.utc) > expiry_time:
+            return "expired"
+    
+    attack_state = data.get("attack", {}).get("state", "unknown")
+    if attack_state == "ready" or attack_state == "online":
+        return "ready"  # "online" maps to "ready" for display
+    elif attack_state == "error":
+        return "error"
+    elif attack_state == "not_invited":
+        return "pending"
+    elif attack_state == "provisioning":
+        return "provisioning"
+    return attack_state if attack_state != "unknown" else "ready"
+
+def _lab_event_payload(lab_id: str, data: Optional[Dict]) -> Dict:
+    """Status snapshot pushed to /labs/current/events subscribers."""
+    scenario = DEFAULT_SCENARIOS["air"]
+    victim_url = scenario["victim_url_template"].format(lab_id=lab_id)
+    client_url = scenario["client_url_template"].format(lab_id=lab_id)
+    status = "ready"
+    attack_state = None
+    if data is not None:
+        status = _lab_status(data)
+        attack_state = data.get("attack", {}).get("state")
+        client_url = data.get("attack", {}).get("cloud_run_url") or client_url
+    # A hostname not probed yet (e.g. just after a restart) leaves the status as recorded
+    if status == "ready" and False in (
+        _dns_resolves(urlparse(victim_url).hostname), _dns_resolves(urlparse(client_url).hostname)
+    ):
+        status = "provisioning"
+    return {
+        "lab_id": lab_id,
+        "status": status,
+        "attack_state": attack_state,
+        "victim_url": victim_url,
+        "client_url": client_url,
+    }
+
+get_event_hub().set_renderer(_lab_event_payload)
+
 class LabCurrentResponse(BaseModel):
     victim_url: str
     client_url: str
@@ -62,25 +110,8 @@ class ImpervaOnboardRequest(BaseModel):
     protected_cname: str
     txt_validation: Optional[str] = None
 
-def log_audit_event(actor_email: str, actor_role: str, action: str, target: Optional[str] = None, status: str = "success", details: Optional[Dict] = None):
-    """Log audit event to Firestore."""
-    try:
-        db = get_db()
-        logs = db.collection(AUDIT_LOGS_COLLECTION)
-        logs.add({
-            "timestamp": now_utc(),
-            "actor_email": actor_email,
-            "actor_role": actor_role,
-            "action": action,
-            "target": target,
-            "status": status,
-            "details": details or {},
-        })
-    except Exception as e:
-        print(f"WARNING: Failed to log audit event: {e}")
-
 @router.get("/me")
-def get_me(user: Dict = Depends(get_current_user)):
+async def get_me(user: Dict = Depends(get_current_user)):
     """Get current user info."""
     from datetime import timedelta
     from app.auth import TOKEN_EXPIRE_HOURS
@@ -100,12 +131,12 @@ def get_me(user: Dict = Depends(get_current_user)):
     }
 
 @router.get("/labs/current", response_model=LabCurrentResponse)
-def get_lab_current(user: Dict = Depends(get_current_user)):
+async def get_lab_current(user: Dict = Depends(get_current_user)):
     """Get current lab info for authenticated user."""
-    db = get_db()
+    db = get_async_db()
     lab_id = stable_lab_id_from_email(user["email"])
     lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
-    lab_doc = lab_ref.get()
+    data = await get_lab_cache().aget(lab_id)
     
     scenario = DEFAULT_SCENARIOS.get("air", DEFAULT_SCENARIOS["air"])
     victim_url = scenario["victim_url_template"].format(lab_id=lab_id)
@@ -151,11 +182,10 @@ def get_lab_current(user: Dict = Depends(get_current_user)):
     # #endregion
     
     # #region agent log
-    import json; print(f"[DEBUG H1A,H2A,H4A] labs.py:get_lab_current:entry - lab_id={lab_id}, email={user['email']}, lab_doc_exists={lab_doc.exists}")
+    import json; print(f"[DEBUG H1A,H2A,H4A] labs.py:get_lab_current:entry - lab_id={lab_id}, email={user['email']}, lab_doc_exists={data is not None}")
     # #endregion
     
-    if lab_doc.exists:
-        data = lab_doc.to_dict()
+    if data is not None:
         attack_data = data.get("attack", {})
         dns_hostname = attack_data.get("dns_hostname")
         cloud_run_url = attack_data.get("cloud_run_url")
@@ -166,10 +196,11 @@ def get_lab_current(user: Dict = Depends(get_current_user)):
         if not dns_hostname or dns_hostname != expected_dns_hostname:
             try:
                 from app.config import AIR_ORIGIN_HOSTNAME
-                create_dns_record(expected_dns_hostname, AIR_ORIGIN_HOSTNAME)
-                lab_ref.update({
+                await create_dns_record_async(expected_dns_hostname, AIR_ORIGIN_HOSTNAME)
+                await lab_ref.update({
                     "attack.dns_hostname": expected_dns_hostname,
-                })
+                }, timeout=FIRESTORE_TIMEOUT_SECONDS)
+                get_lab_cache().invalidate(lab_id)
                 dns_hostname = expected_dns_hostname
                 # #region agent log
                 _debug_log({
@@ -202,35 +233,13 @@ def get_lab_current(user: Dict = Depends(get_current_user)):
                 })
                 # #endregion
         
-        # Check lab expiration
-        expires_at = data.get("expires_at")
-        if expires_at:
-            if hasattr(expires_at, 'timestamp'):
-                # Firestore timestamp
-                expiry_time = expires_at
-            else:
-                expiry_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-            if datetime.now(timezone.utc) > expiry_time:
-                status = "expired"
+        status = _lab_status(data)
         
         # #region agent log
         expires_at_raw = data.get("expires_at")
         print(f"[DEBUG H1A,H2A,H4A] labs.py:get_lab_current:attack_data - attack_data={attack_data}, dns_hostname={dns_hostname}, cloud_run_url={cloud_run_url}, attack_state={attack_state}, expires_at={expires_at_raw}, full_data_keys={list(data.keys())}")
         # #endregion
         
-        # Map attack state to status (only if not expired)
-        if status != "expired":
-            if attack_state == "ready" or attack_state == "online":
-                status = "ready"  # "online" maps to "ready" for display
-            elif attack_state == "error":
-                status = "error"
-            elif attack_state == "not_invited":
-                status = "pending"
-            elif attack_state == "provisioning":
-                status = "provisioning"
-            else:
-                status = attack_state if attack_state != "unknown" else "ready"
-        
         # Use Cloud Run URL for client if available from provisioning
         if cloud_run_url:
             client_url = cloud_run_url
@@ -275,8 +284,8 @@ def get_lab_current(user: Dict = Depends(get_current_user)):
         })
         # #endregion
     
-    # Only show online/ready when both victim and client DNS resolve
-    if status == "ready" and not (dns_victim_ok and dns_client_ok):
+    # Only show online/ready when both victim and client DNS resolve (or have not been probed yet)
+    if status == "ready" and False in (dns_victim_ok, dns_client_ok):
         status = "provisioning"
     
     # #region agent log
@@ -309,123 +318,91 @@ def get_lab_current(user: Dict = Depends(get_current_user)):
         imperva={"waf": "OFF", "cert": "PENDING", "dns": "OK"},
     )
 
-@router.post("/labs/current/extend")
-def extend_lab(req: ExtendRequest, user: Dict = Depends(get_current_user)):
-    """Extend lab session - updates the lab's expires_at in Firestore."""
-    db = get_db()
+@router.get("/labs/current/events")
+async def lab_current_events(
+    user: Dict = Depends(get_stream_user),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """Server-Sent Events stream of status changes for the current user's lab."""
     lab_id = stable_lab_id_from_email(user["email"])
-    lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
-    
-    new_expiry = datetime.now(timezone.utc) + timedelta(minutes=req.extend_minutes)
-    
-    # Update the lab document with new expiry
-    lab_doc = lab_ref.get()
-    if lab_doc.exists:
-        lab_ref.update({"expires_at": new_expiry})
-    else:
-        # Create lab document if it doesn't exist
-        lab_ref.set({
-            "owner_email": user["email"],
-            "lab_name": lab_id,
-            "created_at": datetime.now(timezone.utc),
-            "expires_at": new_expiry,
-            "status": "active",
-            "attack": {"state": "pending"},
-        })
-    
-    return {"new_expiry": new_expiry.isoformat()}
+    try:
+        resume_from = int(last_event_id) if last_event_id else None
+    except ValueError:
+        resume_from = None
+    return StreamingResponse(
+        get_event_hub().stream(lab_id, resume_from),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-@router.post("/labs/current/reset")
-def reset_lab(user: Dict = Depends(get_current_user)):
-    """Reset lab - reprovisions the attack client and resets state."""
-    from app.config import AIR_ORIGIN_HOSTNAME, ATTACK_CLIENT_IMAGE
-    
-    db = get_db()
+def _being_reaped() -> HTTPException:
+    return HTTPException(status_code=409, detail="Lab is being shut down after expiry, please retry in a minute",
+                         headers={"Retry-After": "30"})
+
+@router.post("/labs/current/extend")
+async def extend_lab(req: ExtendRequest, user: Dict = Depends(get_current_user)):
+    """Extend lab session - updates the lab's expires_at in Firestore.
+
+    A lab the reaper already tore down is reprovisioned (the response then
+    carries provisioning_job_id); one being torn down right now gets a 409.
+    """
+    try:
+        return await asyncio.to_thread(extend_lab_session, user["email"], req.extend_minutes)
+    except LabBeingReaped:
+        raise _being_reaped()
+
+@router.post("/labs/current/reset", status_code=202)
+async def reset_lab(user: Dict = Depends(get_current_user)):
+    """Reset lab - queues reprovisioning of the attack client and returns immediately."""
     lab_id = stable_lab_id_from_email(user["email"])
-    lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
-    
-    new_expiry = datetime.now(timezone.utc) + timedelta(hours=4)
     
     # #region agent log
-    print(f"[DEBUG RESET] Starting reset for lab_id={lab_id}, email={user['email']}, ATTACK_CLIENT_IMAGE={ATTACK_CLIENT_IMAGE}")
+    print(f"[DEBUG RESET] Queueing reset for lab_id={lab_id}, email={user['email']}")
     # #endregion
     
-    # Actually provision the attack client
     try:
-        dns_hostname = make_dns_hostname(user["email"], scenario_id="air")
-        service_name = f"attack-client-{lab_id.lower()}"
-        
-        # #region agent log
-        print(f"[DEBUG RESET] Provisioning: service_name={service_name}, dns_hostname={dns_hostname}")
-        _debug_log({
-            "sessionId": "debug-session",
-            "runId": "pre-fix",
-            "hypothesisId": "H1,H3",
-            "location": "labs.py:reset_lab:provisioning",
-            "message": "Provisioning attack client and DNS",
-            "data": {
-                "service_name": service_name,
-                "dns_hostname": dns_hostname,
-                "scenario_id": "air"
-            },
-            "timestamp": int(datetime.now(timezone.utc).timestamp() * 1000),
-        })
-        # #endregion
-        
-        cloud_run_url = create_cloud_run_service(service_name, dns_hostname)
-        
-        # #region agent log
-        print(f"[DEBUG RESET] Cloud Run created: cloud_run_url={cloud_run_url}")
-        # #endregion
-        
-        create_dns_record(dns_hostname, AIR_ORIGIN_HOSTNAME)
-        
-        # #region agent log
-        print(f"[DEBUG RESET] DNS record created for {dns_hostname} -> {AIR_ORIGIN_HOSTNAME}")
-        # #endregion
-        
-        # Update lab with successful provisioning
-        lab_ref.update({
-            "expires_at": new_expiry,
-            "attack": {
-                "state": "ready",
-                "cloud_run_service": service_name,
-                "cloud_run_url": cloud_run_url,
-                "dns_hostname": dns_hostname,
-            },
-        })
-        
-        # #region agent log
-        print(f"[DEBUG RESET] SUCCESS: Lab updated with cloud_run_url={cloud_run_url}, dns_hostname={dns_hostname}")
-        # #endregion
-        
-        log_audit_event(user["email"], user.get("role", "student").upper(), "lab_reset", lab_id, "success")
-        return {"status": "reset_complete", "cloud_run_url": cloud_run_url, "dns_hostname": dns_hostname}
-        
+        job = await asyncio.to_thread(start_lab_provisioning, user["email"], kind="reset")
+    except LabBeingReaped:
+        raise _being_reaped()
     except Exception as e:
-        import traceback
-        print(f"ERROR: Failed to provision attack client: {e}")
-        print(f"[DEBUG RESET] Traceback: {traceback.format_exc()}")
-        # Update with error state
-        lab_ref.update({
-            "expires_at": new_expiry,
-            "attack": {"state": "error", "error": str(e)},
-        })
+        print(f"ERROR: Failed to queue lab reset: {e}")
         log_audit_event(user["email"], user.get("role", "student").upper(), "lab_reset", lab_id, "error", {"error": str(e)})
         raise HTTPException(status_code=500, detail=f"Failed to provision: {str(e)}")
+    
+    log_audit_event(user["email"], user.get("role", "student").upper(), "lab_reset", lab_id,
+                    "attached" if job.get("attached") else "queued", {"job_id": job["job_id"]})
+    return {"status": "provisioning", "job_id": job["job_id"], "attack": {"state": "provisioning"}}
+
+async def _get_owned_job(job_id: str, user: Dict) -> Dict:
+    job = await asyncio.to_thread(get_job, job_id)
+    if not job or (job.get("owner_email") != user["email"] and user["role"] != "admin"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/labs/jobs/{job_id}")
+async def get_provisioning_job(job_id: str, user: Dict = Depends(get_current_user)):
+    """Poll a provisioning job."""
+    return await _get_owned_job(job_id, user)
+
+@router.post("/labs/jobs/{job_id}/cancel")
+async def cancel_provisioning_job(job_id: str, user: Dict = Depends(get_current_user)):
+    """Cancel a queued or running provisioning job."""
+    await _get_owned_job(job_id, user)
+    job = await asyncio.to_thread(cancel_job, job_id)
+    log_audit_event(user["email"], user.get("role", "student").upper(), "provisioning_cancel", job_id, "success")
+    return job
 
 @router.post("/labs/current/imperva/onboard")
-def onboard_imperva(req: ImpervaOnboardRequest, user: Dict = Depends(get_current_user)):
+async def onboard_imperva(req: ImpervaOnboardRequest, user: Dict = Depends(get_current_user)):
     """Onboard lab to Imperva."""
-    db = get_db()
+    db = get_async_db()
     lab_id = stable_lab_id_from_email(user["email"])
     lab_ref = db.collection(LABS_COLLECTION).document(lab_id)
-    lab_doc = lab_ref.get()
+    data = await get_lab_cache().aget(lab_id)
     
-    if not lab_doc.exists:
+    if data is None:
         raise HTTPException(status_code=404, detail="Lab not found")
     
-    data = lab_doc.to_dict()
     attack_data = data.get("attack", {})
     dns_hostname = attack_data.get("dns_hostname")
     
@@ -437,14 +414,15 @@ def onboard_imperva(req: ImpervaOnboardRequest, user: Dict = Depends(get_current
         if not imperva_cname.endswith("."):
             imperva_cname = f"{imperva_cname}."
         
-        create_dns_record(dns_hostname, imperva_cname)
+        await create_dns_record_async(dns_hostname, imperva_cname)
         
         imperva_data = data.get("imperva", {})
         imperva_data["protected_cname"] = req.protected_cname
         imperva_data["dns"] = "OK"
         imperva_data["onboarded_at"] = now_utc()
         
-        lab_ref.update({"imperva": imperva_data})
+        await lab_ref.update({"imperva": imperva_data}, timeout=FIRESTORE_TIMEOUT_SECONDS)
+        get_lab_cache().invalidate(lab_id)
         
         return {
             "accepted": True,
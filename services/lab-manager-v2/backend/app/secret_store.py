@@ -0,0 +1,276 @@
+"""Application secrets, fetched in the background and refreshed while cached.
+
+Each secret comes from its environment variable when set, otherwise from
+SECRETS_FILE (a JSON stand-in for tests and local dev) or Secret Manager.
+prefetch() starts all fetches concurrently at startup; get() waits only for
+the one secret it needs, so import and startup no longer block on Secret
+Manager and /healthz reports not-ready until every secret has been loaded.
+
+Loaded values are re-read every SECRET_REFRESH_SECONDS by a background
+refresher (and by get() when it finds a stale value), so rotating
+lab-manager-auth-token or resend-key no longer needs a restart. Requests
+never wait on a refresh; a failed refresh keeps the last good value. When a
+value changes, the previous one stays available from previous() for
+SECRET_GRACE_SECONDS and subscribers are called with (new, old).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional, Tuple
+from app import startup_profile
+from app.clients import get_secret_manager_client
+from app.config import (
+    GCP_PROJECT, JWT_SECRET_ID, RESEND_SECRET_ID, SECRET_FETCH_TIMEOUT,
+    SECRET_REFRESH_SECONDS, SECRET_GRACE_SECONDS, SECRETS_FILE
+)
+from app.metrics import timed
+
+DEV_JWT_SECRET = "dev-secret-change-me-in-production"
+# On-demand refreshes (refresh(min_age=...)) of a value younger than this are skipped.
+MIN_REFRESH_INTERVAL = 30
+
+class _Secret:
+    def __init__(self, name: str, env_var: str, secret_id: str, default: str = ""):
+        self.name = name
+        self.env_var = env_var
+        self.secret_id = secret_id
+        self.default = default
+        self.value: Optional[str] = None
+        self.source: Optional[str] = None
+        self.fetched_at = 0.0
+        self.previous: Optional[str] = None
+        self.previous_until = 0.0
+        self.loaded = threading.Event()
+        self.fetching = False
+        self.subscribers: List[Callable[[str, Optional[str]], None]] = []
+        self.stats = {"refreshes": 0, "refresh_failures": 0, "rotations": 0}
+
+class SecretStore:
+    def __init__(self, project: str = GCP_PROJECT, refresh_seconds: float = SECRET_REFRESH_SECONDS,
+                 grace_seconds: float = SECRET_GRACE_SECONDS, secrets_file: str = SECRETS_FILE):
+        self.project = project
+        self.refresh_seconds = refresh_seconds
+        self.grace_seconds = grace_seconds
+        self.secrets_file = secrets_file
+        self._secrets: Dict[str, _Secret] = {}
+        self._lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def register(self, name: str, env_var: str, secret_id: str, default: str = "") -> None:
+        self._secrets[name] = _Secret(name, env_var, secret_id, default)
+
+    def subscribe(self, name: str, callback: Callable[[str, Optional[str]], None]) -> None:
+        """Call callback(new, old) from the refresher whenever the secret's value changes."""
+        self._secrets[name].subscribers.append(callback)
+
+    # Loading
+
+    def _load(self, secret: _Secret) -> Tuple[str, str]:
+        """Current (value, source); value is empty if no source has it."""
+        value = os.getenv(secret.env_var, "")
+        if value:
+            return value, "env"
+        if self.secrets_file:
+            return self._read_file(secret), "file"
+        return self._access(secret.secret_id), "secret_manager"
+
+    def _read_file(self, secret: _Secret) -> str:
+        try:
+            with open(self.secrets_file) as f:
+                values = json.load(f)
+            if not isinstance(values, dict):
+                raise ValueError("expected a JSON object")
+            return str(values.get(secret.name) or values.get(secret.secret_id) or "").strip()
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Failed to read secret {secret.name} from {self.secrets_file}: {e}")
+            return ""
+
+    def _access(self, secret_id: str) -> str:
+        try:
+            client = get_secret_manager_client()
+            name = f"projects/{self.project}/secrets/{secret_id}/versions/latest"
+            with timed("secret_manager", "access_secret_version"):
+                resp = client.access_secret_version(request={"name": name}, timeout=SECRET_FETCH_TIMEOUT)
+            return resp.payload.data.decode("utf-8").strip()
+        except Exception as e:
+            print(f"WARNING: Failed to load secret {secret_id}: {e}")
+            return ""
+
+    def _fetch(self, secret: _Secret) -> bool:
+        """Load or refresh one secret; returns True if an already-loaded value changed."""
+        first = not secret.loaded.is_set()
+        value, source, changed = "", None, False
+        try:
+            try:
+                with startup_profile.step(f"secret {secret.name}") if first else nullcontext():
+                    value, source = self._load(secret)
+            except Exception as e:
+                # Handled like a source without the secret: the default, or the last good value
+                print(f"WARNING: Failed to load secret {secret.name}: {e}")
+            with self._lock:
+                old = secret.value
+                secret.fetched_at = time.monotonic()
+                if not first:
+                    secret.stats["refreshes"] += 1
+                if not value:
+                    if not first:
+                        # Keep serving the last good value until a refresh succeeds.
+                        secret.stats["refresh_failures"] += 1
+                        return False
+                    value, source = secret.default, "default"
+                changed = not first and value != old
+                if changed:
+                    secret.previous = old
+                    secret.previous_until = time.monotonic() + self.grace_seconds
+                    secret.stats["rotations"] += 1
+                secret.value = value
+                secret.source = source
+        finally:
+            with self._lock:
+                secret.fetching = False
+        secret.loaded.set()
+        if first and source in ("secret_manager", "file"):
+            where = f"project: {self.project}" if source == "secret_manager" else self.secrets_file
+            print(f"✓ {secret.env_var} loaded from {source.replace('_', ' ')} ({where})")
+        if changed:
+            print(f"✓ {secret.env_var} rotated; previous value valid for {self.grace_seconds:.0f}s")
+            self._notify(secret, value, old)
+        return changed
+
+    def _notify(self, secret: _Secret, new: str, old: Optional[str]) -> None:
+        for callback in secret.subscribers:
+            try:
+                callback(new, old)
+            except Exception as e:
+                print(f"WARNING: Secret {secret.name} subscriber failed: {e}")
+
+    def _start(self, secret: _Secret, refresh: bool = False) -> Optional[threading.Thread]:
+        with self._lock:
+            if secret.fetching or (secret.loaded.is_set() and not refresh):
+                return None
+            secret.fetching = True
+        thread = threading.Thread(target=self._fetch, args=(secret,), name=f"secret-{secret.name}", daemon=True)
+        thread.start()
+        return thread
+
+    def _is_stale(self, secret: _Secret) -> bool:
+        return self.refresh_seconds > 0 and time.monotonic() - secret.fetched_at > self.refresh_seconds
+
+    def prefetch(self) -> List[threading.Thread]:
+        """Start loading every registered secret concurrently; returns the fetch threads."""
+        return [t for t in (self._start(s) for s in self._secrets.values()) if t is not None]
+
+    # Reading
+
+    def get(self, name: str, timeout: float = SECRET_FETCH_TIMEOUT + 5) -> str:
+        """Return a secret, fetching it (or waiting for the in-flight fetch) if it was never loaded.
+
+        A stale value is returned as-is while a refresh runs in the background.
+        """
+        secret = self._secrets[name]
+        if not secret.loaded.is_set():
+            self._start(secret)
+            if not secret.loaded.wait(timeout):
+                print(f"WARNING: Timed out waiting for secret {secret.secret_id}")
+                return secret.default
+        elif self._is_stale(secret):
+            self._start(secret, refresh=True)
+        return secret.value
+
+    def previous(self, name: str) -> Optional[str]:
+        """The value replaced by the last rotation, while it is inside the grace window."""
+        secret = self._secrets[name]
+        with self._lock:
+            if secret.previous is not None and time.monotonic() < secret.previous_until:
+                return secret.previous
+        return None
+
+    def refresh(self, name: Optional[str] = None, min_age: float = 0) -> List[str]:
+        """Re-read secrets now (blocking); returns the names whose value changed.
+
+        Secrets fetched less than min_age seconds ago, or with a fetch already
+        in flight, are skipped.
+        """
+        changed = []
+        for secret in ([self._secrets[name]] if name else list(self._secrets.values())):
+            with self._lock:
+                if secret.fetching or (secret.loaded.is_set() and time.monotonic() - secret.fetched_at < min_age):
+                    continue
+                secret.fetching = True
+            if self._fetch(secret):
+                changed.append(secret.name)
+        return changed
+
+    # Background refresh
+
+    def start_refresher(self) -> None:
+        """Refresh every secret each SECRET_REFRESH_SECONDS in a daemon thread (per process)."""
+        if self.refresh_seconds <= 0:
+            return
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            self._stopping.clear()
+            self._refresher = threading.Thread(target=self._run, name="secret-refresher", daemon=True)
+            self._refresher.start()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.refresh_seconds):
+            for thread in [self._start(s, refresh=True) for s in self._secrets.values() if s.loaded.is_set()]:
+                if thread is not None:
+                    thread.join()
+
+    def stop_refresher(self) -> None:
+        self._stopping.set()
+        thread = self._refresher
+        if thread is not None:
+            thread.join(timeout=SECRET_FETCH_TIMEOUT)
+        self._refresher = None
+
+    # Status
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until every secret is loaded (or timeout); returns readiness."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for secret in self._secrets.values():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not secret.loaded.wait(remaining):
+                return False
+        return True
+
+    def ready(self) -> bool:
+        return all(s.loaded.is_set() for s in self._secrets.values())
+
+    def pending(self) -> List[str]:
+        return [s.name for s in self._secrets.values() if not s.loaded.is_set()]
+
+    def stats(self) -> Dict:
+        """Per-secret source, age and refresh counters (never the values)."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                s.name: {
+                    "source": s.source,
+                    "loaded": s.loaded.is_set(),
+                    "age_seconds": round(now - s.fetched_at, 1) if s.loaded.is_set() else None,
+                    "in_grace_window": s.previous is not None and now < s.previous_until,
+                    **s.stats,
+                }
+                for s in self._secrets.values()
+            }
+
+_store = SecretStore()
+_store.register("jwt", "JWT_SECRET_KEY", JWT_SECRET_ID, DEV_JWT_SECRET)
+_store.register("resend", "RESEND_API_KEY", RESEND_SECRET_ID)
+
+def get_secret_store() -> SecretStore:
+    return _store
+
+def get_jwt_secret() -> str:
+    return _store.get("jwt")
+
+def get_resend_api_key() -> str:
+    return _store.get("resend")
@@ -0,0 +1,142 @@
+"""Production server entrypoint: `python -m app.server`.
+
+Runs gunicorn with uvicorn workers (uvloop + httptools):
+
+- one worker per CPU allowed by the container's cgroup quota (WEB_CONCURRENCY overrides)
+- the app is preloaded in the master, which also fetches secrets and runs
+  the one-time startup work (user seeding, audit spill replay) before
+  forking workers
+- workers are recycled after MAX_REQUESTS (+ jitter) requests
+- SIGTERM drains in-flight requests for up to GRACEFUL_TIMEOUT seconds
+- workers write Prometheus samples to PROMETHEUS_MULTIPROC_DIR (emptied at
+  start), so /metrics on any worker reports all of them
+
+For local development `uvicorn app.main:app --reload` still works; it runs
+the one-time startup work in its own startup hook.
+"""
+import math
+import os
+import shutil
+import tempfile
+from typing import Optional
+from uvicorn.workers import UvicornWorker
+
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "10000"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+KEEPALIVE = int(os.getenv("KEEPALIVE", "5"))
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    """CPUs granted by the cgroup quota (v2 cpu.max or v1 cfs files), if limited."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cpus() -> int:
+    """CPUs this container can actually use: the cgroup quota, capped by CPU affinity."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+def worker_count() -> int:
+    if os.getenv("WEB_CONCURRENCY"):
+        return max(1, int(os.environ["WEB_CONCURRENCY"]))
+    return available_cpus()
+
+class LabManagerWorker(UvicornWorker):
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools", "lifespan": "on"}
+
+def on_starting(_server) -> None:
+    """Master, before forking: run the one-time startup work, then drop resources workers must not inherit."""
+    from app import hashing, startup_profile
+    from app.audit import get_audit_writer
+    from app.clients import close_clients
+    from app.main import STARTUP_DONE_ENV, run_startup_once
+    from app.secret_store import get_secret_store
+    # Fetch secrets while seeding; workers inherit the loaded values.
+    fetches = get_secret_store().prefetch()
+    run_startup_once()
+    for fetch in fetches:
+        fetch.join()
+    # Flush replayed audit events now so forked workers do not inherit them queued.
+    get_audit_writer().shutdown()
+    hashing.shutdown()
+    close_clients()
+    os.environ[STARTUP_DONE_ENV] = "1"
+    startup_profile.report("master startup")
+
+def child_exit(_server, worker) -> None:
+    """Master, after a worker exits (recycled or crashed): drop its live gauges."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def prepare_metrics_dir() -> str:
+    """Point prometheus_client at an empty directory shared by the workers; must run before it is imported."""
+    path = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "lab-manager-metrics"))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def build_options() -> dict:
+    workers = worker_count()
+    return {
+        "bind": f"0.0.0.0:{os.getenv('PORT', '8080')}",
+        "workers": workers,
+        "worker_class": "app.server.LabManagerWorker",
+        "preload_app": True,
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS_JITTER,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        # Worker heartbeat timeout; async workers only miss it if the loop is blocked.
+        "timeout": int(os.getenv("WORKER_TIMEOUT", "60")),
+        "keepalive": KEEPALIVE,
+        "accesslog": "-" if os.getenv("ACCESS_LOG", "").lower() in ("1", "true", "yes") else None,
+        "errorlog": "-",
+        "on_starting": on_starting,
+        "child_exit": child_exit,
+    }
+
+def main() -> None:
+    from gunicorn.app.base import BaseApplication
+
+    prepare_metrics_dir()
+    options = build_options()
+    # Split the CPUs between web workers and their bcrypt pools instead of
+    # giving every worker a pool as large as the machine.
+    os.environ.setdefault("BCRYPT_WORKERS", str(max(1, available_cpus() // options["workers"])))
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app.main import app
+            return app
+
+    print(f"Starting {options['workers']} worker(s) on {options['bind']} "
+          f"(cpus={available_cpus()}, max_requests={MAX_REQUESTS})")
+    Server().run()
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,15 @@
 """Infrastructure services for Cloud Run, DNS, and Email."""
-import os
+import asyncio
 import re
 import secrets
 import string
 import hashlib
+import html
 from datetime import datetime, timezone
-from typing import Optional
-from google.cloud import run_v2
-from google.cloud.run_v2 import types
-from google.cloud import dns
-from google.iam.v1 import policy_pb2, iam_policy_pb2
-import resend
-from app.config import (
-    GCP_PROJECT, GCP_REGION, DNS_ZONE_NAME, DNS_ZONE_DOMAIN,
-    ATTACK_CLIENT_IMAGE, AIR_ORIGIN_HOSTNAME, RESEND_API_KEY
-)
+from typing import Dict, Optional
+from app.cloud_run import get_cloud_run
+from app.dns_changes import get_dns_batcher
+from app.config import DNS_ZONE_DOMAIN, AIR_ORIGIN_HOSTNAME, MANAGER_URL, MAIL_FROM
 
 def _debug_log(payload: dict) -> None:
     """Write NDJSON debug log for runtime analysis."""
@@ -25,12 +20,8 @@ def _debug_log(payload: dict) -> None:
     except Exception:
         pass
 
-if RESEND_API_KEY:
-    resend.api_key = RESEND_API_KEY
-    if not os.getenv("RESEND_API_KEY"):
-        print(f"✓ RESEND_API_KEY loaded from Secret Manager (project: {GCP_PROJECT})")
-
 ALPHANUM = string.ascii_letters + string.digits
+DNS_CHANGE_TIMEOUT = 120
 
 def make_lab_name(email: str) -> str:
     """Generate a lab name from email."""
@@ -67,99 +58,15 @@ def stable_lab_id_from_email(email: str) -> str:
     return f"{prefix}-{digest}"
 
 def create_cloud_run_service(service_name: str, dns_hostname: str) -> str:
-    """Create a Cloud Run service and return its URL."""
-    client = run_v2.ServicesClient()
-    parent = f"projects/{GCP_PROJECT}/locations/{GCP_REGION}"
-    service_path = f"{parent}/services/{service_name}"
-    
-    # Check if service already exists
-    try:
-        existing_service = client.get_service(name=service_path)
-        # Get URI from the service - it might be in different attributes
-        uri = existing_service.uri or ""
-        if not uri and hasattr(existing_service, 'urls') and existing_service.urls:
-            uri = existing_service.urls[0]
-        if not uri:
-            # Construct URL from service name if not available
-            uri = f"https://{service_name}-{GCP_PROJECT[:8]}.{GCP_REGION}.run.app"
-        print(f"[DEBUG CLOUDRUN] Found existing service: {service_path}, uri={uri}")
-        return uri
-    except Exception as e:
-        print(f"[DEBUG CLOUDRUN] Service doesn't exist, creating: {service_path}, error={e}")
-    
-    # Create container with ports and env vars (updated API structure)
-    container = types.Container(
-        image=ATTACK_CLIENT_IMAGE,
-        ports=[types.ContainerPort(container_port=8080)],
-        env=[types.EnvVar(name="ROLE", value="ATTACKER")],
-    )
-    
-    # Create revision template (new API - containers directly on template, no spec)
-    revision_template = types.RevisionTemplate(
-        containers=[container],
-        service_account=f"sa-attack-client@{GCP_PROJECT}.iam.gserviceaccount.com",
-    )
-    
-    # Create service
-    service = types.Service(
-        labels={"managed-by": "lab-manager"},
-        template=revision_template,
-    )
-    
-    request = types.CreateServiceRequest(
-        parent=parent,
-        service=service,
-        service_id=service_name,
-    )
-    
-    operation = client.create_service(request=request)
-    response = operation.result(timeout=300)
-    
-    print(f"[DEBUG CLOUDRUN] Service created: name={response.name}, uri={response.uri}")
-    
-    # Grant public access
-    try:
-        policy_request = iam_policy_pb2.GetIamPolicyRequest(resource=response.name)
-        policy = client.get_iam_policy(request=policy_request)
-        
-        existing_binding = None
-        for b in policy.bindings:
-            if b.role == "roles/run.invoker":
-                existing_binding = b
-                break
-        
-        if existing_binding:
-            if "allUsers" not in existing_binding.members:
-                existing_binding.members.append("allUsers")
-        else:
-            binding = policy_pb2.Binding()
-            binding.role = "roles/run.invoker"
-            binding.members.append("allUsers")
-            policy.bindings.append(binding)
-        
-        set_policy_request = iam_policy_pb2.SetIamPolicyRequest(
-            resource=response.name,
-            policy=policy,
-        )
-        client.set_iam_policy(request=set_policy_request)
-    except Exception as e:
-        print(f"WARNING: Failed to grant public access: {e}")
-    
-    # Return URI, or construct it if empty
-    uri = response.uri or ""
-    if not uri:
-        # Construct URL from response name if URI not available
-        # response.name format: projects/{project}/locations/{region}/services/{service_name}
-        uri = f"https://{service_name}-{GCP_PROJECT[:8]}.{GCP_REGION}.run.app"
-        print(f"[DEBUG CLOUDRUN] URI was empty, constructed: {uri}")
-    
-    return uri
+    """Create a Cloud Run service (or find the existing one) and return its URL."""
+    return get_cloud_run().ensure_service(service_name)
 
-def create_dns_record(hostname: str, target: str) -> None:
-    """Create or update a DNS CNAME record."""
-    client = dns.Client(project=GCP_PROJECT)
-    zone = client.zone(DNS_ZONE_NAME)
-    
+def delete_cloud_run_service(service_name: str) -> bool:
+    """Delete a Cloud Run service; returns False if it did not exist."""
+    return get_cloud_run().delete_service(service_name)
+
+def dns_record_name(hostname: str) -> str:
+    """Fully qualified record name in DNS_ZONE_DOMAIN for a lab hostname."""
     if hostname.endswith("."):
         hostname = hostname[:-1]
     
@@ -168,10 +75,14 @@ def create_dns_record(hostname: str, target: str) -> None:
     else:
         record_name = hostname.split(".")[0]
     
+    return f"{record_name}.{DNS_ZONE_DOMAIN}."
+
+def _submit_dns_record(hostname: str, target: str):
+    """Queue a CNAME upsert on the DNS change batcher and return its future."""
     if not target.endswith("."):
         target = f"{target}."
     
-    full_record_name = f"{record_name}.{DNS_ZONE_DOMAIN}."
+    full_record_name = dns_record_name(hostname)
     
     print(f"[DEBUG DNS] Creating/updating record: {full_record_name} -> {target}")
     # #region agent log
@@ -186,75 +97,45 @@ def create_dns_record(hostname: str, target: str) -> None:
     })
     # #endregion
     
-    # Check if record already exists
-    existing_record = None
-    try:
-        # List all records and find the matching one
-        records = list(zone.list_resource_record_sets())
-        for record in records:
-            if record.name == full_record_name and record.record_type == "CNAME":
-                existing_record = record
-                break
-    except Exception as e:
-        print(f"[DEBUG DNS] Error checking existing records: {e}")
-    
-    if existing_record:
-        # Record exists - check if it needs updating
-        if existing_record.rrdatas and existing_record.rrdatas[0] == target:
-            print(f"[DEBUG DNS] Record already exists with correct target, skipping")
-            return
-        else:
-            # Delete old record and add new one
-            print(f"[DEBUG DNS] Record exists with different target, updating: {existing_record.rrdatas} -> {target}")
-            changes = zone.changes()
-            changes.delete_record_set(existing_record)
-            new_record = zone.resource_record_set(full_record_name, "CNAME", 300, [target])
-            changes.add_record_set(new_record)
-            changes.create()
-            return
-    
-    # Record doesn't exist, create it
-    print(f"[DEBUG DNS] Creating new record: {full_record_name}")
-    record_set = zone.resource_record_set(full_record_name, "CNAME", 300, [target])
-    changes = zone.changes()
-    changes.add_record_set(record_set)
-    changes.create()
+    return full_record_name, get_dns_batcher().upsert(full_record_name, "CNAME", [target])
 
-def send_invite_email(email: str, name: Optional[str] = None) -> bool:
-    """Send invitation email."""
-    if not RESEND_API_KEY:
-        print("WARNING: RESEND_API_KEY not configured")
-        return False
-    
-    try:
-        manager_url = os.getenv("MANAGER_URL", "https://manager.lab.amplifys.us")
-        
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head><meta charset="utf-8"></head>
-        <body style="font-family: Arial, sans-serif; background-color: #f5f5f5; padding: 40px;">
-            <div style="max-width: 600px; margin: 0 auto; background: white; padding: 40px; border-radius: 8px;">
-                <h1 style="color: #333;">Welcome to Amplify Security Lab</h1>
-                <p>Hi {name or 'there'},</p>
-                <p>You've been invited to participate in the Amplify Security Lab.</p>
-                <p><strong>Access URL:</strong> <a href="{manager_url}">{manager_url}</a></p>
-                <p>Use your email address and password to log in.</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        result = resend.emails.send({
-            "from": "Amplify Lab <notifications@amplifys.us>",
-            "to": [email],
-            "subject": "Welcome to Amplify Security Lab",
-            "html": html_content,
-        })
-        return True
-    except Exception as e:
-        print(f"ERROR sending email: {e}")
-        return False
+def create_dns_record(hostname: str, target: str) -> None:
+    """Create or update a DNS CNAME record."""
+    _full_record_name, future = _submit_dns_record(hostname, target)
+    future.result(timeout=DNS_CHANGE_TIMEOUT)
+
+async def create_dns_record_async(hostname: str, target: str) -> None:
+    """create_dns_record() for async handlers (waits on the batch without a thread)."""
+    _full_record_name, future = _submit_dns_record(hostname, target)
+    # Shielded: a timeout or disconnect here must not cancel the batcher's future
+    await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), DNS_CHANGE_TIMEOUT)
+
+# Compiled once: only the recipient's name varies per message
+_INVITE_EMAIL_HTML = string.Template("""
+<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"></head>
+<body style="font-family: Arial, sans-serif; background-color: #f5f5f5; padding: 40px;">
+    <div style="max-width: 600px; margin: 0 auto; background: white; padding: 40px; border-radius: 8px;">
+        <h1 style="color: #333;">Welcome to Amplify Security Lab</h1>
+        <p>Hi $name,</p>
+        <p>You've been invited to participate in the Amplify Security Lab.</p>
+        <p><strong>Access URL:</strong> <a href="$manager_url">$manager_url</a></p>
+        <p>Use your email address and password to log in.</p>
+    </div>
+</body>
+</html>
+""")
+_INVITE_EMAIL_HTML = string.Template(_INVITE_EMAIL_HTML.safe_substitute(manager_url=html.escape(MANAGER_URL).replace("$", "$$")))
+
+def invite_email_message(email: str, name: Optional[str] = None) -> Dict:
+    """Render the invitation email for app.mail."""
+    return {
+        "from": MAIL_FROM,
+        "to": [email],
+        "subject": "Welcome to Amplify Security Lab",
+        "html": _INVITE_EMAIL_HTML.substitute(name=html.escape(name or "there")),
+    }
 
 def now_utc():
     """Get current UTC datetime."""
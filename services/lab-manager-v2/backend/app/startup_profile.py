@@ -0,0 +1,74 @@
+"""Startup profiling (STARTUP_PROFILE=1).
+
+Records how long each module imported by app code took to load (including
+its own imports) and how long each named startup step took, then prints a
+report once startup finishes. Disabled, step() is a no-op context manager.
+"""
+import builtins
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+ENABLED = os.getenv("STARTUP_PROFILE", "").lower() in ("1", "true", "yes")
+REPORT_TOP = int(os.getenv("STARTUP_PROFILE_TOP", "15"))
+
+_started = time.perf_counter()
+_imports: List[Tuple[str, str, float]] = []  # (importer, module, seconds)
+_steps: List[Tuple[str, float, float]] = []  # (name, started offset, seconds)
+_lock = threading.Lock()
+_installed = False
+
+def install() -> None:
+    """Time first-time imports made from app.* modules."""
+    global _installed
+    if not ENABLED or _installed:
+        return
+    _installed = True
+    original_import = builtins.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        importer = (globals or {}).get("__name__", "")
+        if level != 0 or not importer.startswith("app"):
+            return original_import(name, globals, locals, fromlist, level)
+        # "from google.cloud import firestore" loads google.cloud.firestore, not google.cloud
+        new = [m for m in [name, *(f"{name}.{f}" for f in fromlist or ())] if m not in sys.modules]
+        if not new:
+            return original_import(name, globals, locals, fromlist, level)
+        name_loaded = new[0]
+        start = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            with _lock:
+                _imports.append((importer, name_loaded, time.perf_counter() - start))
+
+    builtins.__import__ = timed_import
+
+@contextmanager
+def step(name: str):
+    """Time a named startup step (thread-safe; steps may overlap)."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _steps.append((name, start - _started, time.perf_counter() - start))
+
+def report(label: str = "startup") -> None:
+    if not ENABLED:
+        return
+    total = time.perf_counter() - _started
+    with _lock:
+        imports = sorted(_imports, key=lambda i: i[2], reverse=True)[:REPORT_TOP]
+        steps = sorted(_steps, key=lambda s: s[1])
+    print(f"[STARTUP PROFILE] {label} (pid {os.getpid()}): {total * 1000:.0f} ms since first app import")
+    for importer, module, seconds in imports:
+        print(f"[STARTUP PROFILE]   import {module:<40} {seconds * 1000:8.1f} ms  (from {importer})")
+    for name, offset, seconds in steps:
+        print(f"[STARTUP PROFILE]   step   {name:<40} {seconds * 1000:8.1f} ms  (at +{offset * 1000:.0f} ms)")
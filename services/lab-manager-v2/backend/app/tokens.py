@@ -0,0 +1,273 @@
+"""JWT signing key ring and verified-claims cache.
+
+The key ring holds several verification keys at once, identified by the
+"kid" token header. New tokens are signed with the active key; tokens
+signed with a retired key keep verifying until they expire, so rotating
+lab-manager-auth-token does not log everyone out. HS256 key ids are derived
+from the secret, so every replica agrees on them without extra config. The
+ring follows the secret store: a rotated JWT secret becomes the active
+HS256 key, and a token signed by a replica that rotated first makes this
+one re-read the secret instead of rejecting it.
+
+Verified claims are cached by token digest until the token's exp, so the
+frontend's polling with the same token skips signature verification.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import jwt
+from app.config import (
+    JWT_ALGORITHM, JWT_PREVIOUS_SECRETS, JWT_EDDSA_PRIVATE_KEY, JWT_EDDSA_PUBLIC_KEYS,
+    TOKEN_CACHE_MAX_ENTRIES, TOKEN_EXPIRE_HOURS
+)
+from app.secret_store import MIN_REFRESH_INTERVAL, get_jwt_secret, get_secret_store
+
+HS256 = "HS256"
+EDDSA = "EdDSA"
+# Retired keys stay verifiable this long (tokens signed with them expire by then).
+RETIRED_KEY_GRACE_SECONDS = TOKEN_EXPIRE_HOURS * 3600
+
+class UnknownKeyError(jwt.InvalidTokenError):
+    """The token's kid is not in the ring (yet)."""
+
+def hs256_kid(secret: str) -> str:
+    return "hs-" + hashlib.sha256(secret.encode()).hexdigest()[:12]
+
+def _eddsa_kid(public_pem: str) -> str:
+    return "ed-" + hashlib.sha256(public_pem.strip().encode()).hexdigest()[:12]
+
+class _Key:
+    def __init__(self, kid: str, algorithm: str, signing_key, verify_key):
+        self.kid = kid
+        self.algorithm = algorithm
+        self.signing_key = signing_key
+        self.verify_key = verify_key
+        self.retired_at: Optional[float] = None
+
+class KeyRing:
+    def __init__(self):
+        self._keys: "OrderedDict[str, _Key]" = OrderedDict()
+        self._active: Optional[str] = None
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_key(self, kid: str, algorithm: str, signing_key=None, verify_key=None, activate: bool = False) -> None:
+        """Add a key. Keys without a signing_key only verify."""
+        with self._lock:
+            key = _Key(kid, algorithm, signing_key, verify_key if verify_key is not None else signing_key)
+            self._keys[kid] = key
+            if activate:
+                self._activate(kid)
+
+    def add_hs256(self, secret: str, activate: bool = False) -> str:
+        kid = hs256_kid(secret)
+        self.add_key(kid, HS256, secret, secret, activate=activate)
+        return kid
+
+    def add_eddsa(self, private_pem: Optional[str] = None, public_pem: Optional[str] = None,
+                  activate: bool = False) -> str:
+        """Add an Ed25519 key from PEM; a private key alone also yields its public key."""
+        from cryptography.hazmat.primitives import serialization
+        signing_key = None
+        if private_pem:
+            signing_key = serialization.load_pem_private_key(private_pem.encode(), password=None)
+            public_pem = signing_key.public_key().public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+            ).decode()
+        verify_key = serialization.load_pem_public_key(public_pem.encode())
+        kid = _eddsa_kid(public_pem)
+        self.add_key(kid, EDDSA, signing_key, verify_key, activate=activate)
+        return kid
+
+    def _activate(self, kid: str) -> None:
+        if self._active and self._active != kid and self._active in self._keys:
+            self._keys[self._active].retired_at = time.monotonic()
+        self._keys[kid].retired_at = None
+        self._active = kid
+
+    def rotate_hs256(self, secret: str) -> str:
+        """Sign new tokens with secret; the previous active key keeps verifying for a grace period."""
+        kid = hs256_kid(secret)
+        with self._lock:
+            if self._active == kid:
+                return kid
+        kid = self.add_hs256(secret, activate=True)
+        self._prune()
+        print("✓ Rotated JWT signing key")
+        return kid
+
+    def remove_key(self, kid: str) -> None:
+        with self._lock:
+            if kid == self._active:
+                raise ValueError("Cannot remove the active signing key")
+            self._keys.pop(kid, None)
+        self._notify_removed([kid])
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [k.kid for k in self._keys.values()
+                       if k.retired_at is not None and now - k.retired_at > RETIRED_KEY_GRACE_SECONDS]
+            for kid in expired:
+                del self._keys[kid]
+        if expired:
+            self._notify_removed(expired)
+
+    def on_key_removed(self, callback) -> None:
+        self._listeners.append(callback)
+
+    def _notify_removed(self, kids: List[str]) -> None:
+        for callback in self._listeners:
+            callback(kids)
+
+    @property
+    def active_algorithm(self) -> Optional[str]:
+        key = self._keys.get(self._active) if self._active else None
+        return key.algorithm if key is not None else None
+
+    @property
+    def active_kid(self) -> Optional[str]:
+        return self._active
+
+    def active_hs256_secret(self) -> Optional[str]:
+        key = self._keys.get(self._active) if self._active else None
+        return key.signing_key if key is not None and key.algorithm == HS256 else None
+
+    def kids(self) -> List[str]:
+        with self._lock:
+            return list(self._keys)
+
+    def sign(self, payload: Dict) -> str:
+        key = self._keys.get(self._active) if self._active else None
+        if key is None or key.signing_key is None:
+            raise RuntimeError("No active JWT signing key")
+        return jwt.encode(payload, key.signing_key, algorithm=key.algorithm, headers={"kid": key.kid})
+
+    def decode(self, token: str) -> Tuple[Dict, str]:
+        """Verify a token and return (claims, kid). Raises jwt.InvalidTokenError."""
+        self._prune()
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid is not None:
+            key = self._keys.get(kid)
+            if key is None:
+                raise UnknownKeyError("Unknown signing key")
+            return jwt.decode(token, key.verify_key, algorithms=[key.algorithm]), kid
+        # Tokens issued before key ids: try each HS256 key, newest first.
+        for key in reversed(list(self._keys.values())):
+            if key.algorithm != HS256:
+                continue
+            try:
+                return jwt.decode(token, key.verify_key, algorithms=[HS256]), key.kid
+            except jwt.InvalidSignatureError:
+                continue
+        raise jwt.InvalidSignatureError("Signature verification failed")
+
+class ClaimsCache:
+    """LRU of verified token claims keyed by token digest, honoring exp."""
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # digest -> (exp, kid, claims)
+        self._entries: "OrderedDict[bytes, Tuple[float, str, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Dict]:
+        if self.max_entries <= 0:
+            return None
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[0] <= time.time():
+                del self._entries[digest]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(digest)
+            self._stats["hits"] += 1
+            return dict(entry[2])
+
+    def put(self, token: str, kid: str, claims: Dict) -> None:
+        if self.max_entries <= 0 or "exp" not in claims:
+            return
+        with self._lock:
+            self._entries[self._digest(token)] = (float(claims["exp"]), kid, dict(claims))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def drop_kids(self, kids: List[str]) -> None:
+        """Forget claims verified with keys that are no longer in the ring."""
+        with self._lock:
+            for digest in [d for d, e in self._entries.items() if e[1] in kids]:
+                del self._entries[digest]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+        return stats
+
+def _on_jwt_secret_changed(ring: KeyRing, secret: str) -> None:
+    if ring.active_algorithm == HS256:
+        ring.rotate_hs256(secret)
+    else:
+        # Signing with EdDSA: the HS256 secret only verifies.
+        ring.add_hs256(secret)
+
+def _build_key_ring() -> KeyRing:
+    ring = KeyRing()
+    for secret in JWT_PREVIOUS_SECRETS:
+        ring.add_hs256(secret)
+    for public_pem in JWT_EDDSA_PUBLIC_KEYS:
+        ring.add_eddsa(public_pem=public_pem)
+    sign_eddsa = JWT_ALGORITHM == EDDSA and bool(JWT_EDDSA_PRIVATE_KEY)
+    ring.add_hs256(get_jwt_secret(), activate=not sign_eddsa)
+    if sign_eddsa:
+        ring.add_eddsa(private_pem=JWT_EDDSA_PRIVATE_KEY, activate=True)
+    return ring
+
+_ring: Optional[KeyRing] = None
+_claims = ClaimsCache()
+_ring_lock = threading.Lock()
+
+def get_key_ring() -> KeyRing:
+    global _ring
+    if _ring is None:
+        with _ring_lock:
+            if _ring is None:
+                _ring = _build_key_ring()
+                _ring.on_key_removed(_claims.drop_kids)
+                ring = _ring
+                get_secret_store().subscribe("jwt", lambda new, _old: _on_jwt_secret_changed(ring, new))
+    return _ring
+
+def get_claims_cache() -> ClaimsCache:
+    return _claims
+
+def encode_token(payload: Dict) -> str:
+    return get_key_ring().sign(payload)
+
+def refresh_jwt_secret() -> bool:
+    """Re-read the JWT secret now (blocking, rate-limited); True if it changed."""
+    return bool(get_secret_store().refresh("jwt", min_age=MIN_REFRESH_INTERVAL))
+
+def decode_token(token: str) -> Dict:
+    """Verified claims for token, from the cache when possible. Raises jwt.InvalidTokenError."""
+    claims = _claims.get(token)
+    if claims is not None:
+        return claims
+    claims, kid = get_key_ring().decode(token)
+    _claims.put(token, kid, claims)
+    return claims
@@ -0,0 +1,292 @@
+"""Warm pool of pre-created attack-client services.
+
+Creating a Cloud Run service takes minutes, so first-login provisioning
+claims a generic service (attack-client-pool-<id>) created ahead of
+demand. Each pooled service has a document in WARM_POOL_COLLECTION
+(state "creating" or "ready"); claim() deletes a ready one and binds it
+to the lab (attack.cloud_run_service / cloud_run_url) in one transaction,
+so a service is handed to exactly one lab.
+
+The low/high watermarks live in the collection's _settings document
+(adjustable from the admin API, WARM_POOL_LOW / WARM_POOL_HIGH until
+then); claim() re-reads them every SETTINGS_TTL_SECONDS, so a change made
+on one replica reaches the others. When ready + creating services drop
+below low, a refill pass creates services up to high,
+WARM_POOL_CONCURRENCY at a time; ready services above high are deleted.
+One replica refills at a time, holding a lease on the settings document.
+"""
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+from google.cloud import firestore
+from app.auth import get_db
+from app.config import (
+    WARM_POOL_COLLECTION, WARM_POOL_LOW, WARM_POOL_HIGH, WARM_POOL_MAX, WARM_POOL_REFILL_SECONDS,
+    WARM_POOL_CONCURRENCY
+)
+from app.services import create_cloud_run_service, delete_cloud_run_service, now_utc
+
+POOL_CREATING = "creating"
+POOL_READY = "ready"
+SETTINGS_DOC = "_settings"
+# Ready services read per claim attempt; claimers pick among them at random to avoid contention
+CLAIM_CANDIDATES = 5
+# Pool reads per claim when every candidate goes to other claimers; then the lab gets its own service
+CLAIM_ATTEMPTS = 3
+# A refill pass may wait on several Cloud Run creates (up to 300s each)
+REFILL_LEASE_SECONDS = 900
+# "creating" documents older than this belong to a refill that died
+CREATING_STALE_SECONDS = 900
+# How long claim() trusts its last read of the watermarks (changes made on other replicas show up within this)
+SETTINGS_TTL_SECONDS = 30
+
+def _pool():
+    return get_db().collection(WARM_POOL_COLLECTION)
+
+@firestore.transactional
+def _claim(transaction, pool_ref, lab_ref) -> Optional[Dict]:
+    """Take a ready service for the lab; None if someone else took it first."""
+    snap = pool_ref.get(transaction=transaction)
+    if not snap.exists or snap.to_dict().get("state") != POOL_READY:
+        return None
+    data = snap.to_dict()
+    transaction.delete(pool_ref)
+    if lab_ref is not None:
+        transaction.update(lab_ref, {
+            "attack.cloud_run_service": pool_ref.id,
+            "attack.cloud_run_url": data["uri"],
+            "attack.pool_claimed_at": now_utc(),
+        })
+    return data
+
+@firestore.transactional
+def _acquire_refill_lease(transaction, settings_ref, lease_until) -> Optional[Dict]:
+    """Take the refill lease; returns the watermarks, or None if another replica holds it."""
+    snap = settings_ref.get(transaction=transaction)
+    settings = snap.to_dict() if snap.exists else {}
+    lease = settings.get("refill_lease_until")
+    if lease is not None and lease > now_utc():
+        return None
+    transaction.set(settings_ref, {"refill_lease_until": lease_until}, merge=True)
+    return {"low": settings.get("low", WARM_POOL_LOW), "high": settings.get("high", WARM_POOL_HIGH)}
+
+class WarmPool:
+    def __init__(self, refill_seconds: float = WARM_POOL_REFILL_SECONDS, concurrency: int = WARM_POOL_CONCURRENCY,
+                 settings_ttl: float = SETTINGS_TTL_SECONDS):
+        self.refill_seconds = refill_seconds
+        self.concurrency = max(1, concurrency)
+        self.settings_ttl = settings_ttl
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # Watermarks as last read from _settings: with the pool disabled, logins skip the claim query
+        self._watermarks: Optional[Dict] = None
+        self._watermarks_read_at = 0.0
+        self._stats = {"hits": 0, "misses": 0, "claim_conflicts": 0, "claim_ms_total": 0.0, "claim_ms_max": 0.0,
+                       "refills": 0, "created": 0, "create_failures": 0, "trimmed": 0}
+
+    # Claiming
+
+    def claim(self, lab_ref) -> Optional[Tuple[str, str]]:
+        """Bind a ready pooled service to the lab; returns (service name, URL), or None if the pool is empty."""
+        if self._cached_watermarks()["high"] <= 0:
+            return None
+        started = time.monotonic()
+        claimed = self._claim_one(lab_ref)
+        elapsed_ms = (time.monotonic() - started) * 1000.0
+        with self._lock:
+            stats = self._stats
+            stats["hits" if claimed else "misses"] += 1
+            stats["claim_ms_total"] += elapsed_ms
+            stats["claim_ms_max"] = max(stats["claim_ms_max"], elapsed_ms)
+        # Top up behind the claim (or after a miss) rather than at the next interval
+        self.wake()
+        return claimed
+
+    def _claim_one(self, lab_ref) -> Optional[Tuple[str, str]]:
+        db = get_db()
+        for _attempt in range(CLAIM_ATTEMPTS):
+            ready = list(_pool().where("state", "==", POOL_READY).limit(CLAIM_CANDIDATES).stream())
+            if not ready:
+                return None
+            random.shuffle(ready)
+            for snap in ready:
+                data = _claim(db.transaction(), snap.reference, lab_ref)
+                if data is not None:
+                    return snap.id, data["uri"]
+                with self._lock:
+                    self._stats["claim_conflicts"] += 1
+            # Every candidate went to other claimers; read the pool again
+        return None
+
+    # Settings
+
+    def settings(self) -> Dict:
+        snap = _pool().document(SETTINGS_DOC).get()
+        settings = snap.to_dict() if snap.exists else {}
+        return self._remember({"low": settings.get("low", WARM_POOL_LOW), "high": settings.get("high", WARM_POOL_HIGH)})
+
+    def _remember(self, watermarks: Dict) -> Dict:
+        with self._lock:
+            self._watermarks = dict(watermarks)
+            self._watermarks_read_at = time.monotonic()
+        return watermarks
+
+    def _cached_watermarks(self) -> Dict:
+        """The watermarks, re-read from _settings once they are settings_ttl old."""
+        with self._lock:
+            if self._watermarks is not None and time.monotonic() - self._watermarks_read_at < self.settings_ttl:
+                return self._watermarks
+        return self.settings()
+
+    def set_watermarks(self, low: int, high: int, updated_by: str) -> Dict:
+        if not 0 <= low <= high <= WARM_POOL_MAX:
+            raise ValueError(f"Watermarks must satisfy 0 <= low <= high <= {WARM_POOL_MAX}")
+        _pool().document(SETTINGS_DOC).set({"low": low, "high": high, "updated_by": updated_by,
+                                            "updated_at": now_utc()}, merge=True)
+        self._remember({"low": low, "high": high})
+        self.wake()
+        return {"low": low, "high": high}
+
+    def status(self) -> Dict:
+        counts = {POOL_READY: 0, POOL_CREATING: 0}
+        for snap in _pool().where("state", "in", [POOL_READY, POOL_CREATING]).select(["state"]).stream():
+            counts[snap.to_dict()["state"]] += 1
+        return {**self.settings(), **counts, "stats": self.stats()}
+
+    # Refill
+
+    def start(self) -> None:
+        if self.refill_seconds <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="warm-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stop refilling; services still being created are cleaned up as stale by a later pass."""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=timeout)
+        with self._lock:
+            self._thread = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                self.refill()
+            except Exception as e:
+                print(f"WARNING: Warm pool refill failed: {e}")
+            self._wakeup.wait(self.refill_seconds)
+
+    def refill(self) -> Dict:
+        """One refill pass against the watermarks; returns what it did."""
+        db = get_db()
+        settings_ref = _pool().document(SETTINGS_DOC)
+        lease_until = now_utc() + timedelta(seconds=REFILL_LEASE_SECONDS)
+        watermarks = _acquire_refill_lease(db.transaction(), settings_ref, lease_until)
+        if watermarks is None:
+            self.settings()
+            return {"skipped": "another replica is refilling"}
+        self._remember(watermarks)
+        result = {"created": 0, "failed": 0, "trimmed": 0, "stale": 0}
+        try:
+            ready, creating = self._inventory(result)
+            low, high = watermarks["low"], watermarks["high"]
+            have = len(ready) + creating
+            if have < low:
+                self._create(high - have, result)
+            elif len(ready) > high:
+                self._trim(ready[high:], result)
+        finally:
+            settings_ref.set({"refill_lease_until": firestore.DELETE_FIELD}, merge=True)
+        with self._lock:
+            self._stats["refills"] += 1
+            self._stats["created"] += result["created"]
+            self._stats["create_failures"] += result["failed"]
+            self._stats["trimmed"] += result["trimmed"]
+        if result["created"] or result["failed"] or result["trimmed"]:
+            print(f"✓ Warm pool refill: {result}")
+        return result
+
+    def _inventory(self, result: Dict) -> Tuple[List, int]:
+        """Ready snapshots and the number of live "creating" entries; drops stale ones."""
+        stale_before = now_utc() - timedelta(seconds=CREATING_STALE_SECONDS)
+        ready, creating = [], 0
+        for snap in _pool().where("state", "in", [POOL_READY, POOL_CREATING]).stream():
+            data = snap.to_dict()
+            if data["state"] == POOL_READY:
+                ready.append(snap)
+            elif data.get("created_at") is not None and data["created_at"] < stale_before:
+                self._discard(snap.id)
+                result["stale"] += 1
+            else:
+                creating += 1
+        return ready, creating
+
+    def _create(self, count: int, result: Dict) -> None:
+        def create_one(_index: int) -> bool:
+            service_name = f"attack-client-pool-{uuid.uuid4().hex[:12]}"
+            pool_ref = _pool().document(service_name)
+            pool_ref.set({"state": POOL_CREATING, "created_at": now_utc()})
+            try:
+                uri = create_cloud_run_service(service_name, "")
+            except Exception as e:
+                print(f"WARNING: Failed to create pooled service {service_name}: {e}")
+                self._discard(service_name)
+                return False
+            pool_ref.update({"state": POOL_READY, "uri": uri, "ready_at": now_utc()})
+            return True
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, count), thread_name_prefix="warm-pool") as pool:
+            for ok in pool.map(create_one, range(count)):
+                result["created" if ok else "failed"] += 1
+
+    def _trim(self, excess: List, result: Dict) -> None:
+        db = get_db()
+        for snap in excess:
+            # Claimed like a login would, so a concurrent login cannot get a service being deleted
+            if _claim(db.transaction(), snap.reference, None) is not None:
+                self._discard(snap.id)
+                result["trimmed"] += 1
+
+    def _discard(self, service_name: str) -> None:
+        try:
+            delete_cloud_run_service(service_name)
+        except Exception as e:
+            print(f"WARNING: Failed to delete pooled service {service_name}: {e}")
+        _pool().document(service_name).delete()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        claims = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / claims if claims else 0.0
+        stats["claim_ms_avg"] = stats["claim_ms_total"] / claims if claims else 0.0
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+_warm_pool: Optional[WarmPool] = None
+_warm_pool_lock = threading.Lock()
+
+def get_warm_pool() -> WarmPool:
+    global _warm_pool
+    if _warm_pool is None:
+        with _warm_pool_lock:
+            if _warm_pool is None:
+                _warm_pool = WarmPool()
+    return _warm_pool
@@ -0,0 +1,90 @@
+"""Shared fixtures: in-process backends for every external service.
+
+Firestore is replaced by tests/fake_firestore.py (installed in the client
+registry, so every get_db() / get_async_db() caller sees it), and Cloud
+Run, Cloud DNS and mail use their memory backends.
+"""
+import os
+
+os.environ.update({
+    "JWT_SECRET_KEY": "test-jwt-secret",
+    "RESEND_API_KEY": "test-resend-key",
+    "GCP_PROJECT": "test-project",
+    "CLOUD_RUN_BACKEND": "memory",
+    "DNS_BACKEND": "memory",
+    "DNS_ZONE_DOMAIN": "lab.example.com",
+    "MAIL_BACKEND": "memory",
+    "BCRYPT_ROUNDS": "4",
+    # Background loops are driven by the tests themselves
+    "REAPER_INTERVAL_SECONDS": "0",
+    "WARM_POOL_REFILL_SECONDS": "0",
+    "SECRET_REFRESH_SECONDS": "0",
+    "CLOUD_RUN_CREATE_RATE": "0",
+    "DNS_CHANGE_RATE": "0",
+})
+
+import pytest
+from app import clients
+from app.config import GCP_PROJECT, FIRESTORE_DB
+from app.credential_cache import get_credential_cache
+from app.lab_cache import get_lab_cache
+from tests.fake_firestore import AsyncFakeClient, FakeClient, FakeStore
+
+@pytest.fixture
+def store():
+    """A fresh in-memory Firestore behind get_db() and get_async_db()."""
+    store = FakeStore()
+    sync_key = ("firestore", GCP_PROJECT, FIRESTORE_DB)
+    async_key = ("firestore.async", GCP_PROJECT, FIRESTORE_DB)
+    clients._clients[sync_key] = FakeClient(store)
+    clients._clients[async_key] = AsyncFakeClient(store)
+    get_lab_cache().clear()
+    get_credential_cache().clear()
+    yield store
+    get_lab_cache().clear()
+    get_credential_cache().clear()
+
+@pytest.fixture
+def cloud_run():
+    """An in-process Cloud Run behind create/delete_cloud_run_service(); yields its MemoryRunBackend."""
+    from app.cloud_run import CloudRunServices, MemoryRunBackend, set_cloud_run
+    services = CloudRunServices(MemoryRunBackend())
+    set_cloud_run(services)
+    yield services.backend
+    set_cloud_run(None)
+
+@pytest.fixture
+def dns_zone():
+    """An in-process zone behind the DNS batcher; yields its MemoryZoneBackend."""
+    from app.dns_changes import DnsChangeBatcher, MemoryZoneBackend, set_dns_batcher
+    backend = MemoryZoneBackend()
+    set_dns_batcher(DnsChangeBatcher(backend, window_seconds=0.01))
+    yield backend
+    set_dns_batcher(None)
+
+@pytest.fixture
+def provisioning(store, cloud_run, dns_zone):
+    """Provisioning jobs against the fakes; restores the job backends afterwards."""
+    from app import jobs
+    saved = dict(jobs._backends)
+    yield jobs
+    jobs._backends.update(saved)
+    jobs.shutdown_workers(wait=True)
+    jobs._flights.clear()
+
+@pytest.fixture
+def api():
+    """Call the app in-process (no lifespan, so no background startup): api(method, path, token=None, **kw)."""
+    import asyncio
+    import httpx
+    from app.main import app
+
+    def call(method: str, path: str, token: str = None, **kwargs) -> httpx.Response:
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+        async def send():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.request(method, path, headers=headers, **kwargs)
+        return asyncio.run(send())
+    return call
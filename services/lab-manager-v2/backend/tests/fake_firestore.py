@@ -0,0 +1,428 @@
+"""In-memory Firestore for tests.
+
+Implements the part of the google-cloud-firestore API the app uses, for
+both the sync and asyncio clients over one shared store: top-level
+collections (or a document by path), document get/set/update/delete/create (dotted field paths,
+DELETE_FIELD, merge), collection add, queries (where, order_by, limit,
+select, start_after, stream, get), write batches and transactions.
+
+Transactions hold the store's lock from begin to commit, so they are
+serializable and work with @firestore.transactional unchanged. Snapshot
+listeners return an inert watch.
+"""
+import asyncio
+import copy
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud import firestore
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+_MISSING = object()
+
+def _lookup(data: Dict, path: str) -> Any:
+    value = data
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _assign(data: Dict, path: str, value: Any) -> None:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        child = data.get(part)
+        if not isinstance(child, dict):
+            child = data[part] = {}
+        data = child
+    if value is firestore.DELETE_FIELD:
+        data.pop(parts[-1], None)
+    else:
+        data[parts[-1]] = copy.deepcopy(value)
+
+def _merge(target: Dict, source: Dict) -> None:
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        else:
+            target[key] = copy.deepcopy(value)
+
+def _project(data: Dict, field_paths: Optional[List[str]]) -> Dict:
+    if field_paths is None:
+        return copy.deepcopy(data)
+    projected: Dict = {}
+    for path in field_paths:
+        value = _lookup(data, path)
+        if value is not _MISSING:
+            _assign(projected, path, value)
+    return projected
+
+class FakeSnapshot:
+    def __init__(self, reference, data: Optional[Dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        value = _lookup(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+class _Watch:
+    is_active = True
+
+    def unsubscribe(self) -> None:
+        self.is_active = False
+
+class FakeStore:
+    """Collections of documents shared by the sync and async clients."""
+
+    def __init__(self):
+        self.collections: Dict[str, Dict[str, Dict]] = {}
+        self.lock = threading.RLock()
+        self.ops: Dict[str, int] = {}
+        # Simulated round-trip time of each asyncio client call
+        self.latency = 0.0
+
+    def count(self, op: str) -> None:
+        with self.lock:
+            self.ops[op] = self.ops.get(op, 0) + 1
+
+    def docs(self, collection: str) -> Dict[str, Dict]:
+        return self.collections.setdefault(collection, {})
+
+    # Writes, applied under the lock (directly, or by a batch/transaction commit)
+
+    def apply(self, op: str, collection: str, doc_id: str, data: Optional[Dict] = None, merge: bool = False) -> None:
+        with self.lock:
+            docs = self.docs(collection)
+            if op == "set":
+                if merge and doc_id in docs:
+                    _merge(docs[doc_id], data)
+                else:
+                    docs[doc_id] = {}
+                    _merge(docs[doc_id], data)
+            elif op == "create":
+                if doc_id in docs:
+                    raise AlreadyExists(f"Document already exists: {collection}/{doc_id}")
+                docs[doc_id] = {}
+                _merge(docs[doc_id], data)
+            elif op == "update":
+                if doc_id not in docs:
+                    raise NotFound(f"No document to update: {collection}/{doc_id}")
+                for path, value in data.items():
+                    _assign(docs[doc_id], path, value)
+            elif op == "delete":
+                docs.pop(doc_id, None)
+
+class _WriteBuffer:
+    def __init__(self, store: FakeStore):
+        self._store = store
+        self._writes: List[Tuple] = []
+
+    def set(self, ref, data: Dict, merge: bool = False):
+        self._writes.append(("set", ref, data, merge))
+
+    def create(self, ref, data: Dict):
+        self._writes.append(("create", ref, data, False))
+
+    def update(self, ref, data: Dict):
+        self._writes.append(("update", ref, data, False))
+
+    def delete(self, ref):
+        self._writes.append(("delete", ref, None, False))
+
+    def _apply(self) -> List:
+        writes, self._writes = self._writes, []
+        with self._store.lock:
+            for op, ref, data, merge in writes:
+                self._store.apply(op, ref.collection, ref.id, data, merge)
+        return [None] * len(writes)
+
+class FakeBatch(_WriteBuffer):
+    def commit(self, **_kwargs) -> List:
+        self._store.count("batch_commit")
+        return self._apply()
+
+    def __len__(self):
+        return len(self._writes)
+
+class FakeTransaction(_WriteBuffer):
+    """Satisfies firestore.transactional: the lock is held from _begin to _commit/_rollback."""
+
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, store: FakeStore):
+        super().__init__(store)
+        self._id = None
+        self._held = False
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None) -> None:
+        self._store.lock.acquire()
+        self._held = True
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self) -> List:
+        try:
+            self._store.count("transaction_commit")
+            return self._apply()
+        finally:
+            self._release()
+
+    def _rollback(self) -> None:
+        self._writes = []
+        self._release()
+
+    def _release(self) -> None:
+        if self._held:
+            self._held = False
+            self._store.lock.release()
+
+class FakeDocument:
+    def __init__(self, store: FakeStore, collection: str, doc_id: Optional[str] = None):
+        self._store = store
+        self.collection = collection
+        self.id = doc_id or uuid.uuid4().hex[:20]
+
+    @property
+    def path(self) -> str:
+        return f"{self.collection}/{self.id}"
+
+    def get(self, field_paths: Optional[List[str]] = None, transaction=None, **_kwargs) -> FakeSnapshot:
+        self._store.count("get")
+        with self._store.lock:
+            data = self._store.docs(self.collection).get(self.id)
+            return FakeSnapshot(self, None if data is None else _project(data, field_paths))
+
+    def set(self, data: Dict, merge: bool = False, **_kwargs):
+        self._store.count("set")
+        self._store.apply("set", self.collection, self.id, data, merge)
+
+    def create(self, data: Dict, **_kwargs):
+        self._store.count("create")
+        self._store.apply("create", self.collection, self.id, data)
+
+    def update(self, data: Dict, **_kwargs):
+        self._store.count("update")
+        self._store.apply("update", self.collection, self.id, data)
+
+    def delete(self, **_kwargs):
+        self._store.count("delete")
+        self._store.apply("delete", self.collection, self.id)
+
+    def on_snapshot(self, _callback) -> _Watch:
+        return _Watch()
+
+class FakeQuery:
+    _document = FakeDocument
+
+    def __init__(self, store: FakeStore, collection: str, filters=(), orders=(), limit=None, fields=None,
+                 start_after=None):
+        self._store = store
+        self._collection = collection
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._fields = fields
+        self._start_after = start_after
+
+    def _copy(self, **changes) -> "FakeQuery":
+        state = {"filters": self._filters, "orders": self._orders, "limit": self._limit, "fields": self._fields,
+                 "start_after": self._start_after, **changes}
+        return type(self)(self._store, self._collection, **state)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> "FakeQuery":
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path: str, direction: str = firestore.Query.ASCENDING) -> "FakeQuery":
+        return self._copy(orders=self._orders + [(field_path, direction == firestore.Query.DESCENDING)])
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count)
+
+    def select(self, field_paths: List[str]) -> "FakeQuery":
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, snapshot) -> "FakeQuery":
+        return self._copy(start_after=snapshot)
+
+    def _matches(self, data: Dict) -> bool:
+        for field_path, op, value in self._filters:
+            actual = _lookup(data, field_path)
+            if actual is _MISSING or not _OPERATORS[op](actual, value):
+                return False
+        return all(_lookup(data, field_path) is not _MISSING for field_path, _desc in self._orders)
+
+    def _sort_key(self, item: Tuple[str, Dict]):
+        return tuple(_lookup(item[1], field_path) for field_path, _desc in self._orders) + (item[0],)
+
+    def _results(self) -> List[FakeSnapshot]:
+        self._store.count("query")
+        with self._store.lock:
+            items = [(doc_id, copy.deepcopy(data)) for doc_id, data in self._store.docs(self._collection).items()
+                     if self._matches(data)]
+        # Stable sorts from the last key to the first give mixed directions
+        items.sort(key=lambda item: item[0])
+        for index in range(len(self._orders) - 1, -1, -1):
+            field_path, descending = self._orders[index]
+            items.sort(key=lambda item: _lookup(item[1], field_path), reverse=descending)
+        if self._start_after is not None:
+            ids = [doc_id for doc_id, _data in items]
+            if self._start_after.id in ids:
+                items = items[ids.index(self._start_after.id) + 1:]
+        if self._limit is not None:
+            items = items[:self._limit]
+        return [FakeSnapshot(self._document(self._store, self._collection, doc_id), _project(data, self._fields))
+                for doc_id, data in items]
+
+    def stream(self, transaction=None, **_kwargs):
+        return iter(self._results())
+
+    def get(self, transaction=None, **_kwargs) -> List[FakeSnapshot]:
+        return self._results()
+
+    def on_snapshot(self, _callback) -> _Watch:
+        return _Watch()
+
+class FakeCollection(FakeQuery):
+    def __init__(self, store: FakeStore, collection: str, **state):
+        super().__init__(store, collection, **state)
+        self.id = collection
+
+    def _copy(self, **changes) -> FakeQuery:
+        state = {"filters": self._filters, "orders": self._orders, "limit": self._limit, "fields": self._fields,
+                 "start_after": self._start_after, **changes}
+        return FakeQuery(self._store, self._collection, **state)
+
+    def document(self, doc_id: Optional[str] = None) -> FakeDocument:
+        return FakeDocument(self._store, self._collection, doc_id)
+
+    def add(self, data: Dict, document_id: Optional[str] = None, **_kwargs):
+        ref = self.document(document_id)
+        ref.create(data)
+        return None, ref
+
+class FakeClient:
+    """Stands in for firestore.Client."""
+
+    def __init__(self, store: Optional[FakeStore] = None):
+        self.store = store or FakeStore()
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self.store, name)
+
+    def document(self, path: str) -> FakeDocument:
+        """A top-level document by path, e.g. "invites/<id>"."""
+        collection, doc_id = path.split("/")
+        return self.collection(collection).document(doc_id)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self.store)
+
+    def transaction(self, **_kwargs) -> FakeTransaction:
+        return FakeTransaction(self.store)
+
+    def close(self) -> None:
+        pass
+
+# asyncio client: the same operations as coroutines, over the same store
+
+class AsyncFakeDocument(FakeDocument):
+    async def get(self, field_paths: Optional[List[str]] = None, transaction=None, **kwargs) -> FakeSnapshot:
+        await asyncio.sleep(self._store.latency)
+        return FakeDocument.get(self, field_paths, **kwargs)
+
+    async def set(self, data: Dict, merge: bool = False, **kwargs):
+        await asyncio.sleep(self._store.latency)
+        FakeDocument.set(self, data, merge)
+
+    async def create(self, data: Dict, **kwargs):
+        await asyncio.sleep(self._store.latency)
+        FakeDocument.create(self, data)
+
+    async def update(self, data: Dict, **kwargs):
+        await asyncio.sleep(self._store.latency)
+        FakeDocument.update(self, data)
+
+    async def delete(self, **kwargs):
+        await asyncio.sleep(self._store.latency)
+        FakeDocument.delete(self)
+
+class AsyncFakeQuery(FakeQuery):
+    _document = AsyncFakeDocument
+
+    def stream(self, transaction=None, **_kwargs):
+        async def results():
+            await asyncio.sleep(self._store.latency)
+            for snap in self._results():
+                await asyncio.sleep(0)
+                yield snap
+        return results()
+
+    async def get(self, transaction=None, **_kwargs) -> List[FakeSnapshot]:
+        await asyncio.sleep(self._store.latency)
+        return self._results()
+
+class AsyncFakeCollection(AsyncFakeQuery):
+    def __init__(self, store: FakeStore, collection: str, **state):
+        super().__init__(store, collection, **state)
+        self.id = collection
+
+    def _copy(self, **changes) -> FakeQuery:
+        state = {"filters": self._filters, "orders": self._orders, "limit": self._limit, "fields": self._fields,
+                 "start_after": self._start_after, **changes}
+        return AsyncFakeQuery(self._store, self._collection, **state)
+
+    def document(self, doc_id: Optional[str] = None) -> AsyncFakeDocument:
+        return AsyncFakeDocument(self._store, self._collection, doc_id)
+
+    async def add(self, data: Dict, document_id: Optional[str] = None, **_kwargs):
+        ref = self.document(document_id)
+        await ref.create(data)
+        return None, ref
+
+class AsyncFakeBatch(FakeBatch):
+    async def commit(self, **kwargs) -> List:
+        await asyncio.sleep(self._store.latency)
+        return FakeBatch.commit(self)
+
+class AsyncFakeClient:
+    """Stands in for firestore.AsyncClient."""
+
+    def __init__(self, store: FakeStore):
+        self.store = store
+
+    def collection(self, name: str) -> AsyncFakeCollection:
+        return AsyncFakeCollection(self.store, name)
+
+    def batch(self) -> AsyncFakeBatch:
+        return AsyncFakeBatch(self.store)
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from datetime import timedelta
+import pytest
+from app.audit import AuditWriter, iter_audit_logs, query_audit_logs, search_keywords
+from app.config import AUDIT_LOGS_COLLECTION
+from app.services import now_utc
+
+def _stalled_writer(tmp_path, overflow: str, **kw):
+    """A writer whose Firestore write hangs until released, with its queue (size 1) full."""
+    writer = AuditWriter(max_queue=1, batch_size=1, flush_interval=0.01, overflow=overflow,
+                         spill_path=str(tmp_path / "spill.ndjson"), **kw)
+    writing, release = threading.Event(), threading.Event()
+    written = []
+
+    def write(events):
+        writing.set()
+        release.wait(10)
+        written.extend(events)
+    writer._write = write
+    writer.enqueue({"action": "first"})
+    assert writing.wait(5)
+    writer.enqueue({"action": "queued"})
+    return writer, release, written
+
+def _spilled(tmp_path):
+    with open(tmp_path / "spill.ndjson", encoding="utf-8") as spill:
+        return [json.loads(line)["action"] for line in spill]
+
+def test_block_policy_waits_bounded_then_spills_on_writer_thread(tmp_path):
+    writer, release, written = _stalled_writer(tmp_path, "block", block_timeout=0.05)
+    started = time.monotonic()
+    writer.enqueue({"action": "overflow"})
+    assert time.monotonic() - started < 1
+    # Handed to the writer thread, not written by the caller
+    assert not (tmp_path / "spill.ndjson").exists() and writer.stats()["overflow"] == 1
+
+    release.set()
+    writer.shutdown()
+    assert [event["action"] for event in written] == ["first", "queued"]
+    assert _spilled(tmp_path) == ["overflow"]
+    assert writer.stats()["spilled"] == 1 and writer.stats()["enqueued"] == 3
+
+def test_spill_policy_never_blocks_the_caller(tmp_path):
+    writer, release, _ = _stalled_writer(tmp_path, "spill")
+    started = time.monotonic()
+    for i in range(100):
+        writer.enqueue({"action": f"overflow{i}"})
+    assert time.monotonic() - started < 0.5
+    release.set()
+    writer.shutdown()
+    assert len(_spilled(tmp_path)) == 100
+
+def test_stats_are_exact_under_concurrent_producers(tmp_path):
+    writer = AuditWriter(max_queue=10, overflow="drop_oldest", spill_path=str(tmp_path / "spill.ndjson"))
+    writer._write = lambda events: time.sleep(30)
+    threads = [threading.Thread(target=lambda: [writer.enqueue({"action": "x"}) for _ in range(500)])
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = writer.stats()
+    assert stats["enqueued"] == 4000
+    # Every event is either still queued, taken by the (stalled) writer, or counted as dropped
+    assert 4000 - stats["dropped"] - stats["queued"] <= writer.batch_size
+
+# Queries
+
+def _seed_logs(store):
+    start = now_utc() - timedelta(hours=1)
+    actors = ["alice@example.com", "bob@example.com", "alice@example.com", "carol@corp.test", "bob@example.com"]
+    for i, actor in enumerate(actors):
+        event = {"timestamp": start + timedelta(minutes=i), "actor_email": actor, "actor_role": "ADMIN",
+                 "action": "reset_lab" if i % 2 else "invite_participant", "target": f"lab{i}", "status": "success"}
+        store.docs(AUDIT_LOGS_COLLECTION)[f"log{i}"] = {**event, "search_keywords": search_keywords(event)}
+
+def test_cursor_pages_round_trip_newest_first(store):
+    _seed_logs(store)
+    pages, cursor = [], None
+    while True:
+        logs, cursor = query_audit_logs(limit=2, cursor=cursor)
+        pages.append([log["id"] for log in logs])
+        if cursor is None:
+            break
+    assert pages == [["log4", "log3"], ["log2", "log1"], ["log0"]]
+    assert [log["id"] for log in iter_audit_logs(page_size=2)] == ["log4", "log3", "log2", "log1", "log0"]
+
+    # Cursors carry over with filters
+    logs, cursor = query_audit_logs(limit=1, actor="Alice@Example.com")
+    assert [log["id"] for log in logs] == ["log2"]
+    logs, cursor = query_audit_logs(limit=1, cursor=cursor, actor="alice@example.com")
+    assert [log["id"] for log in logs] == ["log0"]
+
+@pytest.mark.parametrize("cursor", ["!!!", "gA", "bWlzc2luZw"])
+def test_invalid_cursor_raises_value_error(store, cursor):
+    _seed_logs(store)
+    with pytest.raises(ValueError):
+        query_audit_logs(limit=2, cursor=cursor)
+
+def test_search_matches_keyword_prefixes(store):
+    def ids(search):
+        return sorted(log["id"] for log in iter_audit_logs(page_size=2, search=search))
+
+    _seed_logs(store)
+    assert ids("ali") == ["log0", "log2"]
+    assert ids("ALICE@example.com") == ["log0", "log2"]
+    assert ids("example") == ["log0", "log1", "log2", "log4"]
+    assert ids("reset") == ["log1", "log3"]
+    assert ids("lab3") == ["log3"]
+    # Prefixes only: neither infixes nor single characters match
+    assert ids("lice") == [] and ids("a") == []
+    logs, _cursor = query_audit_logs(limit=10, search="corp", action="reset_lab")
+    assert [log["id"] for log in logs] == ["log3"]
@@ -0,0 +1,75 @@
+import asyncio
+import time
+import bcrypt
+import httpx
+import pytest
+from app import hashing
+from app.auth import verify_token
+from app.config import USERS_COLLECTION
+from app.credential_cache import get_credential_cache
+
+USERS = 100
+RPC_LATENCY = 0.02
+
+@pytest.fixture
+def users(store):
+    """USERS active admins, password "pw-<i>", hashed at the configured cost."""
+    hashing.warm_up()
+    docs = store.docs(USERS_COLLECTION)
+    for i in range(USERS):
+        docs[f"user{i}"] = {
+            "email": f"user{i}@example.com",
+            "password_hash": bcrypt.hashpw(f"pw-{i}".encode(), bcrypt.gensalt(rounds=4)).decode(),
+            "role": "admin",
+            "is_active": True,
+        }
+    yield [(f"user{i}@example.com", f"pw-{i}") for i in range(USERS)]
+    hashing.shutdown()
+
+async def _logins(credentials, concurrent: bool):
+    """Status codes, wall time and worst event-loop stall of a burst of logins."""
+    from app.main import app
+    lag, done = 0.0, asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag = max(lag, time.perf_counter() - started - 0.005)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        def login(email, password):
+            return client.post("/api/v1/auth/login", json={"email": email, "password": password})
+        task = asyncio.ensure_future(ticker())
+        started = time.perf_counter()
+        if concurrent:
+            responses = await asyncio.gather(*[login(*c) for c in credentials])
+        else:
+            responses = [await login(*c) for c in credentials]
+        elapsed = time.perf_counter() - started
+        done.set()
+        await task
+    return [r.status_code for r in responses], elapsed, lag
+
+def test_login_checks_password(users, api):
+    email, password = users[0]
+    assert api("POST", "/api/v1/auth/login", json={"email": email, "password": "wrong"}).status_code == 401
+    assert api("POST", "/api/v1/auth/login", json={"email": "nobody@example.com", "password": "x"}).status_code == 401
+    response = api("POST", "/api/v1/auth/login", json={"email": email, "password": password})
+    assert response.status_code == 200 and response.json()["user"]["role"] == "admin"
+    assert verify_token(response.json()["access_token"])["sub"] == email
+
+def test_concurrent_logins_overlap_firestore_waits(users, store):
+    """100 logins with a 20ms Firestore round trip: one after another vs all at once."""
+    store.latency = RPC_LATENCY
+    statuses, sequential_s, _ = asyncio.run(_logins(users, concurrent=False))
+    assert statuses == [200] * USERS
+    get_credential_cache().clear()
+    statuses, concurrent_s, lag = asyncio.run(_logins(users, concurrent=True))
+    assert statuses == [200] * USERS
+
+    print(f"\n{USERS} logins, {RPC_LATENCY * 1000:.0f}ms per Firestore call: sequential {sequential_s * 1000:.0f}ms, "
+          f"concurrent {concurrent_s * 1000:.0f}ms (event loop stalled at most {lag * 1000:.1f}ms)")
+    assert concurrent_s * 3 < sequential_s
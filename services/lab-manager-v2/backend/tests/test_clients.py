@@ -0,0 +1,47 @@
+import os
+import pytest
+from app import clients
+from app.auth import get_db
+
+@pytest.fixture
+def registry(monkeypatch):
+    """An empty client registry (restored afterwards); Firestore clients point at an emulator address."""
+    monkeypatch.setenv("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+    monkeypatch.setattr(clients, "_clients", {})
+    monkeypatch.setattr(clients, "_created_total", 0)
+    monkeypatch.setattr(clients, "_owner_pid", os.getpid())
+    yield clients
+
+def test_repeated_get_db_reuses_one_client(registry):
+    first = get_db()
+    assert all(get_db() is first for _ in range(10))
+    stats = registry.client_stats()
+    assert stats["pid"] == os.getpid()
+    assert stats["clients"] == 1 and stats["created_total"] == 1
+    # No RPC yet, so no channel has been opened
+    assert stats["channels"] == 0
+
+def test_registry_is_reset_in_a_forked_child(registry):
+    parent_client = get_db()
+    # As if this process were a child forked after the registry was filled
+    registry._owner_pid = -1
+    child_client = get_db()
+    assert child_client is not parent_client
+    stats = registry.client_stats()
+    assert stats["clients"] == 1 and stats["created_total"] == 1
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_fork_hook_clears_inherited_clients(registry):
+    get_db()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        stats = registry.client_stats()
+        os.write(write_end, f"{stats['clients']} {stats['created_total']} {stats['pid']}".encode())
+        os._exit(0)
+    os.close(write_end)
+    reply = os.read(read_end, 100).decode().split()
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    assert reply == ["0", "0", str(pid)]
+    assert registry.client_stats()["clients"] == 1
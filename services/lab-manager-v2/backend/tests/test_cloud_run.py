@@ -0,0 +1,102 @@
+import pytest
+from app.cloud_run import CloudRunServices, MemoryRunBackend
+
+@pytest.fixture
+def backend():
+    """A MemoryRunBackend with one existing public service."""
+    backend = MemoryRunBackend()
+    backend.create_service("attack-client-old")
+    backend.grant_public("attack-client-old")
+    backend.calls.clear()
+    return backend
+
+def test_known_service_is_a_lookup_after_one_sweep(backend):
+    services = CloudRunServices(backend, ttl=60)
+    for _ in range(3):
+        assert services.ensure_service("attack-client-old") == "https://attack-client-old.run.app"
+    assert backend.calls == {"list_services": 1}
+    assert services.stats()["hits"] == 3 and services.stats()["sweeps"] == 1
+
+def test_service_missing_from_a_fresh_listing_is_created_without_a_get(backend):
+    services = CloudRunServices(backend, ttl=60)
+    uri = services.ensure_service("attack-client-new")
+    assert uri == "https://attack-client-new.run.app" and backend.public["attack-client-new"]
+    assert "get_service" not in backend.calls
+    assert backend.calls["create_service"] == 1 and backend.calls["set_iam_policy"] == 1
+    # Remembered: no further calls
+    backend.calls.clear()
+    assert services.ensure_service("attack-client-new") == uri
+    assert backend.calls == {}
+
+def test_failed_sweep_falls_back_to_per_service_gets(backend, monkeypatch):
+    services = CloudRunServices(backend, ttl=60)
+
+    def unavailable():
+        raise RuntimeError("Cloud Run unavailable")
+    monkeypatch.setattr(backend, "list_services", unavailable)
+
+    assert services.ensure_service("attack-client-old") == "https://attack-client-old.run.app"
+    assert services.ensure_service("attack-client-new") == "https://attack-client-new.run.app"
+    # The index is not trusted, so each miss is checked before creating
+    assert backend.calls["get_service"] == 2 and backend.calls["create_service"] == 1
+    stats = services.stats()
+    assert stats["sweep_failures"] == 1 and stats["sweeps"] == 0
+    # Not retried until the TTL runs out
+    services.ensure_service("attack-client-other")
+    assert services.stats()["sweep_failures"] == 1
+
+    monkeypatch.undo()
+    services._swept_at -= 60
+    services.ensure_service("attack-client-old")
+    assert services.stats()["sweeps"] == 1
+
+def test_index_is_reswept_after_its_ttl(backend):
+    services = CloudRunServices(backend, ttl=60)
+    services.ensure_service("attack-client-old")
+    # Deleted by another replica: still looks alive until the next sweep
+    backend.delete_service("attack-client-old")
+    assert services.ensure_service("attack-client-old") == "https://attack-client-old.run.app"
+    assert "create_service" not in backend.calls
+
+    services._swept_at -= 60
+    services.ensure_service("attack-client-old")
+    assert backend.calls["list_services"] == 2 and backend.calls["create_service"] == 1
+    assert "attack-client-old" in backend.services
+
+def test_service_created_by_another_replica_after_the_sweep(backend):
+    services = CloudRunServices(backend, ttl=60)
+    services.sweep()
+    backend.create_service("attack-client-raced")
+    assert services.ensure_service("attack-client-raced") == "https://attack-client-raced.run.app"
+    assert services.stats()["creates"] == 0
+    assert backend.calls["get_service"] == 1 and backend.public["attack-client-raced"]
+
+def test_failed_grant_is_retried_on_the_next_ensure(backend, monkeypatch):
+    services = CloudRunServices(backend, ttl=60)
+    real_grant = backend.grant_public
+
+    def denied(_service_name):
+        raise PermissionError("iam denied")
+    monkeypatch.setattr(backend, "grant_public", denied)
+    services.ensure_service("attack-client-new")
+    assert not backend.public.get("attack-client-new")
+
+    monkeypatch.setattr(backend, "grant_public", real_grant)
+    services.ensure_service("attack-client-new")
+    assert backend.public["attack-client-new"]
+    assert services.stats()["iam_grants"] == 1 and backend.calls["create_service"] == 1
+
+def test_delete_drops_the_index_entry(backend):
+    services = CloudRunServices(backend, ttl=60)
+    services.ensure_service("attack-client-old")
+    assert services.delete_service("attack-client-old")
+    assert not services.delete_service("attack-client-old")
+    services.ensure_service("attack-client-old")
+    assert backend.calls["create_service"] == 1
+    assert services.stats()["deletes"] == 1
+
+def test_zero_ttl_disables_the_index(backend):
+    services = CloudRunServices(backend, ttl=0)
+    services.ensure_service("attack-client-old")
+    services.ensure_service("attack-client-old")
+    assert "list_services" not in backend.calls and backend.calls["get_service"] == 2
@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+from app import hashing
+from app.auth import authenticate_user, create_user
+from app.config import USERS_COLLECTION
+from app.credential_cache import CredentialCache, get_credential_cache
+
+def _users(store):
+    return store.docs(USERS_COLLECTION)
+
+def _change(kind, doc_id, data):
+    return SimpleNamespace(type=SimpleNamespace(name=kind), document=SimpleNamespace(id=doc_id, to_dict=lambda: data))
+
+def test_user_lookups_are_cached_including_misses(store):
+    _users(store)["u1"] = {"email": "ada@example.com", "password_hash": "h1"}
+    cache = CredentialCache(ttl=60, max_entries=10)
+    assert cache.get_user("ada@example.com") == ("u1", {"email": "ada@example.com", "password_hash": "h1"})
+    assert asyncio.run(cache.aget_user("nobody@example.com")) == (None, None)
+    queries = store.ops["query"]
+
+    _users(store)["u2"] = {"email": "nobody@example.com", "password_hash": "h2"}
+    assert asyncio.run(cache.aget_user("ada@example.com"))[0] == "u1"
+    assert cache.get_user("nobody@example.com") == (None, None)
+    assert store.ops["query"] == queries
+    # Callers get copies
+    cache.get_user("ada@example.com")[1]["password_hash"] = "mutated"
+    assert cache.get_user("ada@example.com")[1]["password_hash"] == "h1"
+    stats = cache.stats()
+    assert (stats["user_hits"], stats["user_misses"], stats["users"]) == (4, 2, 2)
+
+def test_verified_password_only_counts_for_the_same_hash(store):
+    cache = CredentialCache(ttl=60, max_entries=10)
+    cache.remember_verified("ada@example.com", "secret", "h1")
+    assert cache.is_verified("ada@example.com", "secret", "h1")
+    assert not cache.is_verified("ada@example.com", "secret", "h2")
+    assert not cache.is_verified("ada@example.com", "wrong", "h1")
+    assert not cache.is_verified("bob@example.com", "secret", "h1")
+    # Passwords are kept only as keyed digests
+    assert all("secret" not in repr(key) for key in cache._verified)
+
+def test_invalidate_drops_user_and_verified_passwords(store):
+    _users(store)["u1"] = {"email": "ada@example.com", "password_hash": "h1"}
+    cache = CredentialCache(ttl=60, max_entries=10)
+    cache.get_user("ada@example.com")
+    cache.remember_verified("ada@example.com", "secret", "h1")
+    cache.invalidate("ada@example.com")
+    assert not cache.is_verified("ada@example.com", "secret", "h1")
+    assert cache.stats()["users"] == 0 and cache.stats()["invalidations"] == 1
+
+def test_entries_expire_and_are_evicted_lru(store):
+    cache = CredentialCache(ttl=60, max_entries=2)
+    for email in ("a@example.com", "b@example.com", "c@example.com"):
+        cache.get_user(email)
+    assert list(cache._users) == ["b@example.com", "c@example.com"]
+    assert cache.stats()["evictions"] == 1
+
+    cache = CredentialCache(ttl=0.01, max_entries=2)
+    cache.remember_verified("ada@example.com", "secret", "h1")
+    asyncio.run(asyncio.sleep(0.02))
+    assert not cache.is_verified("ada@example.com", "secret", "h1")
+    assert cache.stats()["expirations"] == 1
+
+def test_disabled_cache_always_reads_through(store):
+    _users(store)["u1"] = {"email": "ada@example.com", "password_hash": "h1"}
+    cache = CredentialCache(ttl=0)
+    cache.get_user("ada@example.com")
+    cache.get_user("ada@example.com")
+    cache.remember_verified("ada@example.com", "secret", "h1")
+    assert not cache.is_verified("ada@example.com", "secret", "h1")
+    assert cache.stats()["user_hits"] == 0 and store.ops["query"] == 2
+
+def test_listener_refreshes_users_and_drops_changed_credentials(store):
+    user = {"email": "ada@example.com", "password_hash": "h1", "role": "student"}
+    _users(store)["u1"] = dict(user)
+    cache = CredentialCache(ttl=60, max_entries=10)
+    cache.get_user("ada@example.com")
+    cache.remember_verified("ada@example.com", "secret", "h1")
+
+    # A change that leaves the credentials alone refreshes the cached user
+    cache._on_snapshot([], [_change("MODIFIED", "u1", {**user, "role": "admin"})], None)
+    assert cache.get_user("ada@example.com")[1]["role"] == "admin"
+    assert cache.is_verified("ada@example.com", "secret", "h1")
+
+    # A password change (or deactivation) on another replica forgets everything for the user
+    cache._on_snapshot([], [_change("MODIFIED", "u1", {**user, "password_hash": "h2"})], None)
+    assert cache.stats()["users"] == 0 and cache.stats()["verified"] == 0
+    cache.get_user("ada@example.com")
+    cache._on_snapshot([], [_change("MODIFIED", "u1", {**user, "is_active": False})], None)
+    assert cache.stats()["users"] == 0
+    # Users this replica has not cached are ignored
+    cache._on_snapshot([], [_change("ADDED", "u9", {"email": "new@example.com"})], None)
+    assert cache.stats()["users"] == 0
+
+def test_repeat_login_skips_the_query_and_bcrypt(store, monkeypatch):
+    create_user("ada@example.com", "secret", "student")
+    verifies = []
+    real_verify = hashing.verify_password_async
+
+    async def counting_verify(password, password_hash):
+        verifies.append(password)
+        return await real_verify(password, password_hash)
+
+    monkeypatch.setattr(hashing, "verify_password_async", counting_verify)
+    get_credential_cache().clear()
+    queries = store.ops.get("query", 0)
+    for _ in range(3):
+        assert asyncio.run(authenticate_user("Ada@Example.com", "secret"))["email"] == "ada@example.com"
+    assert asyncio.run(authenticate_user("ada@example.com", "wrong")) is None
+    assert verifies == ["secret", "wrong"]
+    assert store.ops["query"] == queries + 1
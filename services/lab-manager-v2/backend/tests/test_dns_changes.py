@@ -0,0 +1,218 @@
+"""DNS change batcher and zone index (app.dns_changes) against MemoryZoneBackend."""
+import threading
+import time
+from app.dns_changes import DnsChangeBatcher, MemoryZoneBackend, ZoneIndex
+
+TARGET = ["air-origin.lab.example.com."]
+
+def _record(name: str, rrdatas=None) -> dict:
+    return {"name": name, "type": "CNAME", "ttl": 300, "rrdatas": list(rrdatas or TARGET)}
+
+def _seed(backend: MemoryZoneBackend, count: int) -> None:
+    for i in range(count):
+        record = _record(f"lab{i}.air.lab.example.com.")
+        backend.records[(record["name"], "CNAME")] = record
+
+def test_concurrent_upserts_merge_into_one_change():
+    backend = MemoryZoneBackend()
+    batcher = DnsChangeBatcher(backend, window_seconds=0.2, max_batch=100)
+    futures, lock = [], threading.Lock()
+
+    def submit(i):
+        future = batcher.upsert(f"lab{i}.air.lab.example.com.", "CNAME", TARGET)
+        with lock:
+            futures.append(future)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [future.result(timeout=5) for future in futures] == ["created"] * 50
+    assert backend.change_calls == 1
+    assert len(backend.records) == 50
+    stats = batcher.stats()
+    assert stats["operations"] == 50 and stats["changes_submitted"] == 1 and stats["max_batch_size"] == 50
+
+def test_upsert_noop_update_and_delete():
+    backend = MemoryZoneBackend()
+    _seed(backend, 2)
+    batcher = DnsChangeBatcher(backend, window_seconds=0.01)
+
+    assert batcher.upsert("lab0.air.lab.example.com.", "CNAME", TARGET).result(5) == "noop"
+    assert backend.change_calls == 0
+    assert batcher.upsert("lab0.air.lab.example.com.", "CNAME", ["other.example.com."]).result(5) == "updated"
+    assert backend.records[("lab0.air.lab.example.com.", "CNAME")]["rrdatas"] == ["other.example.com."]
+    assert batcher.delete("lab1.air.lab.example.com.", "CNAME").result(5) == "deleted"
+    assert batcher.delete("lab1.air.lab.example.com.", "CNAME").result(5) == "noop"
+    assert ("lab1.air.lab.example.com.", "CNAME") not in backend.records
+
+def test_last_operation_per_record_wins_within_a_batch():
+    backend = MemoryZoneBackend()
+    batcher = DnsChangeBatcher(backend)
+    outcomes = batcher.apply([
+        {"action": "upsert", **_record("a.lab.example.com.")},
+        {"action": "delete", "name": "a.lab.example.com.", "type": "CNAME"},
+        {"action": "upsert", **_record("b.lab.example.com.")},
+    ])
+    assert outcomes == ["noop", "noop", "created"]
+    assert list(backend.records) == [("b.lab.example.com.", "CNAME")]
+    assert backend.change_calls == 1
+
+def test_apply_submits_in_chunks_without_waiting():
+    backend = MemoryZoneBackend()
+    batcher = DnsChangeBatcher(backend, window_seconds=10, max_batch=10)
+    started = time.monotonic()
+    outcomes = batcher.apply([{"action": "upsert", **_record(f"lab{i}.lab.example.com.")} for i in range(25)])
+    assert time.monotonic() - started < 1
+    assert outcomes == ["created"] * 25
+    assert backend.change_calls == 3
+
+def test_one_bad_change_does_not_fail_the_batch():
+    backend = MemoryZoneBackend()
+    batcher = DnsChangeBatcher(backend)
+    batcher.index.get("x.lab.example.com.", "CNAME")  # load the (empty) index
+    # Created behind the index's back: the merged change is rejected
+    backend.records[("taken.lab.example.com.", "CNAME")] = _record("taken.lab.example.com.", ["elsewhere."])
+    outcomes = batcher.apply([{"action": "upsert", **_record("taken.lab.example.com.")},
+                              {"action": "upsert", **_record("fresh.lab.example.com.")}])
+    assert outcomes[1] == "created"
+    assert ("fresh.lab.example.com.", "CNAME") in backend.records
+
+def test_disabled_index_looks_records_up_by_name():
+    backend = MemoryZoneBackend()
+    _seed(backend, 100)
+    index = ZoneIndex(backend, ttl=0)
+    assert index.get("lab7.air.lab.example.com.", "CNAME")["rrdatas"] == TARGET
+    assert index.get("missing.lab.example.com.", "CNAME") is None
+    assert backend.list_calls == 0
+
+def test_index_loads_once_then_refreshes_incrementally():
+    backend = MemoryZoneBackend()
+    _seed(backend, 1000)
+    index = ZoneIndex(backend, ttl=0.05)
+    for i in range(1000):
+        assert index.get(f"lab{i}.air.lab.example.com.", "CNAME") is not None
+    assert backend.list_calls == 1
+
+    # Changed by another replica: visible after the TTL without another full listing
+    backend.apply([_record("new.lab.example.com.")], [])
+    time.sleep(0.06)
+    assert index.get("new.lab.example.com.", "CNAME") is not None
+    stats = index.stats()
+    assert stats["full_loads"] == 1 and stats["incremental_refreshes"] == 1 and backend.list_calls == 1
+
+def test_index_lookup_benchmark_10k_records():
+    """Index hit vs the old full-zone scan per lookup, on a 10k-record zone."""
+    backend = MemoryZoneBackend()
+    _seed(backend, 10_000)
+    names = [f"lab{i}.air.lab.example.com." for i in range(0, 10_000, 100)]
+
+    started = time.perf_counter()
+    for name in names:
+        next(r for r in backend.list_all() if r["name"] == name and r["type"] == "CNAME")
+    scan_s = time.perf_counter() - started
+
+    index = ZoneIndex(backend, ttl=60)
+    started = time.perf_counter()
+    for name in names:
+        assert index.get(name, "CNAME") is not None
+    index_s = time.perf_counter() - started
+
+    print(f"\n{len(names)} lookups in a 10k-record zone: full scan {scan_s * 1000:.1f}ms, "
+          f"index {index_s * 1000:.1f}ms (including the one load)")
+    assert index_s * 10 < scan_s
+
+def test_create_dns_record_goes_through_the_batcher(dns_zone):
+    from app.services import create_dns_record, dns_record_name
+    create_dns_record("lab1-air.lab.example.com", "air-origin.lab.example.com")
+    record = dns_zone.records[(dns_record_name("lab1-air.lab.example.com"), "CNAME")]
+    assert record["rrdatas"] == ["air-origin.lab.example.com."]
+    create_dns_record("lab1-air.lab.example.com", "air-origin.lab.example.com")
+    assert dns_zone.change_calls == 1
+
+def test_conflicting_change_is_retried_after_resync():
+    """A record changed by another replica since the index loaded: the rejected change is replanned once."""
+    backend = MemoryZoneBackend()
+    batcher = DnsChangeBatcher(backend, window_seconds=0.01)
+    assert batcher.index.get("lab1.air.lab.example.com.", "CNAME") is None
+    backend.apply([_record("lab1.air.lab.example.com.", ["stale-origin.example.com."])], [])
+
+    assert batcher.upsert("lab1.air.lab.example.com.", "CNAME", TARGET).result(5) == "updated"
+    assert backend.records[("lab1.air.lab.example.com.", "CNAME")]["rrdatas"] == TARGET
+    assert batcher.stats()["errors"] == 0
+
+def test_persistent_failure_is_reported_after_one_retry():
+    class RejectingZone(MemoryZoneBackend):
+        def apply(self, additions, deletions):
+            self.change_calls += 1
+            raise ValueError("412 Precondition Failed")
+
+    backend = RejectingZone()
+    batcher = DnsChangeBatcher(backend, window_seconds=0.01)
+    future = batcher.upsert("lab1.air.lab.example.com.", "CNAME", TARGET)
+    try:
+        future.result(5)
+        raise AssertionError("expected the change to fail")
+    except ValueError:
+        pass
+    assert backend.change_calls == 2 and batcher.stats()["errors"] == 1
+
+def test_apply_and_batched_flushes_do_not_overlap():
+    class SlowZone(MemoryZoneBackend):
+        active = peak = 0
+
+        def apply(self, additions, deletions):
+            SlowZone.active += 1
+            SlowZone.peak = max(SlowZone.peak, SlowZone.active)
+            time.sleep(0.02)
+            SlowZone.active -= 1
+            return super().apply(additions, deletions)
+
+    backend = SlowZone()
+    batcher = DnsChangeBatcher(backend, window_seconds=0.001, max_batch=1)
+    futures = [batcher.upsert(f"up{i}.lab.example.com.", "CNAME", TARGET) for i in range(5)]
+    deleter = threading.Thread(target=batcher.apply, args=(
+        [{"action": "upsert", **_record(f"bulk{i}.lab.example.com.")} for i in range(5)],))
+    deleter.start()
+    deleter.join(10)
+    assert [future.result(5) for future in futures] == ["created"] * 5
+    assert SlowZone.peak == 1 and len(backend.records) == 10
+
+def test_cancelled_waiter_does_not_kill_the_batcher():
+    """A waiter that gives up cancels its future; the rest of the batch and later changes still resolve."""
+    backend = MemoryZoneBackend()
+    batcher = DnsChangeBatcher(backend, window_seconds=0.1)
+    abandoned = batcher.upsert("gone.lab.example.com.", "CNAME", TARGET)
+    kept = batcher.upsert("kept.lab.example.com.", "CNAME", TARGET)
+    assert abandoned.cancel()
+
+    assert kept.result(5) == "created"
+    assert batcher.upsert("later.lab.example.com.", "CNAME", TARGET).result(5) == "created"
+    assert batcher._thread.is_alive()
+    # The abandoned change is still applied
+    assert ("gone.lab.example.com.", "CNAME") in backend.records
+
+def test_async_caller_timeout_leaves_the_batched_change_alone(dns_zone, monkeypatch):
+    import asyncio
+    from app import services
+    release = threading.Event()
+    apply = dns_zone.apply
+    monkeypatch.setattr(dns_zone, "apply", lambda additions, deletions: release.wait(5) and apply(additions, deletions))
+    monkeypatch.setattr(services, "DNS_CHANGE_TIMEOUT", 0.05)
+    submitted = []
+    submit = services._submit_dns_record
+    monkeypatch.setattr(services, "_submit_dns_record", lambda *a: submitted.append(submit(*a)) or submitted[-1])
+
+    async def timed_out():
+        try:
+            await services.create_dns_record_async("lab1-air.lab.example.com", "air-origin.lab.example.com")
+        except asyncio.TimeoutError:
+            return True
+    assert asyncio.run(timed_out())
+
+    name, future = submitted[0]
+    assert not future.cancelled()
+    release.set()
+    assert future.result(5) == "created" and (name, "CNAME") in dns_zone.records
@@ -0,0 +1,81 @@
+import asyncio
+from app.dns_health import DnsHealthProber
+
+class Resolver:
+    """Injected resolver: hostnames in live resolve, "broken.*" raises."""
+
+    def __init__(self, *live: str):
+        self.live = set(live)
+        self.calls = []
+
+    async def __call__(self, hostname: str) -> bool:
+        self.calls.append(hostname)
+        if hostname.startswith("broken."):
+            raise RuntimeError("resolver crashed")
+        return hostname in self.live
+
+def _prober(resolver, **kw) -> DnsHealthProber:
+    kw = {"positive_ttl": 60, "negative_ttl": 5, "concurrency": 2, "idle_seconds": 300, **kw}
+    return DnsHealthProber(resolver=resolver, **kw)
+
+def test_hostnames_are_unknown_until_their_first_probe():
+    resolver = Resolver("up.lab.example.com")
+    prober = _prober(resolver)
+    assert prober.resolves("up.lab.example.com") is None
+    assert prober.resolves("down.lab.example.com") is None
+    assert prober.resolves(None) is False
+    assert not resolver.calls
+
+    assert asyncio.run(prober.probe_due()) == 2
+    assert prober.resolves("up.lab.example.com") is True
+    assert prober.resolves("down.lab.example.com") is False
+
+def test_results_are_cached_for_their_ttl():
+    resolver = Resolver("up.lab.example.com")
+    prober = _prober(resolver, positive_ttl=60, negative_ttl=0)
+    prober.resolves("up.lab.example.com")
+    prober.resolves("down.lab.example.com")
+    asyncio.run(prober.probe_due())
+    # Only the negative result has lapsed
+    assert asyncio.run(prober.probe_due()) == 1
+    assert resolver.calls.count("up.lab.example.com") == 1
+    assert resolver.calls.count("down.lab.example.com") == 2
+
+def test_resolver_errors_count_as_not_resolving():
+    prober = _prober(Resolver())
+    prober.resolves("broken.lab.example.com")
+    asyncio.run(prober.probe_due())
+    assert prober.resolves("broken.lab.example.com") is False
+
+def test_idle_hostnames_are_dropped():
+    resolver = Resolver("up.lab.example.com")
+    prober = _prober(resolver, idle_seconds=0)
+    prober.resolves("up.lab.example.com")
+    asyncio.run(prober.probe_due())
+    assert prober.snapshot() == {}
+    assert not resolver.calls
+
+def test_ready_lab_is_shown_provisioning_only_once_dns_fails(store, api):
+    from datetime import timedelta
+    from app.auth import create_token
+    from app.config import LABS_COLLECTION
+    from app.dns_health import set_dns_prober
+    from app.services import now_utc, stable_lab_id_from_email
+
+    email = "ada@example.com"
+    lab_id = stable_lab_id_from_email(email)
+    store.docs(LABS_COLLECTION)[lab_id] = {
+        "owner_email": email,
+        "expires_at": now_utc() + timedelta(hours=1),
+        "attack": {"state": "ready", "cloud_run_url": "https://client.run.app"},
+    }
+    prober = _prober(Resolver("client.run.app"))
+    set_dns_prober(prober)
+    try:
+        token = create_token(email, "student")
+        assert api("GET", "/api/v1/labs/current", token=token).json()["status"] == "ready"
+        # The victim hostname does not resolve yet
+        asyncio.run(prober.probe_due())
+        assert api("GET", "/api/v1/labs/current", token=token).json()["status"] == "provisioning"
+    finally:
+        set_dns_prober(None)
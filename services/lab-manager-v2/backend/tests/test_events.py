@@ -0,0 +1,42 @@
+import asyncio
+from app.events import LabEventHub
+
+def _hub() -> LabEventHub:
+    return LabEventHub(renderer=lambda lab_id, data: {"lab_id": lab_id, "state": (data or {}).get("state")})
+
+async def _frames(hub: LabEventHub, last_event_id, states):
+    """The status frames one viewer receives while the lab goes through states."""
+    stream = hub.stream("lab1", last_event_id=last_event_id)
+    assert (await stream.__anext__()).startswith("retry:")
+    frames = []
+    for state in states:
+        pending = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)
+        hub._apply("lab1", {"state": state}, loaded=True)
+        frames.append(await asyncio.wait_for(pending, 1))
+    await stream.aclose()
+    return frames
+
+def test_last_event_id_from_another_process_does_not_drop_events(store):
+    # The client last saw id 5000 on another worker; this process has issued far fewer ids.
+    frames = asyncio.run(_frames(_hub(), 5000, ["provisioning", "ready"]))
+    assert ['"state": "provisioning"' in frames[0], '"state": "ready"' in frames[1]] == [True, True]
+
+def test_known_last_event_id_replays_only_newer_events(store):
+    hub = _hub()
+
+    async def scenario():
+        queue = asyncio.Queue()
+        hub._subscribe("lab1", queue)
+        for state in ("queued", "provisioning", "ready"):
+            hub._apply("lab1", {"state": state}, loaded=True)
+        ids = [event_id for event_id, _ in hub._topics["lab1"].events]
+        stream = hub.stream("lab1", last_event_id=ids[0])
+        frames = [await stream.__anext__() for _ in range(3)]
+        await stream.aclose()
+        hub._unsubscribe("lab1", queue)
+        return ids, frames
+
+    ids, frames = asyncio.run(scenario())
+    assert frames[1].startswith(f"id: {ids[1]}\n") and '"provisioning"' in frames[1]
+    assert frames[2].startswith(f"id: {ids[2]}\n") and '"ready"' in frames[2]
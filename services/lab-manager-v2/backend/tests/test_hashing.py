@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+import bcrypt
+import pytest
+from fastapi import HTTPException
+from app import hashing
+
+BENCH_ROUNDS = 6
+LOGINS = 200
+
+@pytest.fixture(scope="module")
+def pool():
+    hashing.warm_up()
+    yield
+    hashing.shutdown()
+
+async def _max_loop_lag(work) -> float:
+    """Run work() while a ticker measures the longest the event loop went without running it."""
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag = max(lag, time.perf_counter() - started - 0.005)
+
+    task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    try:
+        await work()
+    finally:
+        done.set()
+        await task
+    return lag
+
+def test_hash_and_verify_round_trip(pool):
+    hashed = hashing.hash_password("correct horse")
+    assert hashing.hash_cost(hashed) == 4 and not hashing.needs_rehash(hashed)
+    assert hashing.verify_password("correct horse", hashed)
+    assert not hashing.verify_password("wrong", hashed)
+
+def test_concurrent_logins_benchmark(pool):
+    """200 simultaneous password checks: in the pool vs inline on the event loop."""
+    hashed = bcrypt.hashpw(b"secret", bcrypt.gensalt(rounds=BENCH_ROUNDS)).decode()
+
+    async def pooled():
+        results = await asyncio.gather(*[hashing.verify_password_async("secret", hashed) for _ in range(LOGINS)])
+        assert all(results)
+
+    async def inline():
+        for _ in range(LOGINS):
+            assert bcrypt.checkpw(b"secret", hashed.encode())
+
+    started = time.perf_counter()
+    pool_lag = asyncio.run(_max_loop_lag(pooled))
+    pool_s = time.perf_counter() - started
+    started = time.perf_counter()
+    inline_lag = asyncio.run(_max_loop_lag(inline))
+    inline_s = time.perf_counter() - started
+
+    print(f"\n{LOGINS} logins at cost {BENCH_ROUNDS} on {hashing.WORKERS} worker(s): "
+          f"pool {pool_s * 1000:.0f}ms (loop stalled at most {pool_lag * 1000:.1f}ms), "
+          f"inline {inline_s * 1000:.0f}ms (loop stalled {inline_lag * 1000:.0f}ms)")
+    assert pool_lag * 5 < inline_lag
+
+def test_saturated_pool_returns_429(pool, monkeypatch):
+    monkeypatch.setattr(hashing, "_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(hashing, "BCRYPT_ACQUIRE_TIMEOUT", 0.05)
+    hashing._slots.acquire()
+    with pytest.raises(HTTPException) as raised:
+        hashing.verify_password("secret", "$2b$04$" + "a" * 53)
+    assert raised.value.status_code == 429 and raised.value.headers["Retry-After"] == "1"
+
+def test_rehash_is_skipped_when_saturated(pool, monkeypatch):
+    monkeypatch.setattr(hashing, "_slots", threading.BoundedSemaphore(1))
+    hashing._slots.acquire()
+    done = []
+    hashing.rehash_in_background("secret", done.append)
+    hashing._slots.release()
+    hashing.rehash_in_background("secret", done.append)
+    deadline = time.monotonic() + 10
+    while not done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(done) == 1 and hashing.verify_password("secret", done[0])
@@ -0,0 +1,105 @@
+import pytest
+from app import invites, mail
+from app.config import INVITES_COLLECTION, INVITE_JOBS_COLLECTION, MAIL_OUTBOX_COLLECTION
+from app.outbox import MailOutbox
+
+@pytest.fixture
+def sink(store):
+    """A MemoryMailSink behind app.mail."""
+    sink = mail.MemoryMailSink()
+    mail.set_mail_backend(sink)
+    yield sink
+    mail.set_mail_backend(None)
+
+def _invite(participants):
+    """Run a bulk invite to completion; returns its job document and summary event."""
+    job = invites.start_bulk_invite(participants, "admin@example.com")
+    events = list(invites.iter_invite_events(job["job_id"]))
+    return invites.get_invite_job(job["job_id"]), events[-1]
+
+def _recipients(sink):
+    return [message["to"][0] for message in sink.sent]
+
+def _invites_by_email(store):
+    return {data["email"]: (doc_id, data) for doc_id, data in store.docs(INVITES_COLLECTION).items()}
+
+def test_already_sent_invites_and_repeats_are_skipped(store, sink):
+    store.docs(INVITES_COLLECTION)["sent"] = {"email": "ada@example.com", "email_sent": True}
+    store.docs(INVITES_COLLECTION)["unsent"] = {"email": "bob@example.com", "email_sent": False}
+    job, summary = _invite([
+        {"email": "ada@example.com"},
+        {"email": " Bob@Example.com ", "name": "Bob"},
+        {"email": "cy@example.com"},
+        {"email": "CY@example.com"},
+        {"email": "not-an-email"},
+    ])
+
+    assert sorted(_recipients(sink)) == ["bob@example.com", "cy@example.com"]
+    assert job["state"] == "succeeded"
+    assert job["counts"] == {"sent": 2, "queued": 0, "failed": 0, "skipped": 2, "invalid": 1}
+    assert {k: summary[k] for k in job["counts"]} == job["counts"]
+    # The unsent invite is updated in place rather than duplicated
+    docs = _invites_by_email(store)
+    assert len(store.docs(INVITES_COLLECTION)) == 3
+    assert docs["bob@example.com"][0] == "unsent" and docs["bob@example.com"][1]["email_sent"]
+    assert docs["cy@example.com"][1]["job_id"] == job["job_id"]
+
+def test_batches_are_sent_in_one_provider_call_each(store, sink, monkeypatch):
+    monkeypatch.setattr(invites, "INVITE_BATCH_SIZE", 3)
+    job, _summary = _invite([{"email": f"p{i}@example.com"} for i in range(7)])
+    assert sink.calls == 3
+    assert len(sink.sent) == 7
+    assert job["counts"]["sent"] == 7
+
+def test_rejected_batch_is_retried_one_message_at_a_time(store, sink):
+    # The batch call and then the first single send are rejected outright
+    sink.fail_next(2, retryable=False)
+    job, _summary = _invite([{"email": f"p{i}@example.com"} for i in range(3)])
+
+    assert sink.calls == 1 + 3
+    assert _recipients(sink) == ["p1@example.com", "p2@example.com"]
+    assert job["state"] == "succeeded"
+    assert job["counts"] == {"sent": 2, "queued": 0, "failed": 1, "skipped": 0, "invalid": 0}
+    docs = _invites_by_email(store)
+    assert not docs["p0@example.com"][1]["email_sent"]
+    assert docs["p1@example.com"][1]["email_sent"] and docs["p2@example.com"][1]["email_sent"]
+    rejected = store.docs(MAIL_OUTBOX_COLLECTION)[docs["p0@example.com"][1]["mail_id"]]
+    assert rejected["state"] == "failed" and "next_attempt_at" not in rejected
+
+def test_each_invite_is_written_with_its_outbox_message(store, sink):
+    job, _summary = _invite([{"email": "ada@example.com"}, {"email": "bob@example.com"}])
+    outbox = store.docs(MAIL_OUTBOX_COLLECTION)
+    assert len(outbox) == 2
+    for doc_id, invite in store.docs(INVITES_COLLECTION).items():
+        message = outbox[invite["mail_id"]]
+        assert message["ref"] == f"{INVITES_COLLECTION}/{doc_id}"
+        assert message["message"]["to"] == [invite["email"]]
+        assert message["state"] == "sent" and message["attempts"] == 1 and invite["email_sent"]
+    # Nothing is left for the outbox worker
+    assert MailOutbox(concurrency=1).drain() == 0
+
+def test_retryable_failures_are_handed_to_the_outbox(store, sink, monkeypatch):
+    monkeypatch.setattr(mail, "EMAIL_RETRY_BASE_SECONDS", 0)
+    sink.fail_next(mail.EMAIL_MAX_ATTEMPTS, retryable=True)
+    job, _summary = _invite([{"email": "ada@example.com"}])
+    assert job["counts"]["queued"] == 1 and job["counts"]["sent"] == 0
+    (mail_id, message), = store.docs(MAIL_OUTBOX_COLLECTION).items()
+    assert message["state"] == "pending" and message["attempts"] == 1
+
+    # Once due, the worker delivers it and marks the invite sent
+    message["next_attempt_at"] = message["created_at"]
+    outbox = MailOutbox(concurrency=1)
+    assert outbox.drain() == 1
+    assert store.docs(MAIL_OUTBOX_COLLECTION)[mail_id]["state"] == "sent"
+    assert _recipients(sink) == ["ada@example.com"]
+    assert _invites_by_email(store)["ada@example.com"][1]["email_sent"]
+
+def test_job_document_records_a_pipeline_failure(store, sink, monkeypatch):
+    def unavailable(_emails):
+        raise RuntimeError("firestore unavailable")
+    monkeypatch.setattr(invites, "_existing_invites", unavailable)
+    job, summary = _invite([{"email": "ada@example.com"}])
+    assert job["state"] == summary["state"] == "failed"
+    assert job["error"] == "firestore unavailable"
+    assert sink.calls == 0
+    assert store.docs(INVITE_JOBS_COLLECTION)[job["job_id"]]["finished_at"]
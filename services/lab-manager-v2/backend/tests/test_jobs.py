@@ -0,0 +1,286 @@
+"""Provisioning jobs (app.jobs) against fake Firestore, Cloud Run and DNS."""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+import bcrypt
+import httpx
+import pytest
+from app import hashing
+from app.main import app
+from app.services import make_dns_hostname, stable_lab_id_from_email
+
+EMAIL = "student@example.com"
+LAB_ID = stable_lab_id_from_email(EMAIL)
+
+def _lab(store):
+    return store.docs("labs")[LAB_ID]
+
+def _job(store, job_id):
+    return store.docs("provisioning_jobs")[job_id]
+
+def test_create_job_provisions_service_and_dns(provisioning, store, cloud_run, dns_zone):
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    assert job["state"] == provisioning.JOB_QUEUED
+    assert _lab(store)["attack"] == {"state": "provisioning", "job_id": job["job_id"]}
+
+    assert provisioning.run_job(job["job_id"]) == provisioning.JOB_SUCCEEDED
+
+    attack = _lab(store)["attack"]
+    service_name = provisioning.service_name_for(LAB_ID)
+    assert attack["state"] == "ready"
+    assert attack["cloud_run_service"] == service_name
+    assert attack["cloud_run_url"] == f"https://{service_name}.run.app"
+    assert attack["dns_hostname"] == make_dns_hostname(EMAIL, scenario_id="air")
+    assert service_name in cloud_run.services and cloud_run.public[service_name]
+    assert dns_zone.change_calls == 1
+    assert _job(store, job["job_id"])["state"] == provisioning.JOB_SUCCEEDED
+    assert provisioning.get_job(job["job_id"])["result"]["cloud_run_url"] == attack["cloud_run_url"]
+    # The lease is released with the job
+    assert LAB_ID not in store.docs("provisioning_leases")
+
+def test_submitted_job_runs_on_worker_pool(provisioning, store):
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create")
+    future = provisioning._futures.get(job["job_id"])
+    if future is not None:
+        future.result(timeout=10)
+    assert _job(store, job["job_id"])["state"] == provisioning.JOB_SUCCEEDED
+
+def test_reset_reuses_bound_service(provisioning, store, cloud_run):
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    provisioning.run_job(job["job_id"])
+    _lab(store)["attack"]["cloud_run_service"] = "attack-client-pool-abc"
+    cloud_run.services["attack-client-pool-abc"] = {"name": "attack-client-pool-abc",
+                                                   "uri": "https://attack-client-pool-abc.run.app"}
+
+    reset = provisioning.start_lab_provisioning(EMAIL, kind="reset", submit=False)
+    assert _lab(store)["attack"]["state"] == "provisioning"
+    assert _lab(store)["attack"]["cloud_run_service"] == "attack-client-pool-abc"
+    assert provisioning.run_job(reset["job_id"]) == provisioning.JOB_SUCCEEDED
+    assert _lab(store)["attack"]["cloud_run_url"] == "https://attack-client-pool-abc.run.app"
+
+def test_failed_backend_marks_job_and_lab(provisioning, store):
+    def broken_dns(hostname, target):
+        raise RuntimeError("zone unavailable")
+
+    provisioning.set_backends(create_dns=broken_dns)
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    assert provisioning.run_job(job["job_id"]) == provisioning.JOB_FAILED
+
+    attack = _lab(store)["attack"]
+    assert attack["state"] == "error" and attack["error"] == "zone unavailable"
+    # The service created before the failure stays bound for the next reset
+    assert attack["cloud_run_service"] == provisioning.service_name_for(LAB_ID)
+    assert _job(store, job["job_id"])["error"] == "zone unavailable"
+
+def test_cancel_running_job_stops_at_next_stage(provisioning, store, dns_zone):
+    started, release = threading.Event(), threading.Event()
+    real_create = provisioning._backends["create_service"]
+
+    def slow_create(service_name, hostname):
+        started.set()
+        release.wait(10)
+        return real_create(service_name, hostname)
+
+    provisioning.set_backends(create_service=slow_create)
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    runner = threading.Thread(target=provisioning.run_job, args=(job["job_id"],))
+    runner.start()
+    assert started.wait(10)
+    provisioning.cancel_job(job["job_id"])
+    release.set()
+    runner.join(10)
+
+    assert _job(store, job["job_id"])["state"] == provisioning.JOB_CANCELLED
+    attack = _lab(store)["attack"]
+    assert attack["state"] == "error" and attack["error"] == "Provisioning cancelled"
+    assert attack["cloud_run_service"] == provisioning.service_name_for(LAB_ID)
+    assert dns_zone.change_calls == 0
+
+def test_job_cancelled_while_queued_elsewhere_updates_lab(provisioning, store):
+    """Another replica set cancel_requested: the claim cancels it and the lab leaves "provisioning"."""
+    job = provisioning.start_lab_provisioning(EMAIL, kind="reset", submit=False)
+    _lab(store)["attack"]["cloud_run_service"] = "attack-client-pool-abc"
+    _job(store, job["job_id"])["cancel_requested"] = True
+
+    assert provisioning.run_job(job["job_id"]) == provisioning.JOB_CANCELLED
+
+    attack = _lab(store)["attack"]
+    assert attack["state"] == "error" and attack["error"] == "Provisioning cancelled"
+    assert attack["cloud_run_service"] == "attack-client-pool-abc"
+    assert LAB_ID not in store.docs("provisioning_leases")
+    assert provisioning.start_lab_provisioning(EMAIL, kind="reset", submit=False).get("attached") is None
+
+def test_cancel_queued_job_keeps_service_binding(provisioning, store):
+    job = provisioning.start_lab_provisioning(EMAIL, kind="reset", submit=False)
+    _lab(store)["attack"].update({"cloud_run_service": "attack-client-pool-abc",
+                                  "cloud_run_url": "https://attack-client-pool-abc.run.app"})
+    # Queued on the local pool and not started yet
+    provisioning._futures[job["job_id"]] = Future()
+
+    cancelled = provisioning.cancel_job(job["job_id"])
+
+    assert cancelled["state"] == provisioning.JOB_CANCELLED
+    attack = _lab(store)["attack"]
+    assert attack["state"] == "error"
+    assert attack["cloud_run_service"] == "attack-client-pool-abc"
+    assert attack["cloud_run_url"] == "https://attack-client-pool-abc.run.app"
+    assert LAB_ID not in store.docs("provisioning_leases")
+
+def test_cancel_finished_job_is_a_noop(provisioning, store):
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    provisioning.run_job(job["job_id"])
+    assert provisioning.cancel_job(job["job_id"])["state"] == provisioning.JOB_SUCCEEDED
+    assert provisioning.cancel_job("missing") is None
+
+@pytest.mark.parametrize("state", ["running", "succeeded"])
+def test_claim_skips_jobs_not_queued(provisioning, store, state):
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    _job(store, job["job_id"])["state"] = state
+    assert provisioning.run_job(job["job_id"]) is None
+    # The lost claim still drops the local flight (the lease belongs to whoever runs the job)
+    assert LAB_ID not in provisioning._flights and LAB_ID in store.docs("provisioning_leases")
+
+def test_job_finishing_immediately_drops_its_flight(provisioning, store, monkeypatch):
+    """The job may finish on the pool before start_lab_provisioning() returns."""
+    monkeypatch.setattr(provisioning, "_submit", provisioning.run_job)
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create")
+    assert _job(store, job["job_id"])["state"] == provisioning.JOB_SUCCEEDED
+    assert LAB_ID not in provisioning._flights
+    assert provisioning.start_lab_provisioning(EMAIL, kind="reset", submit=False).get("attached") is None
+
+def test_simultaneous_logins_provision_once(provisioning, store, api):
+    """50 first logins of one student at once: one job, one Cloud Run service."""
+    creates = []
+
+    def slow_create(service_name, dns_hostname):
+        creates.append(service_name)
+        time.sleep(0.05)
+        return f"https://{service_name}.run.app"
+    provisioning.set_backends(create_service=slow_create)
+    store.docs("users")["student"] = {
+        "email": EMAIL, "role": "student", "is_active": True,
+        "password_hash": bcrypt.hashpw(b"pw", bcrypt.gensalt(rounds=4)).decode(),
+    }
+    hashing.warm_up()
+    try:
+        async def logins():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await asyncio.gather(*[
+                    client.post("/api/v1/auth/login", json={"email": EMAIL, "password": "pw"}) for _ in range(50)
+                ])
+        responses = asyncio.run(logins())
+    finally:
+        hashing.shutdown()
+
+    assert [r.status_code for r in responses] == [200] * 50
+    job_ids = {r.json()["user"].get("provisioning_job_id") for r in responses} - {None}
+    assert len(job_ids) == 1 and len(store.docs("provisioning_jobs")) == 1
+    provisioning.shutdown_workers(wait=True)
+    assert creates == [provisioning.service_name_for(LAB_ID)]
+    assert _lab(store)["attack"]["state"] == "ready" and not provisioning._flights
+
+def test_concurrent_starts_share_one_job(provisioning, store):
+    barrier = threading.Barrier(50)
+    results = []
+
+    def start():
+        barrier.wait()
+        results.append(provisioning.start_lab_provisioning(EMAIL, kind="create"))
+    threads = [threading.Thread(target=start) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    provisioning.shutdown_workers(wait=True)
+
+    assert len({job["job_id"] for job in results}) == 1
+    assert sum(1 for job in results if not job.get("attached")) == 1
+    assert len(store.docs("provisioning_jobs")) == 1 and not provisioning._flights
+
+def test_job_polling_and_cancel_endpoints(provisioning, store, api):
+    from app.auth import create_token
+    job = provisioning.start_lab_provisioning(EMAIL, kind="create", submit=False)
+    owner = create_token(EMAIL, "student")
+
+    polled = api("GET", f"/api/v1/labs/jobs/{job['job_id']}", owner)
+    assert polled.status_code == 200 and polled.json()["state"] == provisioning.JOB_QUEUED
+    assert api("GET", f"/api/v1/labs/jobs/{job['job_id']}", create_token("other@example.com", "student")).status_code == 404
+    assert api("GET", f"/api/v1/labs/jobs/{job['job_id']}").status_code == 401
+
+    cancelled = api("POST", f"/api/v1/labs/jobs/{job['job_id']}/cancel", owner)
+    assert cancelled.status_code == 200 and cancelled.json()["cancel_requested"] is True
+    assert provisioning.run_job(job["job_id"]) == provisioning.JOB_CANCELLED
+    assert api("GET", f"/api/v1/labs/jobs/{job['job_id']}", owner).json()["state"] == provisioning.JOB_CANCELLED
+
+def _roster(count):
+    return [f"bulk{i}@example.com" for i in range(count)]
+
+def test_bulk_provisioning_is_bounded_by_its_concurrency(provisioning, store):
+    active, peak, lock = [0], [0], threading.Lock()
+    real_create = provisioning._backends["create_service"]
+
+    def tracked_create(service_name, hostname):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return real_create(service_name, hostname)
+
+    provisioning.set_backends(create_service=tracked_create)
+    events = list(provisioning.provision_labs_bulk(_roster(8), concurrency=2))
+
+    assert peak[0] == 2
+    assert [e["done"] for e in events[:-1]] == list(range(1, 9))
+    assert events[-1] == {"event": "summary", "total": 8, "queued": 8, "skipped": 0,
+                          provisioning.JOB_SUCCEEDED: 8, provisioning.JOB_FAILED: 0, provisioning.JOB_CANCELLED: 0}
+
+def test_bulk_provisioning_reports_skipped_and_failed_labs(provisioning, store):
+    emails = _roster(3)
+    store.docs("labs")[stable_lab_id_from_email(emails[0])] = {"attack": {"state": "ready"}}
+    real_dns = provisioning._backends["create_dns"]
+
+    def dns(hostname, target):
+        if hostname == make_dns_hostname(emails[2], scenario_id="air"):
+            raise RuntimeError("zone unavailable")
+        return real_dns(hostname, target)
+
+    provisioning.set_backends(create_dns=dns)
+    events = list(provisioning.provision_labs_bulk(emails, concurrency=2))
+
+    states = {e["email"]: e["state"] for e in events[:-1]}
+    assert states == {emails[0]: "skipped", emails[1]: provisioning.JOB_SUCCEEDED,
+                      emails[2]: provisioning.JOB_FAILED}
+    summary = events[-1]
+    assert (summary["skipped"], summary["queued"], summary[provisioning.JOB_FAILED]) == (1, 2, 1)
+    assert store.docs("labs")[stable_lab_id_from_email(emails[2])]["attack"]["state"] == "error"
+
+def test_bulk_provisioning_shuts_its_executor_down_on_disconnect(provisioning, store, monkeypatch):
+    executors = []
+
+    class RecordingExecutor(provisioning.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.shutdown_calls = []
+            executors.append(self)
+
+        def shutdown(self, wait=True, **kwargs):
+            self.shutdown_calls.append(wait)
+            super().shutdown(wait=wait, **kwargs)
+
+    monkeypatch.setattr(provisioning, "ThreadPoolExecutor", RecordingExecutor)
+    events = provisioning.provision_labs_bulk(_roster(4), concurrency=2)
+    first = next(events)
+    # The client went away: the response generator is closed
+    events.close()
+
+    executor, = [e for e in executors if e._thread_name_prefix == "bulk-provision"]
+    assert executor.shutdown_calls == [False]
+    # Jobs already handed to it still finish and leave the labs consistent
+    executor.shutdown(wait=True)
+    assert first["state"] == provisioning.JOB_SUCCEEDED
+    assert all(store.docs("labs")[stable_lab_id_from_email(email)]["attack"]["state"] == "ready"
+               for email in _roster(4))
@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from app.config import LABS_COLLECTION
+from app.lab_cache import LabCache
+from tests.fake_firestore import AsyncFakeDocument, FakeDocument
+
+def _labs(store):
+    return store.docs(LABS_COLLECTION)
+
+def test_reads_are_cached_until_invalidated(store):
+    _labs(store)["lab1"] = {"status": "active"}
+    cache = LabCache(ttl=60, max_entries=10)
+    assert cache.get("lab1") == {"status": "active"}
+    _labs(store)["lab1"] = {"status": "expired"}
+    assert cache.get("lab1") == {"status": "active"}
+    cache.invalidate("lab1")
+    assert asyncio.run(cache.aget("lab1")) == {"status": "expired"}
+    # Missing labs are cached too
+    assert cache.get("nope") is None
+    _labs(store)["nope"] = {"status": "active"}
+    assert cache.get("nope") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (2, 3, 1)
+
+def test_callers_get_copies(store):
+    _labs(store)["lab1"] = {"attack": {"state": "ready"}}
+    cache = LabCache(ttl=60, max_entries=10)
+    cache.get("lab1")["attack"]["state"] = "mutated"
+    assert cache.get("lab1") == {"attack": {"state": "ready"}}
+
+def test_entries_expire_and_are_evicted_lru(store):
+    for i in range(3):
+        _labs(store)[f"lab{i}"] = {"n": i}
+    cache = LabCache(ttl=60, max_entries=2)
+    cache.get("lab0")
+    cache.get("lab1")
+    cache.get("lab0")
+    cache.get("lab2")
+    assert cache.stats()["evictions"] == 1 and "lab1" not in cache._entries
+
+    cache = LabCache(ttl=0.01, max_entries=2)
+    cache.get("lab0")
+    asyncio.run(asyncio.sleep(0.02))
+    _labs(store)["lab0"] = {"n": 99}
+    assert cache.get("lab0") == {"n": 99}
+    assert cache.stats()["expirations"] == 1
+
+def test_invalidate_during_a_miss_is_not_undone(store, monkeypatch):
+    _labs(store)["lab1"] = {"status": "active"}
+    cache = LabCache(ttl=60, max_entries=10)
+    real_load = cache._load
+
+    def load_then_write(lab_id):
+        data = real_load(lab_id)
+        # A writer updates the lab and invalidates while this read is in flight
+        _labs(store)["lab1"] = {"status": "expired"}
+        cache.invalidate(lab_id)
+        return data
+
+    monkeypatch.setattr(cache, "_load", load_then_write)
+    assert cache.get("lab1") == {"status": "active"}
+    monkeypatch.setattr(cache, "_load", real_load)
+    assert cache.get("lab1") == {"status": "expired"}
+    assert cache._loading == {}
+
+def test_async_miss_racing_an_invalidate_is_not_stored(store, monkeypatch):
+    _labs(store)["lab1"] = {"status": "active"}
+    cache = LabCache(ttl=60, max_entries=10)
+
+    async def slow_response(self, *args, **kwargs):
+        # The document is read at once; the response takes a while to arrive
+        snap = FakeDocument.get(self)
+        await asyncio.sleep(0.02)
+        return snap
+
+    monkeypatch.setattr(AsyncFakeDocument, "get", slow_response)
+
+    async def race():
+        read = asyncio.ensure_future(cache.aget("lab1"))
+        await asyncio.sleep(0.005)
+        _labs(store)["lab1"] = {"status": "expired"}
+        cache.invalidate("lab1")
+        return await read
+
+    assert asyncio.run(race()) == {"status": "active"}
+    assert "lab1" not in cache._entries
+    assert cache.get("lab1") == {"status": "expired"}
+
+def test_failed_read_releases_its_generation(store, monkeypatch):
+    cache = LabCache(ttl=60, max_entries=10)
+
+    def unavailable(_lab_id):
+        raise RuntimeError("firestore unavailable")
+
+    monkeypatch.setattr(cache, "_load", unavailable)
+    with pytest.raises(RuntimeError):
+        cache.get("lab1")
+    assert cache._loading == {} and cache._entries == {}
+
+def test_listener_updates_cached_entries(store):
+    _labs(store)["lab1"] = {"status": "active", "n": 1}
+    cache = LabCache(ttl=60, max_entries=10)
+    cache.get("lab1")
+
+    def change(kind, data=None):
+        document = SimpleNamespace(id="lab1", to_dict=lambda: data)
+        return SimpleNamespace(type=SimpleNamespace(name=kind), document=document)
+
+    cache._on_snapshot([], [change("MODIFIED", {"status": "active", "n": 2})], None)
+    assert cache.get("lab1") == {"status": "active", "n": 2}
+    cache._on_snapshot([], [change("REMOVED")], None)
+    assert "lab1" not in cache._entries
@@ -0,0 +1,54 @@
+import pytest
+from app import main
+
+class _Worker:
+    def __init__(self, fail: bool = False):
+        self.fail, self.started = fail, False
+
+    def start(self):
+        if self.fail:
+            raise RuntimeError("boom")
+        self.started = True
+
+@pytest.fixture
+def startup(store, cloud_run, monkeypatch):
+    """_background_startup() with the per-process workers replaced; yields them by name."""
+    workers = {"outbox": _Worker(), "reaper": _Worker(fail=True), "warm_pool": _Worker()}
+    monkeypatch.setenv(main.STARTUP_DONE_ENV, "1")
+    main.get_secret_store().prefetch()
+    monkeypatch.setattr(main.hashing, "warm_up", lambda: None)
+    monkeypatch.setattr(main, "get_mail_outbox", lambda: workers["outbox"])
+    monkeypatch.setattr(main, "get_lab_reaper", lambda: workers["reaper"])
+    monkeypatch.setattr(main, "get_warm_pool", lambda: workers["warm_pool"])
+    monkeypatch.setattr(main, "_startup_done", main.threading.Event())
+    monkeypatch.setattr(main, "_startup_failures", [])
+    yield workers
+    main.get_lab_cache().stop_listener()
+    main.get_credential_cache().stop_listener()
+
+def test_failed_startup_step_does_not_block_the_rest(startup, monkeypatch, api):
+    def resume_fails():
+        raise RuntimeError("firestore unavailable")
+    monkeypatch.setattr(main, "resume_queued_jobs", resume_fails)
+    main._background_startup()
+
+    assert main._startup_done.is_set()
+    assert startup["outbox"].started and startup["warm_pool"].started
+    response = api("GET", "/healthz")
+    assert response.status_code == 200
+    assert response.json()["failed_startup_steps"] == ["resume queued jobs", "start lab reaper"]
+
+def test_unexpected_error_still_marks_startup_done(startup, monkeypatch):
+    def sweep_crashes():
+        raise KeyboardInterrupt
+    monkeypatch.setattr(main, "get_cloud_run", sweep_crashes)
+    with pytest.raises(KeyboardInterrupt):
+        main._background_startup()
+    assert main._startup_done.is_set()
+
+def test_secret_wait_is_bounded(startup, monkeypatch):
+    waits = []
+    store = main.get_secret_store()
+    monkeypatch.setattr(store, "wait", lambda timeout=None: waits.append(timeout) or False)
+    main._background_startup()
+    assert waits == [main.SECRET_FETCH_TIMEOUT] and main._startup_done.is_set()
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from prometheus_client import REGISTRY
+from app import metrics
+from app.auth import create_token
+
+def _count(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(f"{name}_count", labels) or 0.0
+
+def test_requests_are_labelled_by_route_template(store, api):
+    token = create_token("student@example.com", "student")
+    route = {"route": "/api/v1/labs/jobs/{job_id}", "method": "GET", "status": "404"}
+    before = _count("lab_manager_http_request_duration_seconds", **route)
+    for job_id in ("a1", "b2", "c3"):
+        assert api("GET", f"/api/v1/labs/jobs/{job_id}", token=token).status_code == 404
+    assert _count("lab_manager_http_request_duration_seconds", **route) == before + 3
+
+    # Ids never become label values; unknown paths share one series
+    ids = [s for m in REGISTRY.collect() for s in m.samples if "a1" in str(s.labels.values())]
+    assert not ids
+    unmatched = {"route": "unmatched", "method": "GET", "status": "404"}
+    before = _count("lab_manager_http_request_duration_seconds", **unmatched)
+    api("GET", "/no/such/path/123")
+    api("GET", "/no/such/path/456")
+    assert _count("lab_manager_http_request_duration_seconds", **unmatched) == before + 2
+
+def test_timed_records_dependency_latency_and_outcome():
+    ok = {"dependency": "cloud_dns", "operation": "test_op", "outcome": "ok"}
+    error = {**ok, "outcome": "error"}
+    before_ok = _count("lab_manager_dependency_duration_seconds", **ok)
+    before_error = _count("lab_manager_dependency_duration_seconds", **error)
+
+    with metrics.timed("cloud_dns", "test_op"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metrics.timed("cloud_dns", "test_op"):
+            raise RuntimeError("unavailable")
+
+    assert _count("lab_manager_dependency_duration_seconds", **ok) == before_ok + 1
+    assert _count("lab_manager_dependency_duration_seconds", **error) == before_error + 1
+
+def test_failing_component_stats_do_not_stop_sampling(monkeypatch):
+    monkeypatch.setattr(metrics, "_components", {})
+    metrics.register_component("broken", lambda: 1 / 0)
+    metrics.register_component("cache", lambda: {"size": 7, "hit_rate": 0.5})
+    async def sample():
+        metrics.sample()
+    asyncio.run(sample())
+    assert REGISTRY.get_sample_value("lab_manager_component_stat", {"component": "cache", "stat": "size"}) == 7
+    assert REGISTRY.get_sample_value("lab_manager_component_stat", {"component": "cache", "stat": "hit_rate"}) is None
@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import pytest
+from app import mail, outbox
+from app.config import INVITES_COLLECTION, MAIL_OUTBOX_COLLECTION
+from app.services import invite_email_message, now_utc
+
+@pytest.fixture
+def sink(store):
+    sink = mail.MemoryMailSink()
+    mail.set_mail_backend(sink)
+    yield sink
+    mail.set_mail_backend(None)
+
+def _queue(store, mail_id: str, email: str, ref=None, **fields) -> None:
+    store.docs(MAIL_OUTBOX_COLLECTION)[mail_id] = {
+        **outbox.outbox_message(invite_email_message(email), ref=ref), **fields}
+
+def _message(store, mail_id: str):
+    return store.docs(MAIL_OUTBOX_COLLECTION)[mail_id]
+
+def test_drain_delivers_due_messages_and_marks_their_ref(store, sink):
+    store.docs(INVITES_COLLECTION)["inv1"] = {"email": "ada@example.com", "email_sent": False}
+    _queue(store, "m1", "ada@example.com", ref=f"{INVITES_COLLECTION}/inv1")
+    _queue(store, "m2", "bob@example.com")
+    _queue(store, "later", "cy@example.com", next_attempt_at=now_utc() + timedelta(hours=1))
+
+    worker = outbox.MailOutbox(concurrency=1)
+    assert worker.drain() == 2
+    assert sorted(m["to"][0] for m in sink.sent) == ["ada@example.com", "bob@example.com"]
+    sent = _message(store, "m1")
+    assert sent["state"] == outbox.MAIL_SENT and sent["attempts"] == 1 and "next_attempt_at" not in sent
+    assert store.docs(INVITES_COLLECTION)["inv1"]["email_sent"]
+    assert _message(store, "later")["state"] == outbox.MAIL_PENDING
+    assert worker.stats()["sent"] == 2
+    # Sent messages leave the queue
+    assert worker.drain() == 0
+
+def test_retryable_failure_is_rescheduled_until_max_attempts(store, sink):
+    _queue(store, "m1", "ada@example.com")
+    worker = outbox.MailOutbox(concurrency=1, max_attempts=2)
+
+    sink.fail_next(1, retryable=True)
+    worker.drain()
+    message = _message(store, "m1")
+    assert message["state"] == outbox.MAIL_PENDING and message["attempts"] == 1
+    assert message["next_attempt_at"] > now_utc()
+    assert worker.drain() == 0
+
+    message["next_attempt_at"] = now_utc()
+    sink.fail_next(1, retryable=True)
+    worker.drain()
+    message = _message(store, "m1")
+    assert message["state"] == outbox.MAIL_FAILED and message["attempts"] == 2
+    assert "next_attempt_at" not in message
+    assert worker.stats()["retried"] == 1 and worker.stats()["failed"] == 1
+    assert not sink.sent
+
+def test_unexpected_error_fails_the_message_without_stopping_the_drain(store, sink):
+    malformed = outbox.outbox_message({})
+    del malformed["message"]
+    store.docs(MAIL_OUTBOX_COLLECTION)["broken"] = malformed
+    _queue(store, "m1", "ada@example.com")
+
+    worker = outbox.MailOutbox(concurrency=2)
+    # Deliver through a pool, as the running worker does
+    worker._pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        assert worker.drain() == 2
+    finally:
+        worker._pool.shutdown()
+    broken = _message(store, "broken")
+    assert broken["state"] == outbox.MAIL_FAILED and broken["attempts"] == 1 and broken["error"]
+    assert _message(store, "m1")["state"] == outbox.MAIL_SENT
+
+def test_claimed_message_is_redelivered_only_after_its_lease(store, sink):
+    _queue(store, "m1", "ada@example.com")
+    lease_until = now_utc() + timedelta(seconds=120)
+    db = outbox.get_db()
+    ref = db.collection(MAIL_OUTBOX_COLLECTION).document("m1")
+    assert outbox._claim(db.transaction(), ref, lease_until) is not None
+    # A second worker does not get it while the first holds the lease
+    assert outbox._claim(db.transaction(), ref, lease_until) is None
+
+    worker = outbox.MailOutbox(concurrency=1)
+    assert worker.drain() == 0 and not sink.sent
+    # The first worker died: once the lease runs out the message is claimed and sent again
+    _message(store, "m1")["next_attempt_at"] = now_utc() - timedelta(seconds=1)
+    assert worker.drain() == 1
+    assert _message(store, "m1")["state"] == outbox.MAIL_SENT
+    assert len(sink.sent) == 1
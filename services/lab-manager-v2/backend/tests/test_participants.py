@@ -0,0 +1,71 @@
+from datetime import timedelta
+import pytest
+from app.auth import create_token
+from app.config import LABS_COLLECTION
+from app.participants import iter_participants, query_participants
+from app.services import now_utc
+
+EMAILS = ["dora@example.com", "ada@example.com", "eve@example.com", "bob@example.com", "cy@example.com"]
+
+@pytest.fixture
+def labs(store):
+    """Five active labs expiring an hour apart (in EMAILS order) and one expired lab."""
+    now = now_utc()
+    for i, email in enumerate(EMAILS):
+        store.docs(LABS_COLLECTION)[f"lab{i}"] = {
+            "owner_email": email, "lab_name": f"Lab {i}", "status": "active",
+            "created_at": now - timedelta(days=i), "expires_at": now + timedelta(hours=i + 1),
+            "attack": {"state": "ready", "cloud_run_url": "https://x.run.app"}, "victims": {"air": {}},
+        }
+    store.docs(LABS_COLLECTION)["old"] = {"owner_email": "old@example.com", "status": "expired",
+                                          "expires_at": now - timedelta(days=1)}
+    return now
+
+def _pages(**options):
+    pages, cursor = [], None
+    while True:
+        participants, cursor = query_participants(limit=2, cursor=cursor, **options)
+        pages.append([p["email"] for p in participants])
+        if cursor is None:
+            return pages
+
+def test_pages_follow_the_cursor_in_sort_order(labs):
+    assert _pages(sort="email") == [["ada@example.com", "bob@example.com"],
+                                    ["cy@example.com", "dora@example.com"], ["eve@example.com"]]
+    assert _pages(sort="expires_at", order="desc") == [["cy@example.com", "bob@example.com"],
+                                                       ["eve@example.com", "ada@example.com"], ["dora@example.com"]]
+    # The full listing walks the same pages
+    assert [p["email"] for p in iter_participants(page_size=2, sort="email")] == sorted(EMAILS)
+
+def test_participants_are_projected_to_the_listed_columns(labs):
+    participants, _cursor = query_participants(limit=1, sort="email")
+    assert participants == [{
+        "email": "ada@example.com", "lab_id": "lab1", "lab_name": "Lab 1", "status": "active",
+        "created_at": (labs - timedelta(days=1)).isoformat(),
+        "expires_at": (labs + timedelta(hours=2)).isoformat(),
+    }]
+
+def test_expiry_filters(labs):
+    after, before = labs + timedelta(minutes=90), labs + timedelta(minutes=270)
+    assert _pages(expires_after=after, expires_before=before) == [["ada@example.com", "eve@example.com"],
+                                                                    ["bob@example.com"]]
+    with pytest.raises(ValueError):
+        query_participants(limit=2, sort="email", expires_after=after)
+
+def test_endpoint_pages_streams_and_rejects_bad_options(labs, api):
+    token = create_token("admin@example.com", "admin")
+    first = api("GET", "/api/v1/admin/participants", token=token, params={"limit": 3, "sort": "email"}).json()
+    assert [p["email"] for p in first["participants"]] == sorted(EMAILS)[:3]
+    second = api("GET", "/api/v1/admin/participants", token=token,
+                 params={"limit": 3, "sort": "email", "cursor": first["next_cursor"]}).json()
+    assert [p["email"] for p in second["participants"]] == sorted(EMAILS)[3:]
+    assert second["next_cursor"] is None
+
+    streamed = api("GET", "/api/v1/admin/users", token=token, params={"sort": "email", "order": "desc"}).json()
+    assert [p["email"] for p in streamed["participants"]] == sorted(EMAILS, reverse=True)
+    assert streamed["next_cursor"] is None
+
+    for params in ({"sort": "lab_name"}, {"order": "sideways"}, {"limit": 2, "cursor": "bWlzc2luZw"},
+                   {"sort": "email", "expires_before": labs.isoformat()}):
+        assert api("GET", "/api/v1/admin/participants", token=token, params=params).status_code == 400
+    assert api("GET", "/api/v1/admin/participants", token=create_token("ada@example.com", "student")).status_code == 403
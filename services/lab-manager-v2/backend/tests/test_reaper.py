@@ -0,0 +1,197 @@
+import threading
+import time
+from datetime import timedelta
+import pytest
+from app import reaper
+from app.config import LABS_COLLECTION
+from app.services import dns_record_name, now_utc
+
+TARGET = ["air-origin.lab.example.com."]
+
+class Teardown:
+    """Seeds labs and their CNAMEs; stands in for Cloud Run deletion and records what it deleted."""
+
+    def __init__(self, store, dns_zone):
+        self.store, self.dns_zone = store, dns_zone
+        self.deleted, self.failing, self.missing = [], set(), set()
+        self.in_flight = {"now": 0, "peak": 0}
+        self._lock = threading.Lock()
+
+    def delete_service(self, name: str) -> bool:
+        with self._lock:
+            self.in_flight["now"] += 1
+            self.in_flight["peak"] = max(self.in_flight["peak"], self.in_flight["now"])
+        time.sleep(0.02)
+        with self._lock:
+            self.in_flight["now"] -= 1
+        if name in self.failing:
+            raise RuntimeError("permission denied")
+        if name in self.missing:
+            return False
+        self.deleted.append(name)
+        return True
+
+    def seed(self, lab_id: str, expired_minutes_ago: float, **fields) -> None:
+        hostname = f"{lab_id}.air.lab.example.com"
+        self.store.docs(LABS_COLLECTION)[lab_id] = {
+            "owner_email": f"{lab_id}@example.com",
+            "status": "active",
+            "expires_at": now_utc() - timedelta(minutes=expired_minutes_ago),
+            "attack": {"state": "ready", "dns_hostname": hostname, "cloud_run_service": f"svc-{lab_id}"},
+            **fields,
+        }
+        self.dns_zone.apply([{"name": dns_record_name(hostname), "type": "CNAME", "ttl": 300, "rrdatas": TARGET}], [])
+
+    def lab(self, lab_id: str) -> dict:
+        return self.store.docs(LABS_COLLECTION)[lab_id]
+
+    def has_cname(self, lab_id: str) -> bool:
+        return (dns_record_name(f"{lab_id}.air.lab.example.com"), "CNAME") in self.dns_zone.records
+
+@pytest.fixture
+def teardown(store, dns_zone):
+    saved = dict(reaper._backends)
+    t = Teardown(store, dns_zone)
+    reaper.set_backends(delete_service=t.delete_service)
+    yield t
+    reaper._backends.update(saved)
+
+def _reaper(**kw) -> reaper.LabReaper:
+    options = {"interval_seconds": 0, "budget": 50, "concurrency": 4, "grace_seconds": 600, "lease_seconds": 900}
+    return reaper.LabReaper(**{**options, **kw})
+
+def test_dry_run_reports_oldest_first_and_changes_nothing(teardown, dns_zone):
+    for i in range(5):
+        teardown.seed(f"lab{i}", expired_minutes_ago=60 + i)
+    teardown.seed("fresh", expired_minutes_ago=5)
+    teardown.seed("future", expired_minutes_ago=-60)
+
+    report = _reaper().run_once(dry_run=True, budget=3)
+    assert [c["lab_id"] for c in report["candidates"]] == ["lab4", "lab3", "lab2"]
+    assert report["candidates"][0]["service_name"] == "svc-lab4"
+    assert not teardown.deleted and dns_zone.change_calls == 5 + 2
+    assert all(teardown.lab(f"lab{i}")["status"] == "active" for i in range(5))
+
+def test_pass_tears_down_within_budget_and_concurrency(teardown, dns_zone):
+    for i in range(12):
+        teardown.seed(f"lab{i:02d}", expired_minutes_ago=60 + i)
+    teardown.seed("active", expired_minutes_ago=-60)
+    changes = dns_zone.change_calls
+
+    report = _reaper().run_once(dry_run=False, budget=10)
+    assert sorted(report["reaped"]) == [f"lab{i:02d}" for i in range(2, 12)]
+    assert report["services_deleted"] == 10 and report["dns_deleted"] == 10
+    assert 1 < teardown.in_flight["peak"] <= 4
+    assert dns_zone.change_calls == changes + 1
+    lab = teardown.lab("lab05")
+    assert lab["status"] == "expired" and lab["attack"]["state"] == "expired"
+    assert lab["owner_status"] == "lab05@example.com|expired" and "reap_lease_until" not in lab
+    assert not teardown.has_cname("lab05")
+    # Past the budget (newest expiries) and not expired: untouched
+    assert teardown.lab("lab00")["status"] == "active" and teardown.has_cname("lab00")
+    assert teardown.lab("active")["status"] == "active"
+
+def test_failed_delete_keeps_the_claim_and_missing_service_is_fine(teardown):
+    teardown.seed("broken", expired_minutes_ago=90)
+    teardown.seed("gone", expired_minutes_ago=80)
+    teardown.failing.add("svc-broken")
+    teardown.missing.add("svc-gone")
+
+    report = _reaper().run_once(dry_run=False)
+    assert report["reaped"] == ["gone"] and report["services_missing"] == 1
+    assert report["failed"]["broken"].startswith("delete_service:")
+    assert teardown.lab("broken")["status"] == "reaping" and teardown.has_cname("broken")
+    assert teardown.lab("gone")["status"] == "expired"
+
+def test_claims_respect_another_reapers_lease(teardown):
+    teardown.seed("held", expired_minutes_ago=90, status="reaping", reap_lease_until=now_utc() + timedelta(minutes=5))
+    teardown.seed("abandoned", expired_minutes_ago=80, status="reaping",
+                  reap_lease_until=now_utc() - timedelta(minutes=5))
+
+    report = _reaper().run_once(dry_run=False)
+    assert report["skipped"] == ["held"] and report["reaped"] == ["abandoned"]
+    assert teardown.lab("held")["status"] == "reaping" and teardown.deleted == ["svc-abandoned"]
+
+def test_lab_extended_after_the_query_is_left_alone(teardown, monkeypatch):
+    teardown.seed("extended", expired_minutes_ago=90)
+    teardown.seed("expired", expired_minutes_ago=80)
+    lab_reaper = _reaper()
+    find_expired = lab_reaper.find_expired
+
+    def extend_after_query(limit):
+        candidates = find_expired(limit)
+        teardown.lab("extended")["expires_at"] = now_utc() + timedelta(hours=1)
+        return candidates
+    monkeypatch.setattr(lab_reaper, "find_expired", extend_after_query)
+
+    report = lab_reaper.run_once(dry_run=False)
+    assert report["skipped"] == ["extended"] and report["reaped"] == ["expired"]
+    assert teardown.lab("extended")["status"] == "active" and teardown.has_cname("extended")
+
+def test_stats_count_real_passes_only(teardown):
+    teardown.seed("lab1", expired_minutes_ago=90)
+    lab_reaper = _reaper()
+    lab_reaper.run_once(dry_run=True)
+    lab_reaper.run_once(dry_run=False)
+    stats = lab_reaper.stats()
+    assert stats["runs"] == 1 and stats["reaped"] == 1 and stats["services_deleted"] == 1 and not stats["running"]
+
+def test_lab_changed_during_teardown_is_not_marked_expired(teardown, monkeypatch):
+    teardown.seed("revived", expired_minutes_ago=90)
+    delete_service = teardown.delete_service
+
+    def delete_then_revive(name):
+        # A writer that ignored the claim (e.g. an older replica) brought the lab back meanwhile
+        teardown.lab("revived").update({"status": "active", "expires_at": now_utc() + timedelta(hours=1)})
+        return delete_service(name)
+    reaper.set_backends(delete_service=delete_then_revive)
+
+    report = _reaper().run_once(dry_run=False)
+    assert report["superseded"] == ["revived"] and report["reaped"] == []
+    assert teardown.lab("revived")["status"] == "active"
+
+def test_reset_and_extend_are_refused_while_reaping(teardown, provisioning, api):
+    from app.auth import create_token
+    email = "student@example.com"
+    lab_id = provisioning.stable_lab_id_from_email(email)
+    teardown.seed(lab_id, expired_minutes_ago=90, owner_email=email)
+    token = create_token(email, "student")
+    responses = []
+
+    def delete_during_requests(name):
+        responses.append(api("POST", "/api/v1/labs/current/reset", token=token))
+        responses.append(api("POST", "/api/v1/labs/current/extend", token=token, json={"extend_minutes": 60}))
+        return teardown.delete_service(name)
+    reaper.set_backends(delete_service=delete_during_requests)
+
+    report = _reaper().run_once(dry_run=False)
+    assert [r.status_code for r in responses] == [409, 409]
+    assert report["reaped"] == [lab_id] and teardown.lab(lab_id)["status"] == "expired"
+    assert not teardown.store.docs("provisioning_jobs")
+
+def test_extending_a_reaped_lab_reprovisions_it(teardown, provisioning, api):
+    from app.auth import create_token
+    email = "student@example.com"
+    lab_id = provisioning.stable_lab_id_from_email(email)
+    teardown.seed(lab_id, expired_minutes_ago=90, owner_email=email)
+    assert _reaper().run_once(dry_run=False)["reaped"] == [lab_id]
+
+    response = api("POST", "/api/v1/labs/current/extend", token=create_token(email, "student"),
+                   json={"extend_minutes": 60})
+    assert response.status_code == 200 and response.json()["provisioning_job_id"]
+    provisioning.shutdown_workers(wait=True)
+    lab = teardown.lab(lab_id)
+    assert lab["status"] == "active" and lab["attack"]["state"] == "ready"
+    assert lab["expires_at"] > now_utc() + timedelta(minutes=55)
+
+def test_extending_an_active_lab_only_moves_its_expiry(teardown, provisioning, api):
+    from app.auth import create_token
+    email = "student@example.com"
+    lab_id = provisioning.stable_lab_id_from_email(email)
+    teardown.seed(lab_id, expired_minutes_ago=-10, owner_email=email)
+
+    response = api("POST", "/api/v1/labs/current/extend", token=create_token(email, "student"),
+                   json={"extend_minutes": 60})
+    assert response.status_code == 200 and "provisioning_job_id" not in response.json()
+    assert teardown.lab(lab_id)["expires_at"] > now_utc() + timedelta(minutes=55)
+    assert not teardown.store.docs("provisioning_jobs")
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+import pytest
+from app.secret_store import SecretStore
+
+ENV_VAR = "LAB_MANAGER_TEST_SECRET"
+
+@pytest.fixture
+def secrets(tmp_path, monkeypatch):
+    """A SecretStore over a secrets file with one secret, "api" (env var unset)."""
+    monkeypatch.delenv(ENV_VAR, raising=False)
+    path = tmp_path / "secrets.json"
+
+    def write(value):
+        path.write_text(json.dumps(value))
+
+    def make(**kw):
+        store = SecretStore(project="test-project", secrets_file=str(path),
+                            **{"refresh_seconds": 0, "grace_seconds": 60, **kw})
+        store.register("api", ENV_VAR, "api-secret-id", default="fallback")
+        return store
+
+    write({"api": "v1"})
+    return make, write
+
+def test_env_var_wins_over_the_file(secrets, monkeypatch):
+    make, _write = secrets
+    monkeypatch.setenv(ENV_VAR, "from-env")
+    store = make()
+    assert store.get("api") == "from-env"
+    assert store.stats()["api"]["source"] == "env"
+
+def test_prefetch_loads_in_the_background(secrets):
+    make, _write = secrets
+    store = make()
+    assert not store.ready() and store.pending() == ["api"]
+    for thread in store.prefetch():
+        thread.join(5)
+    assert store.ready() and store.wait(0)
+    assert store.get("api") == "v1" and store.stats()["api"]["source"] == "file"
+
+def test_rotation_keeps_the_previous_value_for_the_grace_window(secrets):
+    make, write = secrets
+    store = make(grace_seconds=60)
+    seen = []
+    store.subscribe("api", lambda new, old: seen.append((new, old)))
+    assert store.get("api") == "v1"
+
+    write({"api": "v2"})
+    assert store.refresh() == ["api"]
+    assert store.get("api") == "v2" and store.previous("api") == "v1"
+    assert seen == [("v2", "v1")]
+    assert store.stats()["api"]["rotations"] == 1 and store.stats()["api"]["in_grace_window"]
+    # Unchanged values are not rotations
+    assert store.refresh() == []
+
+    store = make(grace_seconds=0)
+    store.get("api")
+    write({"api": "v3"})
+    store.refresh()
+    assert store.previous("api") is None
+
+def test_failed_refresh_keeps_the_last_good_value(secrets):
+    make, write = secrets
+    store = make()
+    store.get("api")
+    write({})
+    assert store.refresh() == []
+    assert store.get("api") == "v1"
+    assert store.stats()["api"]["refresh_failures"] == 1
+
+@pytest.mark.parametrize("content", [["not", "an", "object"], "just a string"])
+def test_unexpected_file_contents_fall_back_instead_of_raising(secrets, content):
+    make, write = secrets
+    write(content)
+    store = make()
+    assert store.get("api", timeout=5) == "fallback"
+    assert store.stats()["api"]["source"] == "default"
+
+    write({"api": "v1"})
+    store.refresh()
+    write(content)
+    assert store.refresh() == [] and store.get("api") == "v1"
+
+def test_unexpected_load_error_does_not_leave_the_secret_unloaded(secrets, monkeypatch):
+    make, _write = secrets
+    store = make()
+
+    def broken(_secret):
+        raise KeyError("boom")
+    monkeypatch.setattr(store, "_load", broken)
+    assert store.get("api", timeout=5) == "fallback"
+    assert store.ready()
+
+def test_min_age_skips_recent_fetches(secrets):
+    make, write = secrets
+    store = make()
+    store.get("api")
+    write({"api": "v2"})
+    assert store.refresh(min_age=60) == []
+    assert store.get("api") == "v1"
+
+def test_stale_value_is_served_while_it_refreshes(secrets):
+    make, write = secrets
+    store = make(refresh_seconds=0.01)
+    assert store.get("api") == "v1"
+    write({"api": "v2"})
+    time.sleep(0.02)
+    # Returned at once; the refresh runs in the background
+    assert store.get("api") == "v1"
+    deadline = time.monotonic() + 5
+    while store.get("api") != "v2" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.get("api") == "v2"
+
+def test_refresher_thread_picks_up_rotations(secrets):
+    make, write = secrets
+    store = make(refresh_seconds=0.02)
+    rotated = threading.Event()
+    store.subscribe("api", lambda new, old: rotated.set())
+    store.get("api")
+    store.start_refresher()
+    try:
+        write({"api": "v2"})
+        assert rotated.wait(5)
+        assert store.get("api") == "v2"
+    finally:
+        store.stop_refresher()
+    assert store._refresher is None
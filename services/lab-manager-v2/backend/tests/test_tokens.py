@@ -0,0 +1,71 @@
+import time
+from datetime import datetime, timedelta, timezone
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from app import tokens
+from app.auth import is_master_password
+from app.secret_store import get_jwt_secret
+
+VERIFICATIONS = 2000
+
+def _eddsa_pem() -> str:
+    return Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+
+def _ring(algorithm: str) -> tokens.KeyRing:
+    ring = tokens.KeyRing()
+    ring.add_hs256(get_jwt_secret(), activate=algorithm == tokens.HS256)
+    if algorithm == tokens.EDDSA:
+        ring.add_eddsa(private_pem=_eddsa_pem(), activate=True)
+    return ring
+
+@pytest.fixture
+def key_ring(monkeypatch):
+    def use(algorithm: str) -> tokens.KeyRing:
+        ring = _ring(algorithm)
+        monkeypatch.setattr(tokens, "_ring", ring)
+        monkeypatch.setattr(tokens, "_claims", tokens.ClaimsCache())
+        return ring
+    return use
+
+def _token(subject: str = "alice@example.com") -> str:
+    exp = datetime.now(timezone.utc) + timedelta(hours=1)
+    return tokens.encode_token({"sub": subject, "role": "STUDENT", "exp": exp})
+
+@pytest.mark.parametrize("algorithm", [tokens.HS256, tokens.EDDSA])
+def test_master_password_is_the_jwt_secret_whatever_signs_tokens(key_ring, algorithm):
+    key_ring(algorithm)
+    assert is_master_password(get_jwt_secret())
+    assert not is_master_password("") and not is_master_password("not-the-secret")
+
+def test_rotated_key_keeps_verifying_cached_and_uncached(key_ring):
+    ring = key_ring(tokens.HS256)
+    old = _token()
+    ring.rotate_hs256("rotated-secret")
+    assert tokens.decode_token(old)["sub"] == "alice@example.com"
+    assert tokens.decode_token(old)["sub"] == "alice@example.com"
+    assert tokens.get_claims_cache().stats()["hits"] == 1
+    assert ring.decode(_token())[1] == tokens.hs256_kid("rotated-secret")
+
+@pytest.mark.parametrize("algorithm", [tokens.HS256, tokens.EDDSA])
+def test_token_verify_cost_benchmark(key_ring, algorithm):
+    """Per-request token check: signature verification vs the verified-claims cache."""
+    ring = key_ring(algorithm)
+    token = _token()
+
+    started = time.perf_counter()
+    for _ in range(VERIFICATIONS):
+        ring.decode(token)
+    verify_us = (time.perf_counter() - started) / VERIFICATIONS * 1e6
+
+    tokens.decode_token(token)
+    started = time.perf_counter()
+    for _ in range(VERIFICATIONS):
+        tokens.decode_token(token)
+    cached_us = (time.perf_counter() - started) / VERIFICATIONS * 1e6
+
+    print(f"\n{algorithm} token check: verify {verify_us:.1f}us, cached {cached_us:.1f}us")
+    assert tokens.get_claims_cache().stats()["hits"] == VERIFICATIONS
+    assert cached_us < verify_us
@@ -0,0 +1,74 @@
+import threading
+import pytest
+from app import warm_pool
+from app.config import LABS_COLLECTION, WARM_POOL_COLLECTION
+from app.services import now_utc
+
+@pytest.fixture
+def pool(store):
+    """A WarmPool (no refill loop) with five ready services and twenty labs."""
+    for i in range(5):
+        store.docs(WARM_POOL_COLLECTION)[f"attack-client-pool-{i}"] = {
+            "state": warm_pool.POOL_READY, "uri": f"https://attack-client-pool-{i}.run.app", "created_at": now_utc()}
+    for i in range(20):
+        store.docs(LABS_COLLECTION)[f"lab{i}"] = {"attack": {"state": "provisioning"}}
+    store.docs(WARM_POOL_COLLECTION)[warm_pool.SETTINGS_DOC] = {"low": 0, "high": 5}
+    pool = warm_pool.WarmPool(refill_seconds=0)
+    pool.settings()
+    return pool
+
+def _lab_ref(lab_id: str):
+    return warm_pool.get_db().collection(LABS_COLLECTION).document(lab_id)
+
+def test_claim_binds_a_ready_service_to_the_lab(pool, store):
+    name, uri = pool.claim(_lab_ref("lab0"))
+    attack = store.docs(LABS_COLLECTION)["lab0"]["attack"]
+    assert attack["cloud_run_service"] == name and attack["cloud_run_url"] == uri
+    assert name not in store.docs(WARM_POOL_COLLECTION)
+    assert pool.stats()["hits"] == 1
+
+def test_concurrent_claims_hand_each_service_out_once(pool, store):
+    results = {}
+    barrier = threading.Barrier(20)
+
+    def claim(lab_id):
+        barrier.wait()
+        results[lab_id] = pool.claim(_lab_ref(lab_id))
+    threads = [threading.Thread(target=claim, args=(f"lab{i}",)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    names = [claimed[0] for claimed in results.values() if claimed]
+    assert sorted(names) == [f"attack-client-pool-{i}" for i in range(5)]
+    assert pool.stats()["hits"] == 5 and pool.stats()["misses"] == 15
+
+def test_claim_gives_up_after_bounded_attempts(pool, store, monkeypatch):
+    """Every candidate keeps going to other claimers: fall back to a cold create instead of spinning."""
+    monkeypatch.setattr(warm_pool, "_claim", lambda transaction, pool_ref, lab_ref: None)
+    reads = []
+    pool_collection = warm_pool._pool
+    monkeypatch.setattr(warm_pool, "_pool", lambda: reads.append(1) or pool_collection())
+
+    assert pool.claim(_lab_ref("lab0")) is None
+    assert len(reads) == warm_pool.CLAIM_ATTEMPTS
+    assert pool.stats()["claim_conflicts"] == warm_pool.CLAIM_ATTEMPTS * 5 and pool.stats()["misses"] == 1
+
+def test_claim_follows_watermarks_changed_on_another_replica(store):
+    settings = store.docs(WARM_POOL_COLLECTION)
+    settings[warm_pool.SETTINGS_DOC] = {"low": 0, "high": 0}
+    settings["attack-client-pool-0"] = {"state": warm_pool.POOL_READY, "uri": "https://pool-0.run.app"}
+    store.docs(LABS_COLLECTION)["lab0"] = {"attack": {"state": "provisioning"}}
+    pool = warm_pool.WarmPool(refill_seconds=0, settings_ttl=60)
+
+    # Disabled: the claim does not query the pool
+    assert pool.claim(_lab_ref("lab0")) is None
+    assert pool.stats()["misses"] == 0
+
+    # Another replica enables the pool; this one keeps its cached read until the TTL lapses
+    other = warm_pool.WarmPool(refill_seconds=0)
+    other.set_watermarks(1, 2, "admin@example.com")
+    assert pool.claim(_lab_ref("lab0")) is None
+    pool._watermarks_read_at -= 60
+    assert pool.claim(_lab_ref("lab0")) == ("attack-client-pool-0", "https://pool-0.run.app")